@@ -0,0 +1,30 @@
+"""add delivery status to stories
+
+Revision ID: 006_story_delivery_status
+Revises: 005_add_daily_stats
+Create Date: 2026-01-27
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '006_story_delivery_status'
+down_revision = '005_add_daily_stats'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add stories.delivery_status (existing stories are considered delivered)."""
+    op.add_column(
+        'stories',
+        sa.Column('delivery_status', sa.String(length=20), nullable=False, server_default='delivered')
+    )
+    op.alter_column('stories', 'delivery_status', server_default='pending')
+
+
+def downgrade():
+    """Drop stories.delivery_status."""
+    op.drop_column('stories', 'delivery_status')
@@ -0,0 +1,26 @@
+"""add reflection questions to stories
+
+Revision ID: 007_story_reflection_questions
+Revises: 006_story_delivery_status
+Create Date: 2026-01-28
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '007_story_reflection_questions'
+down_revision = '006_story_delivery_status'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add stories.reflection_questions (JSON list, filled after delivery)."""
+    op.add_column('stories', sa.Column('reflection_questions', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    """Drop stories.reflection_questions."""
+    op.drop_column('stories', 'reflection_questions')
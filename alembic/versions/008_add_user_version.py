@@ -0,0 +1,29 @@
+"""add version to users
+
+Revision ID: 008_user_version
+Revises: 007_story_reflection_questions
+Create Date: 2026-01-29
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '008_user_version'
+down_revision = '007_story_reflection_questions'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add users.version for compare-and-set profile patches."""
+    op.add_column(
+        'users',
+        sa.Column('version', sa.Integer(), nullable=False, server_default='1')
+    )
+
+
+def downgrade():
+    """Drop users.version."""
+    op.drop_column('users', 'version')
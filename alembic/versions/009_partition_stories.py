@@ -0,0 +1,122 @@
+"""partition stories by month
+
+Revision ID: 009_partition_stories
+Revises: 008_user_version
+Create Date: 2026-10-19
+
+"""
+from datetime import date, datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '009_partition_stories'
+down_revision = '008_user_version'
+branch_labels = None
+depends_on = None
+
+# Monthly partitions created ahead of the current month
+MONTHS_AHEAD = 2
+
+
+def _month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    """
+    Recreate stories as a table partitioned by RANGE (created_at), one partition per month.
+    Rows are copied as is; the primary key becomes (id, created_at) because PostgreSQL
+    requires the partition key in every unique constraint. Old months are removed by
+    dropping partitions (maintain_story_partitions.py) instead of per-row deletes.
+    """
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    op.execute("ALTER TABLE stories RENAME TO stories_unpartitioned")
+    op.execute("ALTER INDEX IF EXISTS stories_pkey RENAME TO stories_unpartitioned_pkey")
+    op.execute("ALTER INDEX IF EXISTS ix_stories_user_created RENAME TO ix_stories_unpartitioned_user_created")
+    op.execute("ALTER INDEX IF EXISTS ix_stories_created_at RENAME TO ix_stories_unpartitioned_created_at")
+    op.execute("ALTER SEQUENCE stories_id_seq OWNED BY NONE")
+
+    op.execute("""
+        CREATE TABLE stories (
+            id INTEGER NOT NULL DEFAULT nextval('stories_id_seq'::regclass),
+            user_id BIGINT NOT NULL REFERENCES users (telegram_id) ON DELETE CASCADE,
+            text TEXT NOT NULL,
+            model VARCHAR(50) NOT NULL DEFAULT 'deepseek',
+            delivery_status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            reflection_questions JSON,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            CONSTRAINT stories_pkey PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("ALTER SEQUENCE stories_id_seq OWNED BY stories.id")
+    op.create_index('ix_stories_user_created', 'stories', ['user_id', 'created_at'], unique=False)
+    op.create_index('ix_stories_created_at', 'stories', ['created_at'], unique=False)
+    # Catches rows outside the monthly partitions (e.g. if maintenance did not run in time)
+    op.execute("CREATE TABLE stories_default PARTITION OF stories DEFAULT")
+
+    oldest = bind.execute(sa.text("SELECT min(created_at) FROM stories_unpartitioned")).scalar()
+    current = _month_start(datetime.utcnow())
+    month = _month_start(oldest) if oldest is not None and oldest < datetime.utcnow() else current
+    last = _add_months(current, MONTHS_AHEAD)
+    while month <= last:
+        upper = _add_months(month, 1)
+        op.execute(
+            f"CREATE TABLE stories_p{month:%Y%m} PARTITION OF stories "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')"
+        )
+        month = upper
+
+    op.execute("""
+        INSERT INTO stories (id, user_id, text, model, delivery_status, reflection_questions, created_at)
+        SELECT id, user_id, text, model, delivery_status, reflection_questions, created_at
+        FROM stories_unpartitioned
+    """)
+    op.execute("DROP TABLE stories_unpartitioned")
+
+
+def downgrade():
+    """Move all stories back into a single unpartitioned table (full history is kept)."""
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    op.execute("ALTER TABLE stories RENAME TO stories_partitioned")
+    op.execute("ALTER INDEX IF EXISTS stories_pkey RENAME TO stories_partitioned_pkey")
+    op.execute("ALTER INDEX IF EXISTS ix_stories_user_created RENAME TO ix_stories_partitioned_user_created")
+    op.execute("ALTER INDEX IF EXISTS ix_stories_created_at RENAME TO ix_stories_partitioned_created_at")
+    op.execute("ALTER SEQUENCE stories_id_seq OWNED BY NONE")
+
+    op.execute("""
+        CREATE TABLE stories (
+            id INTEGER NOT NULL DEFAULT nextval('stories_id_seq'::regclass),
+            user_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            model VARCHAR(50) NOT NULL DEFAULT 'deepseek',
+            delivery_status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            reflection_questions JSON,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            CONSTRAINT stories_pkey PRIMARY KEY (id),
+            CONSTRAINT stories_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (telegram_id) ON DELETE CASCADE
+        )
+    """)
+    op.execute("ALTER SEQUENCE stories_id_seq OWNED BY stories.id")
+    op.execute("""
+        INSERT INTO stories (id, user_id, text, model, delivery_status, reflection_questions, created_at)
+        SELECT id, user_id, text, model, delivery_status, reflection_questions, created_at
+        FROM stories_partitioned
+    """)
+    op.execute("DROP TABLE stories_partitioned")
+    op.create_index('ix_stories_user_id', 'stories', ['user_id'], unique=False)
+    op.create_index('ix_stories_created_at', 'stories', ['created_at'], unique=False)
+    op.create_index('ix_stories_user_created', 'stories', ['user_id', 'created_at'], unique=False)
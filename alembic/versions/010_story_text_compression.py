@@ -0,0 +1,54 @@
+"""add compressed story text
+
+Revision ID: 010_story_text_compression
+Revises: 009_partition_stories
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '010_story_text_compression'
+down_revision = '009_partition_stories'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add stories.text_zstd / text_dict_id and the story_text_dictionaries table.
+    stories.text becomes nullable: compressed stories keep it NULL.
+    Existing rows are not touched (train_story_dictionary.py --compress-existing).
+    """
+    op.create_table(
+        'story_text_dictionaries',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.Column('sample_count', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.text('CURRENT_TIMESTAMP')),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.add_column('stories', sa.Column('text_zstd', sa.LargeBinary(), nullable=True))
+    op.add_column('stories', sa.Column('text_dict_id', sa.Integer(), nullable=True))
+    op.alter_column('stories', 'text', existing_type=sa.Text(), nullable=True)
+    op.create_check_constraint('ck_stories_text_present', 'stories', 'text IS NOT NULL OR text_zstd IS NOT NULL')
+    # Already compressed, PostgreSQL should not try to TOAST-compress it again
+    op.execute("ALTER TABLE stories ALTER COLUMN text_zstd SET STORAGE EXTERNAL")
+
+
+def downgrade():
+    """
+    Drop compressed text columns and dictionaries.
+    Compressed stories must be decompressed first (their text would be lost).
+    """
+    bind = op.get_bind()
+    compressed = bind.execute(sa.text("SELECT count(*) FROM stories WHERE text_zstd IS NOT NULL")).scalar()
+    if compressed:
+        raise RuntimeError(f"{compressed} stories are stored compressed; decompress them before downgrading")
+    op.drop_constraint('ck_stories_text_present', 'stories', type_='check')
+    op.alter_column('stories', 'text', existing_type=sa.Text(), nullable=False)
+    op.drop_column('stories', 'text_dict_id')
+    op.drop_column('stories', 'text_zstd')
+    op.drop_table('story_text_dictionaries')
@@ -0,0 +1,66 @@
+"""add story request type and materialized analytics
+
+Revision ID: 011_analytics
+Revises: 010_story_text_compression
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '011_analytics'
+down_revision = '010_story_text_compression'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add stories.request_type (which button or message produced the story) and the
+    analytics_* tables filled incrementally by db.analytics.refresh_analytics.
+    Existing stories keep request_type NULL and are reported as 'unknown'.
+    """
+    op.add_column('stories', sa.Column('request_type', sa.String(length=30), nullable=True))
+
+    op.create_table(
+        'analytics_daily',
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('active_users', sa.Integer(), nullable=False),
+        sa.Column('stories', sa.Integer(), nullable=False),
+        sa.Column('new_users', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('date')
+    )
+    op.create_table(
+        'analytics_request_types',
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('request_type', sa.String(length=30), nullable=False),
+        sa.Column('stories', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('date', 'request_type')
+    )
+    op.create_table(
+        'analytics_cohorts',
+        sa.Column('cohort_week', sa.Date(), nullable=False),
+        sa.Column('activity_week', sa.Date(), nullable=False),
+        sa.Column('active_users', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('cohort_week', 'activity_week')
+    )
+    op.create_index('ix_analytics_cohorts_activity_week', 'analytics_cohorts', ['activity_week'], unique=False)
+    op.create_table(
+        'analytics_refresh_state',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('refreshed_until', sa.Date(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    """Drop analytics tables and stories.request_type."""
+    op.drop_table('analytics_refresh_state')
+    op.drop_index('ix_analytics_cohorts_activity_week', table_name='analytics_cohorts')
+    op.drop_table('analytics_cohorts')
+    op.drop_table('analytics_request_types')
+    op.drop_table('analytics_daily')
+    op.drop_column('stories', 'request_type')
@@ -0,0 +1,33 @@
+"""add per-stage timings to stories
+
+Revision ID: 012_story_stage_timings
+Revises: 011_analytics
+Create Date: 2026-10-19
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '012_story_stage_timings'
+down_revision = '011_analytics'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Add stories.agent_ms, generation_ms and delivery_ms (milliseconds, NULL if the stage
+    did not run: no Agent 1 call for buttons, no generation for a cached story).
+    """
+    op.add_column('stories', sa.Column('agent_ms', sa.Integer(), nullable=True))
+    op.add_column('stories', sa.Column('generation_ms', sa.Integer(), nullable=True))
+    op.add_column('stories', sa.Column('delivery_ms', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    """Drop per-stage timings."""
+    op.drop_column('stories', 'delivery_ms')
+    op.drop_column('stories', 'generation_ms')
+    op.drop_column('stories', 'agent_ms')
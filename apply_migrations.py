@@ -1,47 +1,54 @@
-"""Применение миграций Alembic."""
+"""Применение миграций Alembic.
+
+Отдельная одноразовая точка входа для обновления схемы БД: запускается
+перед ботом (например, сервисом basnechkin-migrate в docker-compose),
+сам бот при старте только сверяет ревизию (SCHEMA_CHECK).
+Запуск: python apply_migrations.py [--check]
+"""
 import sys
-import os
+import argparse
 from pathlib import Path
 
 # Добавляем путь к проекту
 sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Применение миграций Alembic")
+    parser.add_argument("--check", action="store_true", help="Только проверить, нужны ли миграции (код 1, если нужны)")
+    args = parser.parse_args()
+
+    try:
+        from db.schema import bundled_head, current_revision, upgrade_to_head
+
+        print("Подключаюсь к базе данных...")
+        head = bundled_head()
+        current = current_revision()
+        print(f"Текущая ревизия: {current or '(нет)'}, ревизия в коде: {head}")
+
+        if current == head:
+            print("✓ Схема БД актуальна, миграции не нужны")
+            return 0
+        if args.check:
+            print("❌ Схема БД отстает, нужно применить миграции")
+            return 1
+
+        print("Применяю миграции...")
+        upgrade_to_head()
+        print(f"✓ Миграции применены успешно! Ревизия: {current_revision()}")
+        return 0
+    except ImportError as e:
+        print(f"❌ Ошибка импорта: {e}")
+        print("\nУбедитесь, что зависимости установлены:")
+        print("  py -m pip install -r requirements.txt")
+        return 1
+    except Exception as e:
+        print(f"❌ Ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
 
-try:
-    from alembic.config import Config
-    from alembic import command
-    from sqlalchemy import create_engine
-    
-    # Загружаем DATABASE_URL
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    database_url = os.getenv("DATABASE_URL")
-    if not database_url:
-        print("❌ DATABASE_URL не установлен в .env")
-        sys.exit(1)
-    
-    # Заменяем postgresql:// на postgresql+psycopg:// для использования psycopg3
-    if database_url.startswith("postgresql://") and "+psycopg" not in database_url:
-        database_url = database_url.replace("postgresql://", "postgresql+psycopg://", 1)
-    
-    print("Подключаюсь к базе данных...")
-    engine = create_engine(database_url)
-    
-    # Создаем конфигурацию Alembic
-    alembic_cfg = Config('alembic.ini')
-    
-    print("Применяю миграции...")
-    command.upgrade(alembic_cfg, "head")
-    print("✓ Миграции применены успешно!")
-    
-except ImportError as e:
-    print(f"❌ Ошибка импорта: {e}")
-    print("\nУбедитесь, что зависимости установлены:")
-    print("  py -m pip install -r requirements.txt")
-    sys.exit(1)
-except Exception as e:
-    print(f"❌ Ошибка: {e}")
-    import traceback
-    traceback.print_exc()
-    sys.exit(1)
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Бенчмарк разбиения длинных сообщений (utils.split_message).
+
+Сравнивает текущую реализацию с прежней посимвольной на текстах
+из 10k, 20k и 40k слов. Запуск: python bench_split_message.py
+"""
+import os
+import random
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from utils import split_message
+from test_split_message import random_story
+
+
+def legacy_split_message(text: str, max_length: int = 3800):
+    """Прежняя реализация: буфер предложений через buffer += char."""
+    if len(text) <= max_length:
+        return [text]
+    chunks = []
+    current_chunk = ""
+    sentences = []
+    buffer = ""
+    for char in text:
+        buffer += char
+        if char in ".!?" and len(buffer) > 10:
+            sentences.append(buffer)
+            buffer = ""
+    if buffer:
+        sentences.append(buffer)
+    if not sentences or any(len(s) > max_length for s in sentences):
+        sentences = text.split("\n\n") or [text]
+    for sentence in sentences:
+        if len(current_chunk) + len(sentence) <= max_length:
+            current_chunk += sentence
+        else:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            if len(sentence) > max_length:
+                for i in range(0, len(sentence), max_length):
+                    chunks.append(sentence[i:i + max_length])
+                current_chunk = ""
+            else:
+                current_chunk = sentence
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks if chunks else [text]
+
+
+def measure(func, text: str, repeat: int = 5) -> float:
+    """Лучшее время из repeat запусков, в миллисекундах."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    rng = random.Random(42)
+    print(f"{'Слов':>8} | {'Символов':>10} | {'Старая, мс':>11} | {'Новая, мс':>10} | {'Частей':>7}")
+    print("-" * 60)
+    for words in (10_000, 20_000, 40_000):
+        text = random_story(rng, words)
+        legacy_ms = measure(legacy_split_message, text)
+        new_ms = measure(split_message, text)
+        parts = len(split_message(text))
+        print(f"{words:>8} | {len(text):>10} | {legacy_ms:>11.2f} | {new_ms:>10.2f} | {parts:>7}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Бенчмарк накладных расходов на формирование промпта для DeepSeek.
+
+Сравнивает вызов story_prompts.build_story_request через поток
+(как раньше, run_blocking / asyncio.to_thread) и напрямую в event loop.
+Запуск: python bench_story_prompts.py
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from story_prompts import build_story_request
+
+PROFILE = {'age': '5 и 7', 'child_names': 'Платон, Демид', 'traits': 'любознательный'}
+REQUEST_TYPES = ["new_dilemma", "random_moral", "previous_moral", "add_traits", "wishes", "regular"]
+
+
+async def run_in_thread(iterations: int) -> float:
+    started = time.perf_counter()
+    for i in range(iterations):
+        await asyncio.to_thread(build_story_request, REQUEST_TYPES[i % len(REQUEST_TYPES)], "не делится", PROFILE)
+    return (time.perf_counter() - started) / iterations
+
+
+async def run_inline(iterations: int) -> float:
+    started = time.perf_counter()
+    for i in range(iterations):
+        build_story_request(REQUEST_TYPES[i % len(REQUEST_TYPES)], "не делится", PROFILE)
+    return (time.perf_counter() - started) / iterations
+
+
+async def main_async(iterations: int):
+    thread_s = await run_in_thread(iterations)
+    inline_s = await run_inline(iterations)
+    print(f"Запросов: {iterations}")
+    print(f"Через поток (до):     {thread_s * 1e6:8.1f} мкс/запрос")
+    print(f"Напрямую (после):     {inline_s * 1e6:8.1f} мкс/запрос")
+    print(f"Ускорение:            {thread_s / inline_s:8.1f}x")
+
+
+def main():
+    # Логи промптов не должны влиять на замер
+    logging.disable(logging.INFO)
+    asyncio.run(main_async(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Выгрузка сырых данных для анализа: метаданные сказок, задержки этапов, daily_stats.
+
+Строки читаются из БД серверным курсором в порядке дат и сразу пишутся в файл,
+поэтому память не зависит от числа строк (миллионы сказок выгружаются так же,
+как сотня). Фильтр --from/--to (включительно) отсекает лишние месячные партиции
+stories. Тексты сказок не выгружаются.
+
+Запуск:
+    python export_data.py stories --from 2026-01-01 --to 2026-03-31
+    python export_data.py latency --from 2026-10-01 --format parquet
+    python export_data.py daily_stats --output daily.csv
+
+Для --format parquet нужен pyarrow: pip install -r requirements-export.txt
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+from datetime import date, datetime
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from src.db.export import DATASETS, export_columns, iter_export_rows
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Строк в одной группе Parquet: столько строк одновременно держится в памяти
+PARQUET_BATCH_SIZE = 50_000
+PROGRESS_EVERY = 100_000
+
+
+def parse_date(value: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается дата ГГГГ-ММ-ДД, получено: {value}")
+
+
+def report_progress(count: int):
+    if count % PROGRESS_EVERY == 0:
+        logger.info(f"Выгружено строк: {count}")
+
+
+def write_csv(rows, columns, filename: str) -> int:
+    count = 0
+    with open(filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(name for name, _ in columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+            report_progress(count)
+    return count
+
+
+def write_parquet(rows, columns, filename: str) -> int:
+    """Пишет строки группами по PARQUET_BATCH_SIZE, не собирая всю выгрузку в памяти."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'int': pa.int64(), 'str': pa.string(), 'bool': pa.bool_(),
+             'date': pa.date32(), 'datetime': pa.timestamp('us')}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+
+    def flush(writer, batch):
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(zip(*batch), schema)], schema=schema
+        ))
+
+    count = 0
+    batch = []
+    with pq.ParquetWriter(filename, schema, compression='zstd') as writer:
+        for row in rows:
+            batch.append(row)
+            count += 1
+            report_progress(count)
+            if len(batch) >= PARQUET_BATCH_SIZE:
+                flush(writer, batch)
+                batch = []
+        if batch:
+            flush(writer, batch)
+    return count
+
+
+WRITERS = {'csv': write_csv, 'parquet': write_parquet}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Потоковая выгрузка данных в CSV/Parquet")
+    parser.add_argument("dataset", choices=tuple(DATASETS),
+                        help="stories - метаданные сказок, latency - задержки этапов, daily_stats - счетчики по дням")
+    parser.add_argument("--from", dest="start", type=parse_date, help="С какой даты (включительно), ГГГГ-ММ-ДД")
+    parser.add_argument("--to", dest="end", type=parse_date, help="По какую дату (включительно), ГГГГ-ММ-ДД")
+    parser.add_argument("--format", choices=tuple(WRITERS), default="csv", help="Формат файла")
+    parser.add_argument("--output", help="Имя файла (по умолчанию <набор>_export_<время>.<формат>)")
+    args = parser.parse_args()
+
+    if args.start and args.end and args.start > args.end:
+        parser.error("--from позже --to")
+    if args.format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print("❌ Для --format parquet нужен pyarrow: pip install -r requirements-export.txt")
+            return 1
+
+    filename = args.output or f"{args.dataset}_export_{datetime.now():%Y%m%d_%H%M%S}.{args.format}"
+    logger.info(f"Выгрузка {args.dataset} с {args.start or 'начала'} по {args.end or 'сегодня'} в файл {filename}...")
+
+    try:
+        rows = iter_export_rows(args.dataset, args.start, args.end)
+        count = WRITERS[args.format](rows, export_columns(args.dataset), filename)
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке данных: {e}", exc_info=True)
+        return 1
+
+    if not count:
+        os.remove(filename)
+        print("Нет данных для выгрузки.\n")
+        return 0
+
+    print(f"✓ Данные выгружены в файл: {filename}")
+    print(f"  Записей: {count}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
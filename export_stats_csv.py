@@ -1,6 +1,14 @@
-"""Export daily statistics to CSV file."""
+"""Export daily statistics and analytics to CSV file.
+
+Rows are streamed from the database (server-side cursor) and written as they
+arrive, oldest first, so memory use does not depend on the period.
+    python export_stats_csv.py
+    python export_stats_csv.py --report cohorts
+    python export_stats_csv.py --report request_types --no-refresh
+"""
 import sys
 import os
+import argparse
 import logging
 import csv
 from datetime import datetime
@@ -10,51 +18,70 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 sys.path.insert(0, os.path.join(current_dir, 'src'))
 
-from src.db.repository import get_daily_stats
+from src.db.analytics import iter_cohorts, iter_daily_analytics, iter_request_types, refresh_analytics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Отчет -> (источник строк, {колонка CSV: ключ строки})
+REPORTS = {
+    'daily': (iter_daily_analytics, {
+        'Дата': 'date',
+        'Сказки': 'stories',
+        'DAU': 'active_users',
+        'Сказок на пользователя': 'stories_per_user',
+        'Новые пользователи': 'new_users',
+        'Команд /start': 'start_commands',
+        'Заполнено анкет': 'profiles_completed',
+    }),
+    'request_types': (iter_request_types, {
+        'Дата': 'date',
+        'Источник': 'request_type',
+        'Сказки': 'stories',
+    }),
+    'cohorts': (iter_cohorts, {
+        'Когорта (неделя)': 'cohort_week',
+        'Неделя после регистрации': 'week',
+        'Пользователей в когорте': 'cohort_size',
+        'Активных': 'active_users',
+        'Удержание': 'retention',
+    }),
+}
+
 
 def main():
     """Export daily statistics to CSV."""
+    parser = argparse.ArgumentParser(description="Экспорт статистики в CSV")
+    parser.add_argument("--report", choices=tuple(REPORTS), default="daily", help="Какой отчет выгрузить")
+    parser.add_argument("--no-refresh", action="store_true", help="Не обновлять аналитику перед выгрузкой")
+    args = parser.parse_args()
+
     try:
+        if not args.no_refresh:
+            refresh_analytics()
+        
         # Генерируем имя файла с текущей датой
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"stats_export_{timestamp}.csv"
+        filename = f"stats_export_{args.report}_{timestamp}.csv"
         
         logger.info(f"Экспорт статистики в файл {filename}...")
         
-        # Получаем статистику за все дни
-        stats = get_daily_stats(limit=1000)
+        rows, columns = REPORTS[args.report]
+        count = 0
+        with open(filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(columns.keys())
+            for row in rows():
+                writer.writerow(row[key] for key in columns.values())
+                count += 1
         
-        if not stats:
+        if not count:
+            os.remove(filename)
             print("Нет данных для экспорта.\n")
             return 0
         
-        # Записываем в CSV
-        with open(filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
-            fieldnames = [
-                'Дата',
-                'Сказки',
-                'Новые пользователи',
-                'Команд /start',
-                'Заполнено анкет'
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            writer.writeheader()
-            for stat in reversed(stats):  # Reverse to get oldest first
-                writer.writerow({
-                    'Дата': stat['date'],
-                    'Сказки': stat['stories_count'],
-                    'Новые пользователи': stat['new_users_count'],
-                    'Команд /start': stat['start_command_count'],
-                    'Заполнено анкет': stat['profile_completed_count']
-                })
-        
         print(f"✓ Статистика успешно экспортирована в файл: {filename}")
-        print(f"  Записей: {len(stats)}\n")
+        print(f"  Записей: {count}\n")
         
         return 0
         
@@ -65,4 +92,3 @@ def main():
 
 if __name__ == "__main__":
     sys.exit(main())
-
@@ -0,0 +1 @@
+"""Офлайн нагрузочный тест: фейковые Bot API, OpenAI и DeepSeek + сценарии пользователей."""
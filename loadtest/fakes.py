@@ -0,0 +1,247 @@
+"""Фейковые Bot API, OpenAI и DeepSeek для нагрузочного теста.
+
+Каждый сервис - HTTP-сервер на стандартной библиотеке в отдельном потоке
+с настраиваемой задержкой (логнормальное распределение вокруг медианы)
+и долей ошибок.
+"""
+import itertools
+import json
+import math
+import queue
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+
+class LatencyModel:
+    """Задержка ответа и доля ошибок фейкового сервиса."""
+
+    def __init__(self, median_ms: float, sigma: float = 0.5, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.median_s = median_ms / 1000.0
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        """Случайная задержка в секундах (логнормальная, медиана = median_ms)."""
+        if self.median_s <= 0:
+            return 0.0
+        with self._lock:
+            return self.median_s * math.exp(self.sigma * self._rng.gauss(0.0, 1.0))
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+
+class FakeServer:
+    """HTTP-сервер в отдельном потоке; наследники реализуют handle()."""
+
+    def __init__(self, latency: LatencyModel, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._calls_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                params = server.parse_body(self.headers.get("Content-Type", ""), raw)
+                status, payload = server.handle(self.path, params)
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def parse_body(content_type: str, raw: bytes) -> Dict[str, Any]:
+        if not raw:
+            return {}
+        if "application/json" in content_type:
+            return json.loads(raw)
+        if "application/x-www-form-urlencoded" in content_type:
+            return {key: values[0] for key, values in parse_qs(raw.decode("utf-8")).items()}
+        return {}
+
+    def count(self, name: str):
+        with self._calls_lock:
+            self.calls[name] += 1
+
+    def handle(self, path: str, params: Dict[str, Any]) -> Tuple[int, Any]:
+        raise NotImplementedError
+
+
+class FakeTelegram(FakeServer):
+    """Фейковый Bot API: отдает апдейты из очереди и сообщает о каждом вызове бота."""
+
+    def __init__(self, latency: LatencyModel, on_call: Optional[Callable[[str, Dict[str, Any], float], None]] = None, **kwargs):
+        super().__init__(latency, **kwargs)
+        self.on_call = on_call
+        self.ready = threading.Event()
+        self._updates: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+
+    def push_update(self, update: Dict[str, Any]):
+        update["update_id"] = next(self._update_ids)
+        self._updates.put(update)
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        self.ready.set()
+        timeout = min(float(params.get("timeout") or 0), 10.0)
+        updates = []
+        try:
+            updates.append(self._updates.get(timeout=timeout) if timeout > 0 else self._updates.get_nowait())
+        except queue.Empty:
+            return updates
+        while True:
+            try:
+                updates.append(self._updates.get_nowait())
+            except queue.Empty:
+                return updates
+
+    def handle(self, path: str, params: Dict[str, Any]) -> Tuple[int, Any]:
+        method = path.rstrip("/").rsplit("/", 1)[-1]
+        self.count(method)
+
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }}
+
+        time.sleep(self.latency.delay())
+        if self.latency.should_fail():
+            self.count(f"{method}:429")
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}
+
+        if self.on_call:
+            self.on_call(method, params, time.monotonic())
+
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            message_id = int(params["message_id"]) if method == "editMessageText" else self.next_message_id()
+            return 200, {"ok": True, "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }}
+        return 200, {"ok": True, "result": True}
+
+
+def _chat_completion(content: str, model: str) -> Dict[str, Any]:
+    return {
+        "id": f"chatcmpl-{random.getrandbits(32):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def _last_user_message(params: Dict[str, Any]) -> str:
+    for message in reversed(params.get("messages") or []):
+        if message.get("role") == "user":
+            return str(message.get("content", ""))
+    return ""
+
+
+class FakeOpenAI(FakeServer):
+    """Фейковый OpenAI-совместимый endpoint для AgentRouter (Agent 1 и вопросы для размышлений)."""
+
+    def handle(self, path: str, params: Dict[str, Any]) -> Tuple[int, Any]:
+        time.sleep(self.latency.delay())
+        if self.latency.should_fail():
+            self.count("error")
+            return 500, {"error": {"message": "fake OpenAI error", "type": "server_error"}}
+
+        user_message = _last_user_message(params)
+        if "вопрос" in user_message and "questions" in user_message:
+            self.count("reflection_questions")
+            content = {"questions": ["Что почувствовал герой?", "Как бы ты поступил?", "Чему научился герой?"]}
+        else:
+            self.count("process_message")
+            content = {
+                "should_update_profile": False,
+                "profile_patch": {},
+                "deepseek_user_prompt": f"Напиши сказку по запросу: {user_message[-200:]}",
+            }
+        return 200, _chat_completion(json.dumps(content, ensure_ascii=False), params.get("model", "gpt-4o-mini"))
+
+
+class FakeDeepSeek(FakeServer):
+    """Фейковый DeepSeek: возвращает сказку нужной длины (или JSON для однопроходного режима)."""
+
+    def __init__(self, latency: LatencyModel, story_words: int = 650, **kwargs):
+        super().__init__(latency, **kwargs)
+        self.story_words = story_words
+        self._stories = itertools.count(1)
+
+    def _story(self) -> str:
+        number = next(self._stories)
+        words = " ".join(itertools.islice(itertools.cycle(
+            "Однажды маленький герой решил помочь другу и понял что дружба важнее игрушек".split()
+        ), self.story_words))
+        return f"**Сказка номер {number}**\n\n{words}."
+
+    def handle(self, path: str, params: Dict[str, Any]) -> Tuple[int, Any]:
+        time.sleep(self.latency.delay())
+        if self.latency.should_fail():
+            self.count("error")
+            return 500, {"error": {"message": "fake DeepSeek error"}}
+
+        story = self._story()
+        if (params.get("response_format") or {}).get("type") == "json_object":
+            self.count("single_hop")
+            content = json.dumps({"should_update_profile": False, "profile_patch": {}, "story": story}, ensure_ascii=False)
+        else:
+            self.count("story")
+            content = story
+        return 200, _chat_completion(content, params.get("model", "deepseek-chat"))
@@ -0,0 +1,188 @@
+"""Сценарии пользователей и сбор задержек по этапам.
+
+Драйвер кладет апдейты в фейковый Bot API и ждет нужного ответа бота
+в чате пользователя. Задержка этапа - время от публикации апдейта до
+вызова Bot API, которым бот завершил этап (например, сообщение с
+клавиатурой после сказки).
+"""
+import asyncio
+import itertools
+import json
+import math
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .fakes import FakeTelegram
+
+BotCall = Tuple[str, Dict[str, Any], float]
+Predicate = Callable[[str, Dict[str, Any]], bool]
+
+STORY_STAGES = ("first_story", "free_text_story", "button_story")
+
+
+def _text(params: Dict[str, Any]) -> str:
+    return str(params.get("text") or "")
+
+
+def text_contains(fragment: str) -> Predicate:
+    def predicate(method: str, params: Dict[str, Any]) -> bool:
+        return method in ("sendMessage", "editMessageText") and fragment in _text(params)
+    return predicate
+
+
+def story_keyboard(method: str, params: Dict[str, Any]) -> bool:
+    """Клавиатура вариантов следующей сказки - признак завершенной доставки."""
+    markup = params.get("reply_markup") or ""
+    if not isinstance(markup, str):
+        markup = json.dumps(markup)
+    return method in ("sendMessage", "editMessageText") and "story_random_moral" in markup
+
+
+def is_failure(method: str, params: Dict[str, Any]) -> bool:
+    text = _text(params)
+    return method in ("sendMessage", "editMessageText") and text.startswith(("❌", "⏳", "⏹"))
+
+
+@dataclass
+class StageResult:
+    stage: str
+    latency: Optional[float]
+    outcome: str  # ok | error | timeout
+
+
+@dataclass
+class Recorder:
+    """Принимает вызовы Bot API из потока фейкового сервера и раскладывает их по чатам."""
+    loop: asyncio.AbstractEventLoop
+    queues: Dict[int, "asyncio.Queue[BotCall]"] = field(default_factory=lambda: defaultdict(asyncio.Queue))
+    results: List[StageResult] = field(default_factory=list)
+
+    def on_call(self, method: str, params: Dict[str, Any], at: float):
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return
+        self.loop.call_soon_threadsafe(self.queues[int(chat_id)].put_nowait, (method, params, at))
+
+    def drain(self, chat_id: int):
+        calls = self.queues[chat_id]
+        while not calls.empty():
+            calls.get_nowait()
+
+
+class UserJourney:
+    """Путь одного пользователя: онбординг, первая сказка, сказка по тексту, по кнопке, вопросы."""
+
+    _message_ids = itertools.count(1)
+
+    def __init__(self, user_id: int, telegram: FakeTelegram, recorder: Recorder,
+                 free_text_stories: int = 1, stage_timeout: float = 300.0):
+        self.user_id = user_id
+        self.telegram = telegram
+        self.recorder = recorder
+        self.free_text_stories = free_text_stories
+        self.stage_timeout = stage_timeout
+        self.last_bot_message_id = 0
+
+    def _user(self) -> Dict[str, Any]:
+        return {"id": self.user_id, "is_bot": False, "first_name": f"load{self.user_id}", "username": f"load{self.user_id}"}
+
+    def _chat(self) -> Dict[str, Any]:
+        return {"id": self.user_id, "type": "private", "first_name": f"load{self.user_id}"}
+
+    def message_update(self, text: str) -> Dict[str, Any]:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(),
+            "from": self._user(),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    def callback_update(self, data: str) -> Dict[str, Any]:
+        return {"callback_query": {
+            "id": f"{self.user_id}-{next(self._message_ids)}",
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {
+                "message_id": self.last_bot_message_id or self.telegram.next_message_id(),
+                "date": int(time.time()),
+                "chat": self._chat(),
+                "text": "Выберите вариант",
+            },
+        }}
+
+    async def stage(self, name: str, update: Dict[str, Any], done: Predicate) -> bool:
+        """Отправляет апдейт и ждет ответа бота; возвращает True при успехе этапа."""
+        calls = self.recorder.queues[self.user_id]
+        self.recorder.drain(self.user_id)
+        started = time.monotonic()
+        deadline = started + self.stage_timeout
+        self.telegram.push_update(update)
+
+        while True:
+            try:
+                method, params, at = await asyncio.wait_for(calls.get(), timeout=max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self.recorder.results.append(StageResult(name, None, "timeout"))
+                return False
+            if is_failure(method, params):
+                self.recorder.results.append(StageResult(name, at - started, "error"))
+                return False
+            if done(method, params):
+                if "message_id" in params:
+                    self.last_bot_message_id = int(params["message_id"])
+                self.recorder.results.append(StageResult(name, at - started, "ok"))
+                return True
+
+    async def run(self) -> bool:
+        steps = [
+            ("start", self.message_update("/start"), text_contains("Как зовут")),
+            ("name", self.message_update("Маша"), text_contains("Сколько лет")),
+            ("age", self.message_update("6"), text_contains("чертами характера")),
+            ("traits", self.message_update("добрая, любопытная, иногда упрямится"), text_contains("реальную ситуацию")),
+            ("first_story", self.message_update("нет"), story_keyboard),
+        ]
+        steps += [
+            ("free_text_story", self.message_update(f"Сказка про то, как делиться игрушками ({i + 1})"), story_keyboard)
+            for i in range(self.free_text_stories)
+        ]
+        for name, update, done in steps:
+            if not await self.stage(name, update, done):
+                return False
+
+        if not await self.stage("button_story", self.callback_update("story_random_moral"), story_keyboard):
+            return False
+        return await self.stage("reflection_questions", self.callback_update("story_reflection_questions"), story_keyboard)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль по ближайшему рангу."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(results: List[StageResult]) -> Dict[str, Dict[str, Any]]:
+    """Сводка по этапам: число попыток, ошибки, таймауты и p50/p95/p99 в миллисекундах."""
+    stages: Dict[str, Dict[str, Any]] = {}
+    for result in results:
+        entry = stages.setdefault(result.stage, {"count": 0, "ok": 0, "error": 0, "timeout": 0, "_latencies": []})
+        entry["count"] += 1
+        entry[result.outcome] += 1
+        if result.outcome == "ok":
+            entry["_latencies"].append(result.latency)
+
+    for entry in stages.values():
+        latencies = entry.pop("_latencies")
+        for pct in (50, 95, 99):
+            entry[f"p{pct}_ms"] = round(percentile(latencies, pct) * 1000)
+        entry["max_ms"] = round(max(latencies, default=0.0) * 1000)
+    return stages
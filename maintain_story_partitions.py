@@ -0,0 +1,46 @@
+"""Create upcoming monthly partitions of stories and drop the expired ones.
+
+Run daily by cron (or at least once a month, before the month starts), e.g.:
+    python maintain_story_partitions.py
+    python maintain_story_partitions.py --retention-months 36 --dry-run
+"""
+import sys
+import os
+import argparse
+import logging
+
+# Add the current directory and src to Python path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from src.config import STORIES_RETENTION_MONTHS, STORIES_PARTITIONS_AHEAD
+from src.db.partitions import maintain_story_partitions
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Create and drop story partitions."""
+    parser = argparse.ArgumentParser(description="Обслуживание месячных партиций таблицы stories")
+    parser.add_argument("--retention-months", type=int, default=STORIES_RETENTION_MONTHS,
+                        help="Сколько месяцев хранить сказки (0 - хранить всё)")
+    parser.add_argument("--months-ahead", type=int, default=STORIES_PARTITIONS_AHEAD,
+                        help="На сколько месяцев вперед создавать партиции")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет сделано")
+    args = parser.parse_args()
+
+    try:
+        result = maintain_story_partitions(args.retention_months, args.months_ahead, dry_run=args.dry_run)
+        created, dropped = ("Будут созданы", "Будут удалены") if args.dry_run else ("Созданы", "Удалены")
+        print(f"{created} партиции: {', '.join(result['created']) or 'нет'}")
+        print(f"{dropped} партиции: {', '.join(result['dropped']) or 'нет'}")
+        return 0
+    except Exception as e:
+        logger.error(f"Ошибка обслуживания партиций: {e}", exc_info=True)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+"""Delete users inactive for N days together with their stories and contexts."""
+import sys
+import os
+import argparse
+import logging
+
+# Add the current directory and src to Python path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from src.db.repository import purge_inactive_users
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Purge inactive users in batches."""
+    parser = argparse.ArgumentParser(description="Удаление неактивных пользователей")
+    parser.add_argument("--days", type=int, required=True, help="Сколько дней без активности")
+    parser.add_argument("--batch-size", type=int, default=500, help="Пользователей за одну транзакцию")
+    parser.add_argument("--dry-run", action="store_true", help="Только посчитать, ничего не удалять")
+    args = parser.parse_args()
+    
+    try:
+        count = purge_inactive_users(args.days, batch_size=args.batch_size, dry_run=args.dry_run)
+        if args.dry_run:
+            print(f"Будет удалено пользователей: {count}")
+        else:
+            print(f"Удалено пользователей: {count}")
+        return 0
+    except Exception as e:
+        logger.error(f"Ошибка при удалении неактивных пользователей: {e}", exc_info=True)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
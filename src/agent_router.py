@@ -2,73 +2,40 @@
 import json
 import logging
 import random
-import secrets
-import re
+import threading
 from typing import Dict, Any, Optional, List
-from openai import OpenAI
 
-from config import OPENAI_API_KEY
+from config import OPENAI_API_KEY, OPENAI_BASE_URL
+from story_prompts import MORALS_BY_AGE, build_story_request, get_age_group, get_random_moral_by_age  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
-# Список моралей для разных возрастов
-MORALS_BY_AGE = {
-    "3-5": [
-        "Дружить важнее, чем владеть игрушкой",
-        "Делая добро, ты сам становишься счастливее",
-        "Делиться — не значит терять",
-        "Мама и папа помогают, даже когда запрещают",
-        "Добрые слова делают мир мягче",
-        "Драться — не способ решать проблемы",
-        "Помогать другим — это правильно",
-        "Если ошибся, можно попросить прощения",
-        "Жадность мешает радоваться",
-        "Вежливость открывает сердца",
-    ],
-    "6-8": [
-        "Честность важнее выгоды",
-        "Усилие приводит к результату",
-        "Не суди других по внешности",
-        "Каждый поступок имеет последствия",
-        "Настойчивость помогает достигать цели",
-        "Ошибки — часть обучения",
-        "Хвастовство отталкивает друзей",
-        "Быть справедливым важнее чем быть первым",
-        "Доброта возвращается",
-    ],
-    "9-12": [
-        "Справедливость важнее личной выгоды",
-        "Ответственность — это умение держать слово",
-        "Зависть разрушает, труд развивает",
-        "Каждый человек ценен, даже если он не похож на тебя",
-        "Самоконтроль это сила",
-        "Настоящая дружба проверяется поступками",
-        "Ошибаться не стыдно, стыдно не учиться",
-        "Уважение нужно заслужить делами",
-        "Смелость — это делать правильно, даже когда трудно",
-    ],
-    "13+": [
-        "Честность с собой важнее одобрения окружающих",
-        "Характер формируется в сложных ситуациях",
-        "Популярность не равна уважению",
-        "Успех без совести не делает счастливым",
-        "Выбор — это всегда отказ от чего-то другого",
-        "Сильный человек умеет признавать ошибки",
-        "Не каждый конфликт нужно выигрывать",
-        "Ценности важнее обстоятельств",
-        "Ты отвечаешь не только за свои желания, но и за последствия своих поступков",
-    ],
-}
-
 
 class AgentRouter:
     """Agent 1: анализирует сообщения и формирует промпты для DeepSeek."""
     
     def __init__(self):
-        self.client = OpenAI(
-            api_key=OPENAI_API_KEY,
-            base_url="https://api.proxyapi.ru/openai/v1"
-        )
+        self._client = None
+        self._client_lock = threading.Lock()
+    
+    @property
+    def client(self):
+        """OpenAI-клиент создается при первом обращении: импорт openai - самая долгая часть запуска бота."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    self._client = OpenAI(
+                        api_key=OPENAI_API_KEY,
+                        base_url=OPENAI_BASE_URL,
+                        # Ограничиваем время вызова, чтобы поток пула не зависал после отмены генерации
+                        timeout=60.0
+                    )
+        return self._client
+    
+    def warm_up(self):
+        """Создает клиент заранее (вызывается в фоне после запуска бота)."""
+        return self.client
     
     def process_message(
         self,
@@ -306,32 +273,7 @@ class AgentRouter:
     
     def get_random_moral_by_age(self, age: str) -> str:
         """Получает случайную мораль на основе возраста."""
-        # Определяем возрастную группу
-        age_group = None
-        age_value = self._get_average_age_value(age)
-        
-        if age_value is not None:
-            if age_value <= 5:
-                age_group = "3-5"
-            elif age_value <= 8:
-                age_group = "6-8"
-            elif age_value <= 12:
-                age_group = "9-12"
-            else:
-                age_group = "13+"
-        else:
-            # Если не удалось определить, используем среднюю группу
-            age_group = "6-8"
-        
-        morals = MORALS_BY_AGE.get(age_group, MORALS_BY_AGE["6-8"])
-        
-        # Используем secrets.choice для более надежной случайности
-        # Это гарантирует, что каждый раз будет выбираться действительно случайная мораль
-        selected_moral = secrets.choice(morals)
-        
-        logger.info(f"Выбрана случайная мораль для возрастной группы {age_group} (возраст: {age}): '{selected_moral}' из {len(morals)} вариантов")
-        
-        return selected_moral
+        return get_random_moral_by_age(age)
     
     def process_story_request(
         self,
@@ -341,116 +283,15 @@ class AgentRouter:
     ) -> Dict[str, Any]:
         """
         Обрабатывает специальные запросы на генерацию сказки.
-        
-        request_type может быть:
-        - "new_dilemma": новая дилемма (обновляет context_active)
-        - "random_moral": случайная мораль (не использует context_active)
-        - "previous_moral": прошлая мораль (использует context_active)
-        - "add_traits": дополнить характер (обновляет traits)
-        - "regular": обычный запрос сказки
-        
-        Возвращает:
-        {
-            "request_type": str,
-            "deepseek_user_prompt": "string"
-        }
+        Промпт формируется без I/O, см. story_prompts.build_story_request.
         """
-        try:
-            age = user_profile.get('age', '') if user_profile else ''
-            
-            if request_type == "new_dilemma":
-                # Новая дилемма - формируем промпт на основе новой ситуации
-                prompt = f"Напиши сказку, которая разбирает следующую ситуацию: {user_message}. " \
-                        f"Сказка, которая помогает ребенку понять, как правильно поступать в такой ситуации."
-                logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (new_dilemma) ===\n{prompt}\n{'=' * 50}")
-                return {
-                    "request_type": "new_dilemma",
-                    "deepseek_user_prompt": prompt
-                }
-            
-            elif request_type == "random_moral":
-                # Случайная мораль - генерируем мораль на основе возраста
-                try:
-                    moral = self.get_random_moral_by_age(age)
-                    prompt = f"Напиши сказку, которая передает следующую идею (НЕ пиши мораль текстом, она должна быть понятна из действий героя): {moral}. " \
-                            f"Сказка должна быть интересной и поучительной, но мораль должна быть скрытой, не проговариваться напрямую."
-                    logger.info(f"Сгенерирована случайная мораль для возраста {age}: {moral}")
-                    logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (random_moral) ===\n{prompt}\n{'=' * 50}")
-                    return {
-                        "request_type": "random_moral",
-                        "deepseek_user_prompt": prompt,
-                        "moral": moral  # Возвращаем мораль для сохранения в context_active
-                    }
-                except Exception as e:
-                    logger.error(f"Ошибка при генерации случайной морали для возраста {age}: {e}", exc_info=True)
-                    # Возвращаем дефолтную мораль
-                    default_moral = "Дружба важнее игрушек"
-                    prompt = f"Напиши сказку, которая передает следующую идею (НЕ пиши мораль текстом, она должна быть понятна из действий героя): {default_moral}. " \
-                            f"Сказка должна быть интересной и поучительной, но мораль должна быть скрытой, не проговариваться напрямую."
-                    logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (random_moral, fallback) ===\n{prompt}\n{'=' * 50}")
-                    return {
-                        "request_type": "random_moral",
-                        "deepseek_user_prompt": prompt,
-                        "moral": default_moral  # Возвращаем мораль для сохранения в context_active
-                    }
-            
-            elif request_type == "previous_moral":
-                # Прошлая мораль - используем context_active
-                prompt = f"Напиши сказку, которая разбирает следующую ситуацию: {user_message}. " \
-                        f"Сказка должна помочь ребенку понять, как правильно поступать в такой ситуации, но НЕ пиши мораль текстом - она должна быть понятна из действий и выбора героя."
-                logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (previous_moral) ===\n{prompt}\n{'=' * 50}")
-                return {
-                    "request_type": "previous_moral",
-                    "deepseek_user_prompt": prompt
-                }
-            
-            elif request_type == "add_traits":
-                # Дополнить характер - генерируем сказку с учетом того, что пользователь дополнил
-                if user_message:
-                    prompt = f"Напиши сказку, которая учитывает обновленные черты характера ребенка. " \
-                            f"Пользователь дополнил характер следующим: {user_message}. " \
-                            f"Сказка должна быть интересной и поучительной, но мораль НЕ должна быть написана текстом - она должна быть понятна из действий и выбора героя."
-                else:
-                    prompt = "Напиши сказку, которая учитывает обновленные черты характера ребенка. " \
-                            f"Сказка должна быть интересной и поучительной, но мораль НЕ должна быть написана текстом - она должна быть понятна из действий и выбора героя."
-                logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (add_traits) ===\n{prompt}\n{'=' * 50}")
-                return {
-                    "request_type": "add_traits",
-                    "deepseek_user_prompt": prompt
-                }
-            
-            elif request_type == "wishes":
-                # Пожелания - генерируем сказку с учетом пожеланий пользователя
-                prompt = f"Напиши сказку с учетом следующих пожеланий пользователя: {user_message}. " \
-                        f"Сказка должна быть интересной и поучительной, но мораль НЕ должна быть написана текстом - она должна быть понятна из действий и выбора героя."
-                logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (wishes) ===\n{prompt}\n{'=' * 50}")
-                return {
-                    "request_type": "wishes",
-                    "deepseek_user_prompt": prompt
-                }
-            
-            else:
-                # Обычный запрос
-                prompt = f"Напиши сказку  на основе запроса: {user_message}"
-                logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (regular) ===\n{prompt}\n{'=' * 50}")
-                return {
-                    "request_type": "regular",
-                    "deepseek_user_prompt": prompt
-                }
-                
-        except Exception as e:
-            logger.error(f"Ошибка в process_story_request: {e}")
-            fallback_prompt = f"Напиши сказку ."
-            logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (fallback) ===\n{fallback_prompt}\n{'=' * 50}")
-            return {
-                "request_type": request_type,
-                "deepseek_user_prompt": fallback_prompt
-            }
+        return build_story_request(request_type, user_message, user_profile)
     
     def generate_reflection_questions(
         self,
         story_text: str,
-        user_profile: Optional[Dict[str, Any]] = None
+        user_profile: Optional[Dict[str, Any]] = None,
+        fallback: bool = True
     ) -> List[str]:
         """
         Генерирует 3 вопроса для размышлений на основе последней сказки.
@@ -458,6 +299,7 @@ class AgentRouter:
         Args:
             story_text: Текст последней сказки
             user_profile: Профиль пользователя (для учета возраста)
+            fallback: При ошибке вернуть стандартные вопросы; если False - пустой список
         
         Returns:
             Список из 3 вопросов для размышлений
@@ -532,6 +374,8 @@ class AgentRouter:
             # Валидация: должно быть 3 вопроса
             if not questions or len(questions) != 3:
                 logger.warning(f"Получено {len(questions)} вопросов вместо 3, генерирую дефолтные")
+                if not fallback:
+                    return []
                 questions = self._get_default_questions(age_group)
             
             # Ограничиваем длину каждого вопроса
@@ -542,35 +386,21 @@ class AgentRouter:
             
         except json.JSONDecodeError as e:
             logger.error(f"Ошибка парсинга JSON при генерации вопросов: {e}")
+            if not fallback:
+                return []
             age_group = self._get_age_group(user_profile.get('age', '') if user_profile else '')
             return self._get_default_questions(age_group)
         except Exception as e:
             logger.error(f"Ошибка при генерации вопросов для размышлений: {e}", exc_info=True)
+            if not fallback:
+                return []
             age_group = self._get_age_group(user_profile.get('age', '') if user_profile else '')
             return self._get_default_questions(age_group)
 
     
     def _get_age_group(self, age: str) -> str:
         """Определяет возрастную группу на основе возраста."""
-        age_value = self._get_average_age_value(age)
-        if age_value is None:
-            return "6-8"  # Дефолтная группа
-        
-        if age_value <= 5:
-            return "3-5"
-        elif age_value <= 8:
-            return "6-8"
-        elif age_value <= 12:
-            return "9-12"
-        else:
-            return "13+"
-    
-    def _get_average_age_value(self, age: str) -> Optional[float]:
-        """Возвращает средний возраст, если указано несколько чисел."""
-        age_numbers = [int(n) for n in re.findall(r"\d+", str(age))]
-        if not age_numbers:
-            return None
-        return sum(age_numbers) / len(age_numbers)
+        return get_age_group(age)
     
     def _get_age_specific_instructions(self, age_group: str) -> str:
         """Возвращает инструкции для генерации вопросов в зависимости от возрастной группы."""
@@ -640,6 +470,11 @@ class AgentRouter:
 - Что случилось, когда герой не поделился?"""
 
     
+    def get_default_reflection_questions(self, user_profile: Optional[Dict[str, Any]] = None) -> List[str]:
+        """Стандартные вопросы для размышлений с учетом возраста из профиля."""
+        age = user_profile.get('age', '') if user_profile else ''
+        return self._get_default_questions(self._get_age_group(age))
+    
     def _get_default_questions(self, age_group: str) -> List[str]:
         """Возвращает дефолтные вопросы в зависимости от возрастной группы."""
         defaults = {
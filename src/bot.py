@@ -1,9 +1,12 @@
 """Основной файл Telegram-бота 'Сказочник'."""
+import html
 import logging
 import asyncio
 import random
+import time
+from collections.abc import Mapping
 from contextlib import asynccontextmanager
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode, ChatAction
@@ -18,19 +21,49 @@ from telegram.ext import (
     ContextTypes
 )
 
-from config import TELEGRAM_BOT_TOKEN, ANTIFLOOD_SECONDS, DAILY_STORY_LIMIT
-from db.repository import (
-    get_user,
-    upsert_user_profile,
-    update_user_fields,
-    save_story,
-    delete_user_profile,
-    get_last_stories,
-    increment_daily_stat,
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_API_BASE_URL,
+    ANTIFLOOD_SECONDS,
+    DAILY_STORY_LIMIT,
+    COMPACT_DELIVERY,
+    STORY_CACHE_POLICY,
+    STORY_CACHE_TTL_MINUTES,
+    STORY_CACHE_MAX_SIZE,
+    EXECUTOR_DB_WORKERS,
+    EXECUTOR_LLM_WORKERS,
+    EXECUTOR_CPU_WORKERS,
+    GENERATION_TIMEOUT_SECONDS,
+    TELEGRAM_RATE_LIMIT_PER_SECOND,
+    TYPING_INTERVAL_SECONDS,
+    REFLECTION_PREFETCH,
+    SINGLE_HOP_GENERATION,
+    DB_STATEMENTS_PER_UPDATE_WARN,
+    SCHEMA_CHECK,
+    STORAGE_BACKEND,
+    SHEETS_EXPORT,
+    GOOGLE_SHEETS_CREDENTIALS_PATH,
+    SPREADSHEET_ID,
+    SHEETS_EXPORT_BATCH_SIZE,
+    SHEETS_EXPORT_INTERVAL_SECONDS,
 )
+from db.session import query_scope, query_stats
+from db.schema import check_schema, SchemaOutOfDateError
+from storage import create_storage
 from agent_router import AgentRouter
-from deepseek_client import DeepSeekClient
-from utils import AntifloodManager, ProfileCache, split_message
+from story_prompts import build_story_request, build_deepseek_prompt, build_single_hop_prompt
+from executors import ExecutorRegistry
+from outbound import OutboundRateBudget, TypingTicker
+from deepseek_client import DeepSeekClient, DeepSeekRequestError
+from utils import (
+    AntifloodManager,
+    ProfileCache,
+    StoryCache,
+    markdown_to_html,
+    split_message,
+    utf16_len,
+    TELEGRAM_MAX_MESSAGE_LENGTH,
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -50,46 +83,130 @@ ASKING_WISHES, ASKING_WISHES_EDIT = range(6, 8)
 
 
 # Инициализация компонентов
+storage = create_storage(STORAGE_BACKEND)
+sheets_exporter = None
+if SHEETS_EXPORT:
+    # Копия профилей и сказок в Google Sheets выгружается пачками в фоне
+    from sheets import SheetsExporter, ExportingStorage
+    sheets_exporter = SheetsExporter(
+        SPREADSHEET_ID,
+        GOOGLE_SHEETS_CREDENTIALS_PATH,
+        batch_size=SHEETS_EXPORT_BATCH_SIZE,
+        flush_interval=SHEETS_EXPORT_INTERVAL_SECONDS
+    )
+    storage = ExportingStorage(storage, sheets_exporter)
 agent_router = AgentRouter()
 deepseek_client = DeepSeekClient()
 antiflood = AntifloodManager(cooldown_seconds=ANTIFLOOD_SECONDS, daily_limit=DAILY_STORY_LIMIT)
+story_cache = StoryCache(
+    policy=STORY_CACHE_POLICY,
+    ttl_minutes=STORY_CACHE_TTL_MINUTES,
+    max_size=STORY_CACHE_MAX_SIZE
+)
+
+
+executors = ExecutorRegistry({
+    "db": EXECUTOR_DB_WORKERS,
+    "llm": EXECUTOR_LLM_WORKERS,
+    "cpu": EXECUTOR_CPU_WORKERS,
+})
+
+
+async def run_blocking(func, *args, workload: str = "db", **kwargs):
+    """Запускает блокирующую функцию в пуле потоков для данного типа нагрузки ("db", "llm", "cpu")."""
+    return await executors.run(workload, func, *args, **kwargs)
+
+
+def elapsed_ms(started: float) -> int:
+    """Миллисекунды, прошедшие с момента time.perf_counter() = started."""
+    return int((time.perf_counter() - started) * 1000)
 
 
-async def run_blocking(func, *args, **kwargs):
-    """Запускает блокирующую функцию в отдельном потоке."""
-    return await asyncio.to_thread(func, *args, **kwargs)
 profile_cache = ProfileCache()
 
 
+# Все исходящие запросы к Bot API идут через общий бюджет,
+# статусы 'Typing' для всех чатов отправляет один тикер
+outbound_budget = OutboundRateBudget(max_per_second=TELEGRAM_RATE_LIMIT_PER_SECOND)
+typing_ticker = TypingTicker(outbound_budget, interval=TYPING_INTERVAL_SECONDS)
+
+
 @asynccontextmanager
-async def typing_indicator(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None, interval: float = 4.0):
-    """Периодически отправляет статус 'Typing' пока выполняется долгий этап."""
-    if not chat_id:
+async def typing_indicator(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None):
+    """Показывает статус 'Typing' пока выполняется долгий этап (через общий тикер)."""
+    async with typing_ticker.track(context.bot, chat_id):
         yield
-        return
+
+
+# Фоновые генерации вопросов для размышлений по id сказки
+reflection_tasks: Dict[int, asyncio.Task] = {}
+
+
+async def generate_reflection_questions_for_story(story_id: int, story_text: str, profile: Dict) -> list:
+    """Генерирует вопросы для размышлений и сохраняет их вместе со сказкой.
     
-    stop_event = asyncio.Event()
+    Возвращает пустой список, если сгенерировать вопросы не удалось.
+    """
+    try:
+        questions = await run_blocking(
+            agent_router.generate_reflection_questions,
+            story_text,
+            profile,
+            fallback=False,
+            workload="llm"
+        )
+        if questions:
+            await run_blocking(storage.set_story_reflection_questions, story_id, questions)
+        return questions
+    except Exception as e:
+        logger.error(f"Ошибка генерации вопросов для сказки {story_id}: {e}", exc_info=True)
+        return []
+
+
+def prefetch_reflection_questions(story_id: int, story_text: str, profile: Dict):
+    """Запускает генерацию вопросов для размышлений в фоне, пока пользователь читает сказку."""
+    task = asyncio.create_task(generate_reflection_questions_for_story(story_id, story_text, profile))
+    reflection_tasks[story_id] = task
+    task.add_done_callback(lambda _: reflection_tasks.pop(story_id, None))
+
+
+# Текущие отменяемые генерации по пользователям: новый запрос отменяет старый
+generation_tasks: Dict[int, asyncio.Task] = {}
+
+async def cancel_generation(user_id: int, timeout: float = 5.0) -> bool:
+    """Отменяет текущую генерацию пользователя и дожидается ее завершения.
     
-    async def _send_typing():
-        while not stop_event.is_set():
-            try:
-                await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            except Exception as e:
-                logger.debug(f"Не удалось отправить typing: {e}")
-            try:
-                await asyncio.wait_for(stop_event.wait(), timeout=interval)
-            except asyncio.TimeoutError:
-                continue
+    Возвращает True, если генерация была отменена.
+    """
+    task = generation_tasks.get(user_id)
+    if task is None or task.done():
+        return False
+    logger.info(f"Отменяю текущую генерацию для пользователя {user_id}")
+    task.cancel()
+    # asyncio.wait не пробрасывает CancelledError отмененной задачи
+    await asyncio.wait({task}, timeout=timeout)
+    return True
+
+
+async def start_replacing_generation(user_id: int, source: str) -> Tuple[bool, Optional[str]]:
+    """Допускает генерацию, которая заменяет собой идущую, и только после этого отменяет идущую.
     
-    task = asyncio.create_task(_send_typing())
-    try:
-        yield
-    finally:
-        stop_event.set()
-        try:
-            await task
-        except Exception as e:
-            logger.debug(f"Ошибка при остановке typing: {e}")
+    Допуск проверяется до отмены (идущая генерация считается учтенной с момента своего начала),
+    поэтому при отказе идущая генерация продолжается и пользователь получит ее сказку.
+    Возвращает (допущена_ли, сообщение_если_нет); при допуске слот генерации уже занят.
+    """
+    allowed, refusal_message = antiflood.check_replacement(user_id, source)
+    if not allowed:
+        return False, refusal_message
+    await cancel_generation(user_id)
+    return antiflood.try_start_generation(user_id, source)
+
+
+def detach_generation(user_id: int):
+    """Снимает генерацию с учета отмены (сказка готова, идет сохранение и доставка)."""
+    task = generation_tasks.get(user_id)
+    if task is asyncio.current_task():
+        generation_tasks.pop(user_id, None)
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -101,16 +218,15 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Собираем статистику: команда /start
     try:
-        await run_blocking(increment_daily_stat, 'start_command')
+        await run_blocking(storage.increment_daily_stat, 'start_command')
     except Exception as e:
         logger.warning(f"Ошибка сбора статистики /start: {e}")
     
     # Очищаем любые предыдущие состояния
     context.user_data.clear()
     
-    # Проверяем, есть ли уже профиль
-    profile = get_user(user_id)
-    if profile:
+    # Проверяем, есть ли уже профиль (без загрузки самого профиля)
+    if await run_blocking(storage.user_exists, user_id):
         # Профиль уже есть, просто приветствуем
         await update.message.reply_text(
             "👋 С возвращением! Я готов написать для вас новую сказку.\n\n"
@@ -164,14 +280,13 @@ async def handle_traits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name or ""
     
     # Проверяем, новый ли это пользователь
-    existing_profile = await run_blocking(get_user, user_id)
-    is_new_user = existing_profile is None
+    is_new_user = not await run_blocking(storage.user_exists, user_id)
     
     # Сохраняем профиль
     child_names = context.user_data.get('child_names', '')
     age = context.user_data.get('age', '')
     
-    success = await run_blocking(upsert_user_profile,
+    success = await run_blocking(storage.upsert_user_profile,
         telegram_id=user_id,
         username=username,
         child_names=child_names,
@@ -188,7 +303,7 @@ async def handle_traits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Если это новый пользователь, собираем статистику
     if is_new_user:
         try:
-            await run_blocking(increment_daily_stat, 'new_users')
+            await run_blocking(storage.increment_daily_stat, 'new_users')
         except Exception as e:
             logger.warning(f"Ошибка сбора статистики новых пользователей: {e}")
     
@@ -213,7 +328,7 @@ async def handle_situation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Собираем статистику: анкета заполнена (пользователь ответил на все 3 основных вопроса + этот)
     try:
-        await run_blocking(increment_daily_stat, 'profile_completed')
+        await run_blocking(storage.increment_daily_stat, 'profile_completed')
     except Exception as e:
         logger.warning(f"Ошибка сбора статистики заполненных анкет: {e}")
     
@@ -233,14 +348,8 @@ async def handle_situation(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     else:
         # Сохраняем ситуацию в context_active
-        success = await run_blocking(update_user_fields, user_id, context_active=answer)
-        if success:
-            # Инвалидируем кэш
-            profile_cache.invalidate(user_id)
-            updated_profile = await run_blocking(get_user, user_id)
-            if updated_profile:
-                profile_cache.set(user_id, updated_profile)
-            
+        updated_profile, _ = await patch_profile(user_id, context_active=answer)
+        if updated_profile:
             await update.message.reply_text(
                 "Отлично! Учту эту ситуацию в сказке. Сейчас напишу для вас первую сказку с разбором этой ситуации."
             )
@@ -276,14 +385,16 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def reset_profile_flow(user_id: int, context: ContextTypes.DEFAULT_TYPE, reply_fn):
     """Общий сброс профиля для команды и кнопки меню."""
-    profile = get_user(user_id)
-    if not profile:
+    if not await run_blocking(storage.user_exists, user_id):
         await reply_fn(
             "У вас нет сохраненного профиля. Используйте /start для регистрации."
         )
         return False
     
-    success = delete_user_profile(user_id)
+    # Сброс профиля отменяет еще идущую генерацию сказки
+    await cancel_generation(user_id)
+    
+    success = await run_blocking(storage.delete_user_profile, user_id)
     
     if success:
         profile_cache.invalidate(user_id)
@@ -315,7 +426,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Проверяем наличие профиля
     profile = profile_cache.get(user_id)
     if not profile:
-        profile = get_user(user_id)
+        profile = await run_blocking(storage.get_user, user_id)
         if profile:
             profile_cache.set(user_id, profile)
         else:
@@ -325,62 +436,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     
-    # Проверяем антифлуд
-    can_gen, message = antiflood.can_generate(user_id)
-    if not can_gen:
-        await update.message.reply_text(message)
-        return
-    
-    # Начинаем генерацию
-    antiflood.start_generation(user_id)
-    
-    try:
-        await generate_and_send_story(update, context, user_message)
-    finally:
-        antiflood.finish_generation(user_id)
-
-
-def markdown_to_html(text: str) -> str:
-    """
-    Преобразует markdown разметку в HTML для Telegram.
-    
-    Преобразует:
-    - **текст** → <b>текст</b> (жирный) - только первое вхождение (название)
-    - *текст* → <i>текст</i> (курсив)
-    - __текст__ → <u>текст</u> (подчеркнутый)
-    
-    Args:
-        text: Текст с markdown разметкой
-        
-    Returns:
-        Текст с HTML разметкой
-    """
-    import re
-    
-    # Находим первое вхождение **текст** (название сказки)
-    # Преобразуем только его в <b>текст</b>
-    # Все остальные **текст** удаляем (убираем звездочки, оставляем текст)
-    first_bold_match = re.search(r'\*\*(.+?)\*\*', text)
-    if first_bold_match:
-        # Заменяем первое вхождение на HTML
-        title_text = first_bold_match.group(1)
-        title_html = f'<b>{title_text}</b>'
-        text = text[:first_bold_match.start()] + title_html + text[first_bold_match.end():]
-        
-        # Удаляем все остальные **текст** (убираем звездочки)
-        text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
-    else:
-        # Если нет жирного текста, просто продолжаем
-        pass
-    
-    # Преобразуем __текст__ в <u>текст</u> (подчеркнутый)
-    text = re.sub(r'__(.+?)__', r'<u>\1</u>', text)
-    
-    # Преобразуем *текст* в <i>текст</i> (курсив), но только если это не часть **
-    # Используем негативный просмотр, чтобы не конфликтовать с **
-    text = re.sub(r'(?<!\*)\*([^*]+?)\*(?!\*)', r'<i>\1</i>', text)
-    
-    return text
+    # Допуск (антифлуд, суточный лимит) выполняется в generate_and_send_story до вызова Agent 1
+    await generate_and_send_story(update, context, user_message)
 
 
 def create_story_options_keyboard() -> InlineKeyboardMarkup:
@@ -424,6 +481,107 @@ async def show_story_options(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.callback_query.message.reply_text(text, reply_markup=create_story_options_keyboard())
 
 
+async def deliver_story_compact(
+    message_target,
+    story_text_html: str,
+    moral_text: str = "",
+    status_msg=None
+):
+    """
+    Отправляет сказку минимальным числом вызовов Bot API.
+    
+    Статус-сообщение редактируется в первую часть сказки (вместо удаления),
+    мораль дописывается в последнюю часть, если помещается по длине,
+    а клавиатура выбора следующей сказки прикрепляется к последнему сообщению.
+    
+    Args:
+        message_target: Сообщение, на которое отвечаем
+        story_text_html: Текст сказки в HTML
+        moral_text: Текст морали (для случайной морали), может быть пустым
+        status_msg: Опциональное статус-сообщение "Пишу сказку..."
+    """
+    messages = await run_blocking(split_message, story_text_html, workload="cpu")
+    
+    if moral_text:
+        moral_html = f'Мораль: "{html.escape(moral_text, quote=False)}"'
+        folded = f"{messages[-1]}\n\n{moral_html}"
+        if utf16_len(folded) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            messages[-1] = folded
+        else:
+            messages.append(moral_html)
+    
+    last_index = len(messages) - 1
+    for i, text in enumerate(messages):
+        reply_markup = create_story_options_keyboard() if i == last_index else None
+        
+        if i == 0 and status_msg:
+            try:
+                await status_msg.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+                continue
+            except BadRequest as e:
+                # Статус-сообщение могло быть удалено или устарело - отправляем новое
+                logger.warning(f"Не удалось отредактировать статус-сообщение в сказку: {e}")
+                try:
+                    await status_msg.delete()
+                except Exception as delete_error:
+                    logger.warning(f"Не удалось удалить статус-сообщение: {delete_error}")
+        
+        await message_target.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+async def send_story(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    message_target,
+    story_text: str,
+    moral_text: str = "",
+    status_msg=None
+):
+    """Отрисовывает сказку в HTML и отправляет ее вместе с кнопками выбора следующей сказки."""
+    # Разметка и разбиение длинной сказки - чистый CPU: выполняются в пуле "cpu", не блокируя цикл событий
+    story_text_html = await run_blocking(markdown_to_html, story_text, workload="cpu")
+    
+    if COMPACT_DELIVERY:
+        await deliver_story_compact(message_target, story_text_html, moral_text, status_msg)
+        return
+    
+    # Удаляем статус-сообщение, если оно было передано (перед отправкой сказки)
+    if status_msg:
+        try:
+            await status_msg.delete()
+        except Exception as e:
+            logger.warning(f"Не удалось удалить статус-сообщение: {e}")
+    
+    # Отправляем сказку частями, если она длинная
+    for chunk in await run_blocking(split_message, story_text_html, workload="cpu"):
+        await message_target.reply_text(chunk, parse_mode=ParseMode.HTML)
+    
+    if moral_text:
+        await message_target.reply_text(f'Мораль: "{moral_text}"')
+    
+    # Показываем кнопки выбора для следующей сказки
+    await show_story_options(update, context)
+
+
+def create_resend_keyboard(story_id: int) -> InlineKeyboardMarkup:
+    """Создает клавиатуру с кнопкой повторной отправки сохраненной сказки."""
+    keyboard = [
+        [InlineKeyboardButton("🔁 Отправить сказку ещё раз", callback_data=f"story_resend:{story_id}")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def report_delivery_failure(message_target, story_id: int, text: str = None):
+    """Сообщает об ошибке отправки сохраненной сказки и предлагает отправить ее повторно."""
+    try:
+        await message_target.reply_text(
+            text or "❌ Не удалось отправить сказку, но она сохранена. Нажмите кнопку, чтобы получить её.",
+            reply_markup=create_resend_keyboard(story_id)
+        )
+    except Exception as e:
+        logger.error(f"Не удалось сообщить об ошибке отправки сказки {story_id}: {e}", exc_info=True)
+
+
 async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback для кнопок выбора сказки."""
     query = update.callback_query
@@ -448,7 +606,7 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
     # Проверяем наличие профиля
     profile = profile_cache.get(user_id)
     if not profile:
-        profile = get_user(user_id)
+        profile = await run_blocking(storage.get_user, user_id)
         if profile:
             profile_cache.set(user_id, profile)
         else:
@@ -457,8 +615,8 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
             )
             return
     
-    # Дополнительная проверка: убеждаемся, что profile - это словарь
-    if not isinstance(profile, dict):
+    # Дополнительная проверка: убеждаемся, что profile читается как словарь
+    if not isinstance(profile, Mapping):
         logger.error(f"Профиль имеет неверный тип для пользователя {user_id}: {type(profile)}")
         await query.message.reply_text(
             "Произошла ошибка при загрузке профиля. Используйте /start для повторной регистрации."
@@ -469,25 +627,35 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
     if callback_data == "story_reflection_questions":
         # Вопросы для размышлений - получаем последнюю сказку и генерируем вопросы
         try:
-            # Получаем последнюю сказку
-            last_stories = get_last_stories(user_id, limit=1)
-            if not last_stories:
+            # Вопросы могли быть сгенерированы заранее и сохранены вместе с последней сказкой
+            latest = await run_blocking(storage.get_latest_story_reflection, user_id)
+            if not latest:
                 await query.message.reply_text(
                     "У вас пока нет сохраненных сказок. Сначала сгенерируйте сказку."
                 )
                 return ConversationHandler.END
             
-            last_story_text = last_stories[0]['text']
+            story_id = latest['id']
+            questions = latest['reflection_questions']
+            if not questions and story_id in reflection_tasks:
+                # Вопросы еще генерируются в фоне - дожидаемся их вместо второго запроса к LLM
+                questions = await asyncio.shield(reflection_tasks[story_id])
             
-            # Генерируем вопросы через роутер
-            await query.message.reply_text("💭 Формирую вопросы для размышлений...")
-            chat_id = update.effective_chat.id if update.effective_chat else None
-            async with typing_indicator(context, chat_id):
-                questions = await run_blocking(
-                    agent_router.generate_reflection_questions,
-                    last_story_text,
-                    profile
-                )
+            if not questions:
+                story = await run_blocking(storage.get_story, user_id, story_id)
+                if not story:
+                    await query.message.reply_text(
+                        "У вас пока нет сохраненных сказок. Сначала сгенерируйте сказку."
+                    )
+                    return ConversationHandler.END
+                
+                # Генерируем вопросы через роутер и сохраняем их для повторных нажатий
+                await query.message.reply_text("💭 Формирую вопросы для размышлений...")
+                chat_id = update.effective_chat.id if update.effective_chat else None
+                async with typing_indicator(context, chat_id):
+                    questions = await generate_reflection_questions_for_story(story_id, story['text'], profile)
+                if not questions:
+                    questions = agent_router.get_default_reflection_questions(profile)
             
             # Формируем сообщение с вопросами
             message_text = "<b>Для развития у ребенка рефлексии и закрепления морали из предыдущей сказки рекомендуется задать чаду вопросы:</b>\n\n"
@@ -521,14 +689,12 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif callback_data == "story_random_moral":
         # Со случайной моралью - сразу генерируем
-        # Обновляем профиль из БД перед генерацией, чтобы получить актуальные данные
-        profile_cache.invalidate(user_id)
-        fresh_profile = get_user(user_id)
+        # Перед генерацией читаем из БД актуальные поля, нужные для промпта
+        fresh_profile = await run_blocking(storage.get_generation_profile, user_id)
         if fresh_profile:
-            profile_cache.set(user_id, fresh_profile)
             profile = fresh_profile
-        await query.message.reply_text("✒️ Пишу сказку со случайной моралью...")
-        await generate_story_with_random_moral(update, context, user_id, profile)
+        status_msg = await query.message.reply_text("✒️ Пишу сказку со случайной моралью...")
+        await generate_story_with_random_moral(update, context, user_id, profile, status_msg)
         return ConversationHandler.END
     
     elif callback_data == "story_previous_moral":
@@ -541,8 +707,8 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
             await show_story_options(update, context)
             return ConversationHandler.END
         
-        await query.message.reply_text("✒️ Пишу сказку с прошлой моралью...")
-        await generate_story_with_previous_moral(update, context, user_id, profile, context_active)
+        status_msg = await query.message.reply_text("✒️ Пишу сказку с прошлой моралью...")
+        await generate_story_with_previous_moral(update, context, user_id, profile, context_active, status_msg)
         return ConversationHandler.END
     
     elif callback_data == "menu":
@@ -612,9 +778,8 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif callback_data == "traits_delete":
         # Удалить характер
-        success = update_user_fields(user_id, traits='')
-        if success:
-            profile_cache.invalidate(user_id)
+        updated_profile, _ = await patch_profile(user_id, traits='')
+        if updated_profile:
             await query.message.reply_text("✅ Характер удален.")
             # Показываем первое меню
             await show_story_options(update, context)
@@ -672,9 +837,8 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif callback_data == "wishes_delete":
         # Удалить пожелания
-        success = update_user_fields(user_id, wishes='')
-        if success:
-            profile_cache.invalidate(user_id)
+        updated_profile, _ = await patch_profile(user_id, wishes='')
+        if updated_profile:
             await query.message.reply_text("✅ Пожелания удалены.")
             # Показываем первое меню
             await show_story_options(update, context)
@@ -752,6 +916,37 @@ async def handle_story_callback(update: Update, context: ContextTypes.DEFAULT_TY
         
         return ConversationHandler.END
     
+    elif callback_data.startswith("story_resend:"):
+        # Повторная отправка сохраненной сказки (без новой генерации)
+        try:
+            story_id = int(callback_data.split(":", 1)[1])
+        except ValueError:
+            logger.warning(f"Некорректный callback_data: {callback_data} для пользователя {user_id}")
+            return ConversationHandler.END
+        
+        story = await run_blocking(storage.get_story, user_id, story_id)
+        if not story:
+            await query.message.reply_text(
+                "Эта сказка больше недоступна. Выберите, какую сказку написать дальше."
+            )
+            await show_story_options(update, context)
+            return ConversationHandler.END
+        
+        try:
+            await send_story(update, context, query.message, story['text'])
+        except Exception as e:
+            logger.error(f"Повторная отправка сказки {story_id} пользователю {user_id} не удалась: {e}", exc_info=True)
+            await report_delivery_failure(
+                query.message,
+                story_id,
+                "❌ Снова не удалось отправить сказку. Попробуйте ещё раз чуть позже."
+            )
+            return ConversationHandler.END
+        
+        await run_blocking(storage.set_story_delivery_status, story_id, 'delivered')
+        logger.info(f"Сказка {story_id} повторно отправлена пользователю {user_id}")
+        return ConversationHandler.END
+    
     logger.warning(f"Неизвестный callback_data: {callback_data} для пользователя {user_id}")
     return ConversationHandler.END
 
@@ -761,23 +956,9 @@ async def handle_new_dilemma(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     dilemma = update.message.text.strip()
     
-    # Обновляем context_active в БД
-    success = update_user_fields(user_id, context_active=dilemma)
-    if not success:
-        await update.message.reply_text(
-            "Произошла ошибка при сохранении. Попробуйте позже."
-        )
-        return ConversationHandler.END
-    
-    # Инвалидируем кэш
-    profile_cache.invalidate(user_id)
-    updated_profile = get_user(user_id)
-    if updated_profile:
-        profile_cache.set(user_id, updated_profile)
-    
-    # Генерируем сказку с новой дилеммой
-    await update.message.reply_text("✒️ Пишу сказку с новой дилеммой...")
-    await generate_story_with_new_dilemma(update, context, user_id, updated_profile, dilemma)
+    # Генерируем сказку с новой дилеммой (context_active сохраняется после допуска)
+    status_msg = await update.message.reply_text("✒️ Пишу сказку с новой дилеммой...")
+    await generate_story_with_new_dilemma(update, context, user_id, dilemma, status_msg)
     
     return ConversationHandler.END
 
@@ -790,19 +971,13 @@ async def handle_wishes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     wishes = update.message.text.strip()
     
     # Сохраняем пожелания в БД
-    success = update_user_fields(user_id, wishes=wishes)
-    if not success:
+    updated_profile, _ = await patch_profile(user_id, wishes=wishes)
+    if not updated_profile:
         await update.message.reply_text(
             "Произошла ошибка при сохранении пожеланий. Попробуйте позже."
         )
         return ConversationHandler.END
     
-    # Инвалидируем кэш
-    profile_cache.invalidate(user_id)
-    updated_profile = get_user(user_id)
-    if updated_profile:
-        profile_cache.set(user_id, updated_profile)
-    
     # Сообщаем об успешном сохранении
     await update.message.reply_text("✅ Пожелания сохранены!")
     
@@ -820,32 +995,36 @@ async def handle_wishes_edit(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Получаем текущие пожелания
     profile = profile_cache.get(user_id)
     if not profile:
-        profile = get_user(user_id)
+        profile = await run_blocking(storage.get_user, user_id)
         if profile:
             profile_cache.set(user_id, profile)
     
-    current_wishes = profile.get('wishes', '').strip() if profile.get('wishes') else ''
-    
-    # Объединяем текущие и новые пожелания
-    if current_wishes:
-        updated_wishes = f"{current_wishes}\n{new_wishes_text}"
-    else:
-        updated_wishes = new_wishes_text
+    # Дописываем к той версии пожеланий, которую прочитали; если профиль успели
+    # изменить параллельно, повторяем объединение с актуальной версией
+    updated_profile = None
+    for _ in range(2):
+        if not profile:
+            break
+        current_wishes = profile.get('wishes', '').strip() if profile.get('wishes') else ''
+        
+        # Объединяем текущие и новые пожелания
+        if current_wishes:
+            updated_wishes = f"{current_wishes}\n{new_wishes_text}"
+        else:
+            updated_wishes = new_wishes_text
+        
+        updated_profile, conflict = await patch_profile(user_id, profile.get('version'), wishes=updated_wishes)
+        if not conflict:
+            break
+        profile = updated_profile
+        updated_profile = None
     
-    # Сохраняем обновленные пожелания в БД
-    success = update_user_fields(user_id, wishes=updated_wishes)
-    if not success:
+    if not updated_profile:
         await update.message.reply_text(
             "Произошла ошибка при сохранении пожеланий. Попробуйте позже."
         )
         return ConversationHandler.END
     
-    # Инвалидируем кэш
-    profile_cache.invalidate(user_id)
-    updated_profile = get_user(user_id)
-    if updated_profile:
-        profile_cache.set(user_id, updated_profile)
-    
     # Сообщаем об успешном сохранении
     await update.message.reply_text("✅ Пожелания дополнены!")
     
@@ -865,7 +1044,7 @@ async def handle_traits_addition(update: Update, context: ContextTypes.DEFAULT_T
     # Получаем текущий профиль
     profile = profile_cache.get(user_id)
     if not profile:
-        profile = get_user(user_id)
+        profile = await run_blocking(storage.get_user, user_id)
         if profile:
             profile_cache.set(user_id, profile)
     
@@ -889,7 +1068,8 @@ async def handle_traits_addition(update: Update, context: ContextTypes.DEFAULT_T
                 agent_response = await run_blocking(
                     agent_router.process_profile_update,
                     addition_message,
-                    profile
+                    profile,
+                    workload="llm"
                 )
             logger.info(f"Agent 1 обработал запрос на дополнение характера для пользователя {user_id}")
         except Exception as e:
@@ -900,14 +1080,15 @@ async def handle_traits_addition(update: Update, context: ContextTypes.DEFAULT_T
             else:
                 updated_traits = user_message
             
-            success = update_user_fields(user_id, traits=updated_traits)
-            if not success:
+            updated_profile, conflict = await patch_profile(user_id, profile.get('version'), traits=updated_traits)
+            if not updated_profile or conflict:
                 await update.message.reply_text(
+                    "Профиль только что изменился. Попробуйте ещё раз."
+                    if conflict else
                     "Произошла ошибка при сохранении. Попробуйте позже."
                 )
                 return ConversationHandler.END
             
-            profile_cache.invalidate(user_id)
             await update.message.reply_text("✅ Характер успешно дополнен!")
             await show_story_options(update, context)
             return ConversationHandler.END
@@ -916,20 +1097,17 @@ async def handle_traits_addition(update: Update, context: ContextTypes.DEFAULT_T
         if agent_response.get("should_update_profile", False):
             profile_patch = agent_response.get("profile_patch", {})
             if profile_patch and "traits" in profile_patch:
-                # Обновляем traits в БД
-                success = update_user_fields(user_id, traits=profile_patch["traits"])
-                if not success:
+                # Обновляем traits в БД, только если профиль не изменился с момента чтения:
+                # Agent 1 объединял черты именно с этой версией
+                updated_profile, conflict = await patch_profile(user_id, profile.get('version'), traits=profile_patch["traits"])
+                if not updated_profile or conflict:
                     await update.message.reply_text(
+                        "Профиль только что изменился. Попробуйте ещё раз."
+                        if conflict else
                         "Произошла ошибка при сохранении. Попробуйте позже."
                     )
                     return ConversationHandler.END
                 
-                # Инвалидируем кэш и обновляем
-                profile_cache.invalidate(user_id)
-                updated_profile = get_user(user_id)
-                if updated_profile:
-                    profile_cache.set(user_id, updated_profile)
-                
                 # Сообщаем об успешном сохранении
                 await update.message.reply_text("✅ Характер успешно дополнен!")
             else:
@@ -940,14 +1118,13 @@ async def handle_traits_addition(update: Update, context: ContextTypes.DEFAULT_T
             await update.message.reply_text("✅ Запрос обработан.")
     else:
         # Если по какой-то причине action не 'add', просто сохраняем как новый
-        success = update_user_fields(user_id, traits=user_message)
-        if not success:
+        updated_profile, _ = await patch_profile(user_id, traits=user_message)
+        if not updated_profile:
             await update.message.reply_text(
                 "Произошла ошибка при сохранении. Попробуйте позже."
             )
             return ConversationHandler.END
         
-        profile_cache.invalidate(user_id)
         await update.message.reply_text("✅ Характер успешно сохранен!")
     
     # Очищаем временные данные
@@ -964,41 +1141,73 @@ async def generate_story_with_new_dilemma(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     user_id: int,
-    profile: Dict,
-    dilemma: str
+    dilemma: str,
+    status_msg = None
 ):
-    """Генерирует сказку с новой дилеммой."""
+    """Генерирует сказку с новой дилеммой.
+    
+    Дилемма сохраняется в context_active только после допуска: отказ антифлуда
+    или суточного лимита не меняет профиль.
+    """
+    message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
+    # Новая сказка заменяет еще идущую генерацию (включая запрос к DeepSeek), если будет допущена
+    admitted, refusal_message = await start_replacing_generation(user_id, "new_dilemma")
+    if not admitted:
+        await reply_or_edit_status(message_target, status_msg, refusal_message)
+        return
+    # Пока слот не передан в generate_and_send_story_internal, освобождаем его здесь
+    handed_off = False
+    
     chat_id = update.effective_chat.id if update.effective_chat else None
     async with typing_indicator(context, chat_id):
         try:
-            # Используем агент-роутер для формирования промпта
-            agent_response = await run_blocking(
-                agent_router.process_story_request,
+            # Обновляем context_active в БД
+            profile, _ = await patch_profile(user_id, context_active=dilemma)
+            if not profile:
+                await reply_or_edit_status(message_target, status_msg, "Произошла ошибка при сохранении. Попробуйте позже.")
+                return
+            
+            # Формируем промпт по шаблону (чистая функция, без потока)
+            agent_response = build_story_request(
                 request_type="new_dilemma",
                 user_message=dilemma,
                 user_profile=profile
             )
             
-            await generate_and_send_story_internal(update, context, user_id, profile, agent_response)
+            handed_off = True
+            await generate_and_send_story_internal(update, context, user_id, profile, agent_response, status_msg,
+                                                   admitted=True)
         except Exception as e:
             logger.error(f"Ошибка при генерации сказки с новой дилеммой: {e}", exc_info=True)
-            message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
             if message_target:
                 await message_target.reply_text(
                     "❌ Произошла ошибка при генерации сказки. Попробуйте позже."
                 )
+        finally:
+            if not handed_off:
+                antiflood.abort_generation(user_id)
 
 
 async def generate_story_with_random_moral(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     user_id: int,
-    profile: Dict
+    profile: Dict,
+    status_msg = None
 ):
-    """Генерирует сказку со случайной моралью."""
+    """Генерирует сказку со случайной моралью.
+    
+    Мораль сохраняется в context_active только после допуска (см. generate_story_with_new_dilemma).
+    """
     message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
-    chat_id = update.effective_chat.id if update.effective_chat else None
+    admitted, refusal_message = await start_replacing_generation(user_id, "random_moral")
+    if not admitted:
+        await reply_or_edit_status(message_target, status_msg, refusal_message)
+        return
+    # Пока слот не передан в generate_and_send_story_internal, освобождаем его здесь
+    handed_off = False
     
+    chat_id = update.effective_chat.id if update.effective_chat else None
     async with typing_indicator(context, chat_id):
         try:
             # Проверяем, что profile не None и не пустой
@@ -1010,9 +1219,8 @@ async def generate_story_with_random_moral(
                     )
                 return
             
-            # Используем агент-роутер для формирования промпта
-            agent_response = await run_blocking(
-                agent_router.process_story_request,
+            # Формируем промпт по шаблону (чистая функция, без потока)
+            agent_response = build_story_request(
                 request_type="random_moral",
                 user_message="",
                 user_profile=profile
@@ -1031,29 +1239,27 @@ async def generate_story_with_random_moral(
             if "moral" in agent_response:
                 moral = agent_response["moral"]
                 logger.info(f"Получена мораль для сохранения в context_active для пользователя {user_id}: {moral}")
-                success = update_user_fields(user_id, context_active=moral)
-                if success:
-                    # Инвалидируем кэш и обновляем профиль
-                    profile_cache.invalidate(user_id)
-                    updated_profile = get_user(user_id)
-                    if updated_profile:
-                        profile_cache.set(user_id, updated_profile)
-                        profile = updated_profile
-                        logger.info(f"Сохранена случайная мораль в context_active для пользователя {user_id}: {moral}. Новый context_active: {updated_profile.get('context_active', 'не найден')}")
-                    else:
-                        logger.warning(f"Не удалось получить обновленный профиль для пользователя {user_id}")
+                updated_profile, _ = await patch_profile(user_id, context_active=moral)
+                if updated_profile:
+                    profile = updated_profile
+                    logger.info(f"Сохранена случайная мораль в context_active для пользователя {user_id}: {moral}. Новый context_active: {updated_profile.get('context_active', 'не найден')}")
                 else:
                     logger.warning(f"Не удалось сохранить мораль в context_active для пользователя {user_id}")
             else:
                 logger.error(f"В ответе agent_router отсутствует поле 'moral' для пользователя {user_id}. Ответ: {agent_response}")
             
-            await generate_and_send_story_internal(update, context, user_id, profile, agent_response)
+            handed_off = True
+            await generate_and_send_story_internal(update, context, user_id, profile, agent_response, status_msg,
+                                                   admitted=True)
         except Exception as e:
             logger.error(f"Ошибка при генерации сказки со случайной моралью: {e}", exc_info=True)
             if message_target:
                 await message_target.reply_text(
                     "❌ Произошла ошибка при генерации сказки. Попробуйте позже."
                 )
+        finally:
+            if not handed_off:
+                antiflood.abort_generation(user_id)
 
 
 async def generate_story_with_previous_moral(
@@ -1061,28 +1267,40 @@ async def generate_story_with_previous_moral(
     context: ContextTypes.DEFAULT_TYPE,
     user_id: int,
     profile: Dict,
-    context_active: str
+    context_active: str,
+    status_msg = None
 ):
     """Генерирует сказку с прошлой моралью."""
+    message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
+    admitted, refusal_message = await start_replacing_generation(user_id, "previous_moral")
+    if not admitted:
+        await reply_or_edit_status(message_target, status_msg, refusal_message)
+        return
+    # Пока слот не передан в generate_and_send_story_internal, освобождаем его здесь
+    handed_off = False
+    
     chat_id = update.effective_chat.id if update.effective_chat else None
     async with typing_indicator(context, chat_id):
         try:
-            # Используем агент-роутер для формирования промпта
-            agent_response = await run_blocking(
-                agent_router.process_story_request,
+            # Формируем промпт по шаблону (чистая функция, без потока)
+            agent_response = build_story_request(
                 request_type="previous_moral",
                 user_message=context_active,
                 user_profile=profile
             )
             
-            await generate_and_send_story_internal(update, context, user_id, profile, agent_response)
+            handed_off = True
+            await generate_and_send_story_internal(update, context, user_id, profile, agent_response, status_msg,
+                                                   admitted=True)
         except Exception as e:
             logger.error(f"Ошибка при генерации сказки с прошлой моралью: {e}", exc_info=True)
-            message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
             if message_target:
                 await message_target.reply_text(
                     "❌ Произошла ошибка при генерации сказки. Попробуйте позже."
                 )
+        finally:
+            if not handed_off:
+                antiflood.abort_generation(user_id)
 
 
 async def generate_story_with_wishes(
@@ -1096,10 +1314,9 @@ async def generate_story_with_wishes(
     chat_id = update.effective_chat.id if update.effective_chat else None
     async with typing_indicator(context, chat_id):
         try:
-            # Используем агент-роутер для формирования промпта
+            # Формируем промпт по шаблону (чистая функция, без потока)
             # Передаем пожелания как user_message, чтобы агент учел их
-            agent_response = await run_blocking(
-                agent_router.process_story_request,
+            agent_response = build_story_request(
                 request_type="wishes",
                 user_message=f"Учти следующие пожелания при написании сказки: {wishes}",
                 user_profile=profile
@@ -1127,9 +1344,8 @@ async def generate_story_with_updated_traits(
     chat_id = update.effective_chat.id if update.effective_chat else None
     async with typing_indicator(context, chat_id):
         try:
-            # Используем агент-роутер для формирования промпта
-            agent_response = await run_blocking(
-                agent_router.process_story_request,
+            # Формируем промпт по шаблону (чистая функция, без потока)
+            agent_response = build_story_request(
                 request_type="add_traits",
                 user_message=user_message,
                 user_profile=profile
@@ -1151,13 +1367,83 @@ async def generate_and_send_story_internal(
     user_id: int,
     profile: Dict,
     agent_response: Dict,
-    status_msg = None
+    status_msg = None,
+    admitted: bool = False
 ):
     """Внутренняя функция для генерации и отправки сказки.
     
+    Единая точка допуска для всех источников генерации (сообщения и кнопки):
+    проверяет антифлуд, суточный лимит и не дает запустить вторую генерацию,
+    пока первая для этого пользователя еще идет. Если слот уже занят вызывающим
+    кодом (admitted=True, см. generate_and_send_story), повторный допуск не выполняется.
+    
+    Генерация выполняется отдельной задачей; ее можно отменить через cancel_generation.
+    Дедлайн GENERATION_TIMEOUT_SECONDS действует, пока пишется текст сказки
+    (см. _generate_and_send_story); сохранение и доставка идут уже без него.
+    Генерация учитывается в антифлуде, как только сказка сохранена; прерванные
+    по таймауту и закончившиеся ошибкой до этого момента не учитываются, а отмененные
+    новым запросом учитываются (см. AntifloodManager.abort_generation).
+    
     Args:
         status_msg: Опциональное статус-сообщение, которое будет удалено после успешной генерации сказки.
     """
+    if not admitted:
+        source = (agent_response or {}).get("request_type", "regular")
+        admitted, refusal_message = antiflood.try_start_generation(user_id, source)
+        if not admitted:
+            message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
+            await reply_or_edit_status(message_target, status_msg, refusal_message)
+            return
+    
+    message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
+    
+    async def _run_generation():
+        superseded = False
+        try:
+            await _generate_and_send_story(update, context, user_id, profile, agent_response, status_msg)
+        except asyncio.CancelledError:
+            # Отменена через cancel_generation новым запросом
+            superseded = True
+            raise
+        finally:
+            if generation_tasks.get(user_id) is asyncio.current_task():
+                generation_tasks.pop(user_id, None)
+            # Если сказка сохранена, генерация уже учтена (finish_generation) и это ничего не меняет
+            antiflood.abort_generation(user_id, superseded=superseded)
+    
+    task = asyncio.create_task(_run_generation())
+    generation_tasks[user_id] = task
+    try:
+        await task
+    except asyncio.CancelledError:
+        # Отменен сам обработчик (например, при остановке бота) - пробрасываем дальше
+        if asyncio.current_task().cancelling():
+            raise
+        logger.info(f"Генерация для пользователя {user_id} отменена новым запросом")
+        await reply_or_edit_status(message_target, status_msg, "⏹ Генерация этой сказки отменена.")
+
+
+async def reply_or_edit_status(message_target, status_msg, text: str):
+    """Показывает текст в статус-сообщении, если оно есть, иначе отправляет новое сообщение."""
+    if status_msg:
+        try:
+            await status_msg.edit_text(text)
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус-сообщение: {e}")
+    if message_target:
+        await message_target.reply_text(text)
+
+
+async def _generate_and_send_story(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    profile: Dict,
+    agent_response: Dict,
+    status_msg = None
+):
+    """Генерирует и отправляет сказку (вызывается только после допуска в generate_and_send_story_internal)."""
     message_target = update.message if update.message else (update.callback_query.message if update.callback_query else None)
     
     try:
@@ -1205,46 +1491,15 @@ async def generate_and_send_story_internal(
                 )
             return
         
+        request_type = agent_response.get("request_type", "regular")
+        
         # ВАЖНО: Добавляем информацию о детях из профиля в начало промпта
-        if profile and isinstance(profile, dict):
-            child_names = profile.get('child_names', '').strip() if profile.get('child_names') else ''
-            age = profile.get('age', '').strip() if profile.get('age') else ''
-            traits = profile.get('traits', '').strip() if profile.get('traits') else ''
-            context_active = profile.get('context_active', '').strip() if profile.get('context_active') else ''
-            wishes = profile.get('wishes', '').strip() if profile.get('wishes') else ''
-            request_type = agent_response.get("request_type", "regular")
-            story_total = profile.get('story_total', 0) or 0
-            is_first_story = (story_total == 0)
-            
-            profile_header = f"ГЛАВНЫЕ ГЕРОИ сказки (обязательно используй их в сказке):\n"
-            profile_header += f"- Имена: {child_names}\n"
-            
-            # Возраст и черты характера всегда учитываются, но не прописываются текстом
-            if age:
-                profile_header += f"- Возраст: {age} (УЧИТЫВАЙ при написании: сложность языка, понятность сюжета, глубину морали - но НЕ пиши возраст текстом в сказке)\n"
-            if traits:
-                profile_header += f"- Черты характера: {traits} (ОБЯЗАТЕЛЬНО отрази в поведении и поступках героя, но СТРОГО ЗАПРЕЩЕНО упоминать их текстом. НЕ используй конструкции типа 'сказал он конструктор', 'он наставник', 'он генератор идей' и т.д. Покажи характер только через действия)\n"
+        if profile and hasattr(profile, 'get'):
+            deepseek_prompt = build_deepseek_prompt(deepseek_prompt, profile, request_type)
             
-            # Для случайной морали НЕ добавляем context_active
-            if request_type != "random_moral" and context_active:
-                profile_header += f"\nВАЖНО - РЕАЛЬНАЯ СИТУАЦИЯ ДЛЯ РАЗБОРА:\n{context_active}\n"
-                profile_header += "Сказка ОБЯЗАТЕЛЬНО должна разбирать именно эту ситуацию. Мораль НЕ должна быть написана текстом - она должна быть понятна из действий и выбора героя.\n"
-            
-            # Добавляем пожелания, если они есть
-            if wishes:
-                profile_header += f"\nДОПОЛНИТЕЛЬНЫЕ ПОЖЕЛАНИЯ (ОБЯЗАТЕЛЬНО УЧТИ):\n{wishes}\n"
-                profile_header += "Эти пожелания должны быть учтены при написании сказки.\n"
-            
-            profile_header += f"\nЗАДАНИЕ: {deepseek_prompt}\n\n"
-            
-            # Финальное напоминание всегда включает инструкции по возрасту и характеру
-            profile_header += "ВАЖНО: Главными героями сказки ДОЛЖНЫ быть именно эти дети с указанными именами. "
-            if age or traits:
-                profile_header += "Обязательно учитывай возраст и черты характера при написании (сложность языка, поведение героя), но СТРОГО ЗАПРЕЩЕНО писать их текстом. НЕ используй роли или типы личности типа 'конструктор', 'наставник', 'генератор идей' и т.д."
-            
-            deepseek_prompt = profile_header
-            
-            logger.info(f"Добавлена информация о детях в промпт: {child_names}")
+            context_active = (profile.get('context_active') or '').strip()
+            wishes = (profile.get('wishes') or '').strip()
+            logger.info(f"Добавлена информация о детях в промпт: {(profile.get('child_names') or '').strip()}")
             if request_type != "random_moral" and context_active:
                 logger.info(f"Добавлен контекст ситуации: {context_active[:100]}...")
             if wishes:
@@ -1252,8 +1507,37 @@ async def generate_and_send_story_internal(
         else:
             logger.warning(f"Профиль не найден или некорректен для пользователя {user_id}, используем базовый промпт")
         
-        logger.info(f"Генерирую сказку через DeepSeek для пользователя {user_id}, длина промпта: {len(deepseek_prompt)}")
-        story_text = await run_blocking(deepseek_client.generate_story, deepseek_prompt)
+        # Сказка по тому же промпту могла быть сгенерирована раньше (например, если не удалась отправка)
+        cache_key = story_cache.make_key(deepseek_prompt, deepseek_client.model, deepseek_client.temperature)
+        story_text = story_cache.get(cache_key, user_id)
+        generation_ms = None
+        if story_text:
+            logger.info(f"Сказка для пользователя {user_id} взята из кэша, генерация не требуется")
+        else:
+            generation_started = time.perf_counter()
+            logger.info(f"Генерирую сказку через DeepSeek для пользователя {user_id}, длина промпта: {len(deepseek_prompt)}")
+            single_hop_message = agent_response.get("single_hop_message")
+            # Дедлайн ограничивает только написание текста: сохранение и доставку готовой сказки он не обрывает
+            try:
+                async with asyncio.timeout(GENERATION_TIMEOUT_SECONDS):
+                    if single_hop_message:
+                        story_text, profile = await generate_story_single_hop(user_id, single_hop_message, profile, deepseek_prompt)
+                    else:
+                        # Асинхронный запрос: отмена генерации сразу обрывает HTTP-соединение
+                        story_text = await deepseek_client.agenerate_story(deepseek_prompt)
+            except TimeoutError:
+                logger.warning(f"Генерация для пользователя {user_id} не уложилась в {GENERATION_TIMEOUT_SECONDS} с")
+                await reply_or_edit_status(
+                    message_target, status_msg,
+                    "⏳ Сказка пишется слишком долго. Попробуйте ещё раз чуть позже."
+                )
+                return
+            generation_ms = elapsed_ms(generation_started)
+            if story_text:
+                story_cache.put(cache_key, user_id, story_text)
+        
+        # Сказка готова: дальше сохранение и доставка, их новый запрос уже не отменяет
+        detach_generation(user_id)
         
         if not story_text:
             logger.error(f"DeepSeek вернул пустой ответ для пользователя {user_id}")
@@ -1274,45 +1558,50 @@ async def generate_and_send_story_internal(
                 )
             return
         
-        # Сохраняем сказку в БД
-        try:
-            await run_blocking(save_story, user_id, story_text, model='deepseek')
-            # Собираем статистику: сказка создана
-            try:
-                await run_blocking(increment_daily_stat, 'stories')
-            except Exception as stat_error:
-                logger.warning(f"Ошибка сбора статистики сказок: {stat_error}")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении сказки в БД для пользователя {user_id}: {e}", exc_info=True)
-            # Продолжаем отправку, даже если сохранение не удалось
-        
-        # Удаляем статус-сообщение, если оно было передано (перед отправкой сказки)
-        if status_msg:
+        # Сохраняем сказку в БД (если это повтор из кэша, она уже сохранена)
+        story_id = story_cache.get_saved_story_id(cache_key, user_id)
+        if story_id is None:
             try:
-                await status_msg.delete()
+                story_id = await run_blocking(
+                    storage.save_story, user_id, story_text, model='deepseek', request_type=request_type,
+                    agent_ms=(agent_response or {}).get("agent_ms"), generation_ms=generation_ms
+                )
+                if story_id:
+                    story_cache.mark_saved(cache_key, user_id, story_id)
+                # Собираем статистику: сказка создана
+                try:
+                    await run_blocking(storage.increment_daily_stat, 'stories')
+                except Exception as stat_error:
+                    logger.warning(f"Ошибка сбора статистики сказок: {stat_error}")
             except Exception as e:
-                logger.warning(f"Не удалось удалить статус-сообщение: {e}")
+                logger.error(f"Ошибка при сохранении сказки в БД для пользователя {user_id}: {e}", exc_info=True)
+                # Продолжаем отправку, даже если сохранение не удалось
         
-        # Преобразуем markdown разметку в HTML
-        story_text_html = markdown_to_html(story_text)
+        # Сказка написана и сохранена: генерация учитывается в антифлуде независимо от исхода доставки
+        antiflood.finish_generation(user_id)
         
-        # Отправляем сказку частями, если она длинная
-        chunks = split_message(story_text_html)
-        for i, chunk in enumerate(chunks):
-            if i == 0:
-                await message_target.reply_text(chunk, parse_mode=ParseMode.HTML)
-            else:
-                await message_target.reply_text(chunk, parse_mode=ParseMode.HTML)
-
-        # Для случайной морали отправляем выбранную мораль отдельным сообщением
+        # Для случайной морали показываем выбранную мораль после сказки
+        moral_text = ""
         if request_type == "random_moral":
             moral_text = (agent_response or {}).get("moral", "").strip()
-            if moral_text:
-                await message_target.reply_text(f'Мораль: "{moral_text}"')
-
-        # Показываем кнопки выбора для следующей сказки
-        await show_story_options(update, context)
         
+        delivery_started = time.perf_counter()
+        try:
+            await send_story(update, context, message_target, story_text, moral_text, status_msg)
+        except Exception as e:
+            if not story_id:
+                raise
+            # Сказка уже сохранена - предлагаем отправить ее повторно без новой генерации
+            logger.error(f"Ошибка при отправке сказки {story_id} пользователю {user_id}: {e}", exc_info=True)
+            await run_blocking(storage.set_story_delivery_status, story_id, 'failed', delivery_ms=elapsed_ms(delivery_started))
+            await report_delivery_failure(message_target, story_id)
+            return
+        
+        if story_id:
+            await run_blocking(storage.set_story_delivery_status, story_id, 'delivered', delivery_ms=elapsed_ms(delivery_started))
+            if REFLECTION_PREFETCH:
+                prefetch_reflection_questions(story_id, story_text, profile)
+        story_cache.mark_delivered(cache_key, user_id)
         logger.info(f"Сказка успешно отправлена пользователю {user_id}")
         
     except Exception as e:
@@ -1341,6 +1630,73 @@ async def generate_and_send_story_internal(
                 logger.error(f"Ошибка при отправке сообщения об ошибке пользователю {user_id}: {send_error}", exc_info=True)
 
 
+# Поля профиля, которые может менять Agent 1
+PROFILE_PATCH_FIELDS = ("child_names", "age", "traits")
+
+
+async def patch_profile(user_id: int, expected_version: int | None = None, **fields):
+    """Сохраняет поля профиля одним UPDATE ... RETURNING и кладет новый профиль в кэш без повторного чтения.
+    
+    Если передан expected_version, изменение применяется только к этой версии профиля.
+    Возвращает (профиль, конфликт): при конфликте - актуальный профиль (или None, если он удален).
+    """
+    updated_profile, conflict = await run_blocking(storage.patch_user_profile, user_id, fields, expected_version)
+    if updated_profile:
+        profile_cache.set(user_id, updated_profile)
+    else:
+        profile_cache.invalidate(user_id)
+    if conflict:
+        logger.warning(f"Профиль пользователя {user_id} изменился параллельно, изменение {list(fields)} не применено")
+    return updated_profile, conflict
+
+
+async def apply_profile_patch(user_id: int, profile_patch: Dict, profile: Dict) -> Dict:
+    """Сохраняет изменения профиля от Agent 1 и возвращает актуальный профиль.
+    
+    Agent 1 строит изменения от прочитанной версии профиля, поэтому при конфликте
+    версий изменения не применяются и используется актуальный профиль.
+    """
+    patch = {key: value for key, value in (profile_patch or {}).items() if key in PROFILE_PATCH_FIELDS}
+    if not patch:
+        return profile
+    
+    updated_profile, _ = await patch_profile(user_id, profile.get('version'), **patch)
+    return updated_profile or profile
+
+
+async def generate_story_single_hop(user_id: int, user_message: str, profile: Dict, deepseek_prompt: str):
+    """Однопроходная генерация: обновление профиля и сказка одним вызовом DeepSeek.
+    
+    Если ответ не удалось разобрать, выполняет обычный путь: Agent 1, затем DeepSeek.
+    Сетевые ошибки, таймауты и ошибки API на обычный путь не переводятся: он обращается
+    к тому же DeepSeek, поэтому генерация считается неудавшейся.
+    Возвращает (текст сказки или None, актуальный профиль).
+    """
+    try:
+        result = await deepseek_client.agenerate_story_with_profile_patch(
+            build_single_hop_prompt(deepseek_prompt, user_message, profile)
+        )
+    except DeepSeekRequestError:
+        return None, profile
+    if result is not None:
+        logger.info(f"Сказка и обновление профиля получены одним вызовом для пользователя {user_id}")
+        if result["should_update_profile"]:
+            profile = await apply_profile_patch(user_id, result["profile_patch"], profile)
+        return result["story"], profile
+    
+    logger.warning(f"Однопроходная генерация не удалась для пользователя {user_id}, перехожу на Agent 1 + DeepSeek")
+    agent_response = await run_blocking(
+        agent_router.process_message,
+        user_message,
+        profile,
+        workload="llm"
+    )
+    if agent_response.get("should_update_profile", False):
+        profile = await apply_profile_patch(user_id, agent_response.get("profile_patch", {}), profile)
+    prompt = build_deepseek_prompt(agent_response.get("deepseek_user_prompt", ""), profile, "regular")
+    return await deepseek_client.agenerate_story(prompt), profile
+
+
 async def generate_and_send_story(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -1351,12 +1707,21 @@ async def generate_and_send_story(
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id if update.effective_chat else None
     
+    # Слот генерации занимается до Agent 1 и обновления профиля: второе сообщение,
+    # пришедшее во время первой генерации, не платит за Agent 1 и не меняет профиль
+    admitted, refusal_message = antiflood.try_start_generation(user_id, "regular")
+    if not admitted:
+        await update.message.reply_text(refusal_message)
+        return
+    # Пока слот не передан в generate_and_send_story_internal, освобождаем его здесь
+    handed_off = False
+    
     async with typing_indicator(context, chat_id):
         try:
             # Загружаем профиль (из кэша или из БД)
             profile = profile_cache.get(user_id)
             if not profile:
-                profile = get_user(user_id)
+                profile = await run_blocking(storage.get_user, user_id)
                 if profile:
                     profile_cache.set(user_id, profile)
             
@@ -1371,8 +1736,7 @@ async def generate_and_send_story(
             
             if skip_profile_update:
                 try:
-                    agent_response = await run_blocking(
-                        agent_router.process_story_request,
+                    agent_response = build_story_request(
                         "regular",
                         user_message,
                         profile
@@ -1384,14 +1748,22 @@ async def generate_and_send_story(
                         "❌ Ошибка при обработке запроса. Попробуйте позже."
                     )
                     return
+            elif SINGLE_HOP_GENERATION:
+                # Agent 1 не вызывается: профиль обновит тот же вызов DeepSeek, что пишет сказку
+                agent_response = build_story_request("regular", user_message, profile)
+                agent_response["single_hop_message"] = user_message
             else:
                 # Вызываем Agent 1
                 try:
+                    agent_started = time.perf_counter()
                     agent_response = await run_blocking(
                         agent_router.process_message,
                         user_message,
-                        profile
+                        profile,
+                        workload="llm"
                     )
+                    # Длительность этапа сохраняется вместе со сказкой (agent_ms)
+                    agent_response["agent_ms"] = elapsed_ms(agent_started)
                     logger.info(f"Agent 1 ответ получен для пользователя {user_id}")
                 except Exception as e:
                     logger.error(f"Ошибка при вызове Agent 1: {e}", exc_info=True)
@@ -1402,20 +1774,12 @@ async def generate_and_send_story(
                 
                 # Обновляем профиль, если нужно
                 if agent_response.get("should_update_profile", False):
-                    profile_patch = agent_response.get("profile_patch", {})
-                    if profile_patch:
-                        # Обновляем только существующие поля (last_user_message не используется в новой схеме БД)
-                        success = update_user_fields(user_id, **profile_patch)
-                        if success:
-                            # Инвалидируем кэш и обновляем
-                            profile_cache.invalidate(user_id)
-                            updated_profile = get_user(user_id)
-                            if updated_profile:
-                                profile_cache.set(user_id, updated_profile)
-                                profile = updated_profile
+                    profile = await apply_profile_patch(user_id, agent_response.get("profile_patch", {}), profile)
             
             # Используем внутреннюю функцию для генерации (передаем status_msg, чтобы оно удалилось после генерации)
-            await generate_and_send_story_internal(update, context, user_id, profile, agent_response, status_msg)
+            handed_off = True
+            await generate_and_send_story_internal(update, context, user_id, profile, agent_response, status_msg,
+                                                   admitted=True)
             
         except Exception as e:
             logger.error(f"Ошибка при генерации сказки для пользователя {user_id}: {e}", exc_info=True)
@@ -1432,43 +1796,71 @@ async def generate_and_send_story(
                 await update.message.reply_text(
                     "❌ Произошла ошибка при генерации сказки. Попробуйте позже."
                 )
+        finally:
+            if not handed_off:
+                antiflood.abort_generation(user_id)
+
+
+class InstrumentedApplication(Application):
+    """Application, который считает запросы к БД на каждый апдейт."""
+    
+    async def process_update(self, update: object) -> None:
+        update_id = getattr(update, 'update_id', None)
+        with query_scope(f"update {update_id}") as scope:
+            await super().process_update(update)
+        if scope.statements > DB_STATEMENTS_PER_UPDATE_WARN:
+            logger.warning(f"Апдейт {update_id}: {scope.statements} запросов к БД ({scope.db_ms:.0f} мс)")
+        elif scope.statements:
+            logger.debug(f"Апдейт {update_id}: {scope.statements} запросов к БД ({scope.db_ms:.0f} мс)")
+
+
+async def start_background_tasks(application: Application):
+    """Создает OpenAI-клиент в фоне, не задерживая начало опроса Telegram; запускает выгрузку в Google Sheets."""
+    application.create_task(run_blocking(agent_router.warm_up, workload="llm"))
+    if sheets_exporter is not None:
+        application.create_task(sheets_exporter.start())
+
+
+async def shutdown_executors(application: Application):
+    """Логирует метрики, останавливает пулы потоков и тикер typing, закрывает HTTP-клиент DeepSeek при завершении бота."""
+    await deepseek_client.aclose()
+    await typing_ticker.stop()
+    if sheets_exporter is not None:
+        await sheets_exporter.stop()
+    logger.info(f"Метрики typing: {typing_ticker.stats()}, задержано бюджетом запросов: {outbound_budget.throttled}")
+    logger.info(f"Метрики пулов потоков: {executors.stats()}")
+    logger.info(f"Запросы к БД по функциям репозитория: {query_stats.snapshot()}")
+    executors.shutdown(wait=False)
 
 
 def main():
     """Запуск бота."""
     logger.info("Запуск бота 'Сказочник'...")
     
-    # Проверяем и применяем миграцию для колонки wishes, если нужно
+    # Сверяем ревизию схемы БД с миграциями в образе (один SELECT version_num, без DDL)
     try:
-        from db.session import engine  # noqa
-        from sqlalchemy import text, inspect  # noqa
-        
-        inspector = inspect(engine)
-        columns = [col['name'] for col in inspector.get_columns('users')]
-        
-        if 'wishes' not in columns:
-            logger.warning("Колонка 'wishes' отсутствует в БД. Пытаюсь добавить...")
-            try:
-                with engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE users ADD COLUMN wishes TEXT"))
-                    conn.commit()
-                logger.info("✓ Колонка 'wishes' успешно добавлена в БД")
-            except Exception as e:
-                logger.error(f"Не удалось добавить колонку 'wishes': {e}")
-                logger.error("Пожалуйста, примените миграцию вручную: python check_and_fix_wishes.py")
-        else:
-            logger.info("✓ Колонка 'wishes' присутствует в БД")
+        check_schema(SCHEMA_CHECK if STORAGE_BACKEND == 'postgres' else 'off')
+    except SchemaOutOfDateError as e:
+        logger.critical(f"Схема БД устарела: {e}")
+        raise SystemExit(1)
     except Exception as e:
-        logger.warning(f"Не удалось проверить структуру БД: {e}")
-        logger.warning("Продолжаю запуск, но возможны ошибки при сохранении профилей")
+        logger.warning(f"Не удалось проверить версию схемы БД: {e}")
+        logger.warning("Продолжаю запуск, но возможны ошибки при работе с БД")
     
     # Создаем приложение
-    application = (
+    builder = (
         Application.builder()
+        .application_class(InstrumentedApplication)
         .token(TELEGRAM_BOT_TOKEN)
         .concurrent_updates(True)
-        .build()
+        .rate_limiter(outbound_budget)
+        .post_init(start_background_tasks)
+        .post_shutdown(shutdown_executors)
     )
+    if TELEGRAM_API_BASE_URL:
+        # Локальный Bot API (например, фейковый сервер нагрузочного теста)
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
     
     # ConversationHandler для анкеты
     conv_handler = ConversationHandler(
@@ -12,11 +12,14 @@ load_dotenv(override=False)
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN не установлен в .env")
+# Адрес Bot API (пусто - api.telegram.org); используется нагрузочным тестом с локальным фейковым сервером
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "")
 
 # OpenAI (Agent 1)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY не установлен в .env")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.proxyapi.ru/openai/v1")
 
 # DeepSeek
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
@@ -28,9 +31,17 @@ DEEPSEEK_API_URL = os.getenv(
     "https://api.deepseek.com/v1/chat/completions"
 )
 
-# Google Sheets (deprecated - используем PostgreSQL)
-# GOOGLE_SHEETS_CREDENTIALS_PATH = os.getenv("GOOGLE_SHEETS_CREDENTIALS_PATH", "credentials.json")
-# SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
+# Хранилище данных бота: "postgres" или "memory" (в памяти процесса, для тестов и нагрузочного теста)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres").lower()
+
+# Google Sheets - необязательная выгрузка копии профилей и сказок (основное хранилище - PostgreSQL)
+SHEETS_EXPORT = os.getenv("SHEETS_EXPORT", "false").lower() in ("1", "true", "yes")
+GOOGLE_SHEETS_CREDENTIALS_PATH = os.getenv("GOOGLE_SHEETS_CREDENTIALS_PATH", "credentials.json")
+SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
+if SHEETS_EXPORT and not SPREADSHEET_ID:
+    raise ValueError("SPREADSHEET_ID не установлен в .env (нужен при SHEETS_EXPORT=true)")
+SHEETS_EXPORT_BATCH_SIZE = int(os.getenv("SHEETS_EXPORT_BATCH_SIZE", "200"))
+SHEETS_EXPORT_INTERVAL_SECONDS = float(os.getenv("SHEETS_EXPORT_INTERVAL_SECONDS", "30"))
 
 # PostgreSQL
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -41,11 +52,56 @@ if not DATABASE_URL:
 if DATABASE_URL.startswith("postgresql://") and "+psycopg" not in DATABASE_URL:
     DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
 
+# Проверка схемы БД при запуске: сравнение alembic_version с миграциями в образе.
+# "fail" - не запускаться, если БД отстает; "warn" - только предупредить;
+# "upgrade" - применить миграции (лучше отдельным запуском: python apply_migrations.py); "off" - не проверять
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "fail").lower()
+
+# Хранение истории сказок: таблица stories разбита на месячные партиции (миграция 009).
+# Партиции старше STORIES_RETENTION_MONTHS месяцев удаляются целиком (0 - хранить всё),
+# новые создаются на STORIES_PARTITIONS_AHEAD месяцев вперед: python maintain_story_partitions.py
+STORIES_RETENTION_MONTHS = int(os.getenv("STORIES_RETENTION_MONTHS", "24"))
+STORIES_PARTITIONS_AHEAD = int(os.getenv("STORIES_PARTITIONS_AHEAD", "2"))
+# Сказка по id (статус доставки, повторная отправка, вопросы для размышлений) ищется только среди
+# созданных за последние STORY_LOOKUP_DAYS дней: так PostgreSQL читает лишь последние партиции
+STORY_LOOKUP_DAYS = int(os.getenv("STORY_LOOKUP_DAYS", "31"))
+
+# Сжатие текстов сказок в БД: "off" - хранить как есть; "zstd" - сжимать новые сказки
+# (со словарем, если он обучен: python train_story_dictionary.py). Нужен zstandard (requirements-compression.txt)
+STORY_TEXT_COMPRESSION = os.getenv("STORY_TEXT_COMPRESSION", "off").lower()
+STORY_COMPRESSION_LEVEL = int(os.getenv("STORY_COMPRESSION_LEVEL", "6"))
+
+# Инструментирование запросов к БД: счетчики по функциям репозитория и лог медленных запросов
+DB_QUERY_INSTRUMENTATION = os.getenv("DB_QUERY_INSTRUMENTATION", "true").lower() in ("1", "true", "yes")
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+# Предупреждать, если обработка одного апдейта отправила больше запросов к БД
+DB_STATEMENTS_PER_UPDATE_WARN = int(os.getenv("DB_STATEMENTS_PER_UPDATE_WARN", "20"))
+
 # Настройки
 ANTIFLOOD_SECONDS = int(os.getenv("ANTIFLOOD_SECONDS", "15"))
 PROFILE_CACHE_TTL_MINUTES = int(os.getenv("PROFILE_CACHE_TTL_MINUTES", "5"))
 DAILY_STORY_LIMIT = int(os.getenv("DAILY_STORY_LIMIT", "15"))
+# Компактная доставка сказки: статус-сообщение редактируется в первую часть,
+# клавиатура и мораль прикрепляются к последней части (меньше вызовов Bot API)
+COMPACT_DELIVERY = os.getenv("COMPACT_DELIVERY", "true").lower() in ("1", "true", "yes")
+# Кэш сгенерированных сказок: "retry" - повтор после ошибки доставки, "off" - отключен
+STORY_CACHE_POLICY = os.getenv("STORY_CACHE_POLICY", "retry").lower()
+STORY_CACHE_TTL_MINUTES = int(os.getenv("STORY_CACHE_TTL_MINUTES", "60"))
+STORY_CACHE_MAX_SIZE = int(os.getenv("STORY_CACHE_MAX_SIZE", "500"))
+# Размеры пулов потоков для блокирующих задач: БД, LLM-провайдеры, CPU
+EXECUTOR_DB_WORKERS = int(os.getenv("EXECUTOR_DB_WORKERS", "8"))
+EXECUTOR_LLM_WORKERS = int(os.getenv("EXECUTOR_LLM_WORKERS", "32"))
+EXECUTOR_CPU_WORKERS = int(os.getenv("EXECUTOR_CPU_WORKERS", "2"))
+# Однопроходная генерация: один вызов DeepSeek возвращает и обновление профиля, и сказку
+# (при ошибке разбора ответа - обычный путь Agent 1 + DeepSeek)
+SINGLE_HOP_GENERATION = os.getenv("SINGLE_HOP_GENERATION", "false").lower() in ("1", "true", "yes")
+# Генерировать вопросы для размышлений в фоне сразу после доставки сказки
+REFLECTION_PREFETCH = os.getenv("REFLECTION_PREFETCH", "false").lower() in ("1", "true", "yes")
+# Глобальный бюджет исходящих запросов к Bot API и период обновления статуса 'Typing'
+TELEGRAM_RATE_LIMIT_PER_SECOND = int(os.getenv("TELEGRAM_RATE_LIMIT_PER_SECOND", "25"))
+TYPING_INTERVAL_SECONDS = float(os.getenv("TYPING_INTERVAL_SECONDS", "4"))
+# Общий дедлайн на генерацию одной сказки (промпт + LLM + доставка), секунды
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", "150"))
 
 # Пути
 BASE_DIR = Path(__file__).parent.parent
-
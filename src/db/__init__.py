@@ -1,29 +1,50 @@
 """Database package for PostgreSQL storage."""
-from .session import engine, SessionLocal, Base
+from .session import engine, SessionLocal, Base, query_scope, query_stats
+from .records import UserProfile, GenerationProfile
 from .repository import (
     get_user,
+    user_exists,
+    get_generation_profile,
     upsert_user_profile,
     update_user_fields,
+    patch_user_profile,
     increment_story_total,
     save_story,
+    set_story_delivery_status,
+    get_story,
+    set_story_reflection_questions,
+    get_latest_story_reflection,
     get_last_stories,
     add_context,
     get_active_context,
     delete_user_profile,
+    purge_inactive_users,
 )
 
 __all__ = [
     'engine',
     'SessionLocal',
     'Base',
+    'query_scope',
+    'query_stats',
+    'UserProfile',
+    'GenerationProfile',
     'get_user',
+    'user_exists',
+    'get_generation_profile',
     'upsert_user_profile',
     'update_user_fields',
+    'patch_user_profile',
     'increment_story_total',
     'save_story',
+    'set_story_delivery_status',
+    'get_story',
+    'set_story_reflection_questions',
+    'get_latest_story_reflection',
     'get_last_stories',
     'add_context',
     'get_active_context',
     'delete_user_profile',
+    'purge_inactive_users',
 ]
 
@@ -0,0 +1,236 @@
+"""Materialized analytics computed from stories and users.
+
+refresh_analytics() recomputes the analytics_* tables with INSERT ... SELECT on the
+database side, week by week, starting from the week of the last refresh: days
+before it are final (stories are only appended, with created_at = now), so a
+refresh touches only the last few days and history is never re-read. Computed
+history also outlives the stories partitions dropped by retention.
+
+- analytics_daily: DAU (users who received a story), stories, new users per day;
+- analytics_request_types: stories per day and request type (button mix);
+- analytics_cohorts: users registered in a week who received a story in a later week.
+
+The iter_* readers stream rows with a server-side cursor (yield_per), so exports
+use constant memory regardless of the period.
+"""
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, Optional
+
+from sqlalchemy import Date, cast, delete, func, insert, literal, select, union_all
+
+from .session import SessionLocal, engine, stream_rows
+from .models import (
+    AnalyticsCohort,
+    AnalyticsDaily,
+    AnalyticsRefreshState,
+    AnalyticsRequestType,
+    DailyStats,
+    Story,
+    User,
+)
+
+logger = logging.getLogger(__name__)
+
+REFRESH_STATE_NAME = 'analytics'
+UNKNOWN_REQUEST_TYPE = 'unknown'
+
+
+def _day(column):
+    """Calendar day of a timestamp column, computed by the database."""
+    if engine.dialect.name == 'postgresql':
+        return cast(column, Date)
+    return func.date(column)
+
+
+def _week(column):
+    """Monday of the week of a timestamp/date column, computed by the database."""
+    if engine.dialect.name == 'postgresql':
+        return cast(func.date_trunc('week', column), Date)
+    return func.date(column, 'weekday 0', '-6 days')
+
+
+def week_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+def _refresh_range(db, start: datetime, end: datetime):
+    """Recompute all analytics tables for [start, end); start and end are Mondays."""
+    stories_in_range = (Story.created_at >= start, Story.created_at < end)
+    users_in_range = (User.created_at >= start, User.created_at < end)
+
+    db.execute(delete(AnalyticsDaily).where(AnalyticsDaily.date >= start.date(), AnalyticsDaily.date < end.date()))
+    story_days = (
+        select(_day(Story.created_at).label('day'),
+               func.count(func.distinct(Story.user_id)).label('active_users'),
+               func.count().label('stories'),
+               literal(0).label('new_users'))
+        .where(*stories_in_range)
+        .group_by(_day(Story.created_at))
+    )
+    user_days = (
+        select(_day(User.created_at).label('day'),
+               literal(0).label('active_users'),
+               literal(0).label('stories'),
+               func.count().label('new_users'))
+        .where(*users_in_range)
+        .group_by(_day(User.created_at))
+    )
+    days = union_all(story_days, user_days).subquery()
+    db.execute(insert(AnalyticsDaily).from_select(
+        ['date', 'active_users', 'stories', 'new_users'],
+        select(days.c.day, func.sum(days.c.active_users), func.sum(days.c.stories), func.sum(days.c.new_users))
+        .group_by(days.c.day)
+    ))
+
+    db.execute(delete(AnalyticsRequestType).where(
+        AnalyticsRequestType.date >= start.date(), AnalyticsRequestType.date < end.date()
+    ))
+    request_type = func.coalesce(Story.request_type, UNKNOWN_REQUEST_TYPE)
+    db.execute(insert(AnalyticsRequestType).from_select(
+        ['date', 'request_type', 'stories'],
+        select(_day(Story.created_at), request_type, func.count())
+        .where(*stories_in_range)
+        .group_by(_day(Story.created_at), request_type)
+    ))
+
+    db.execute(delete(AnalyticsCohort).where(
+        AnalyticsCohort.activity_week >= start.date(), AnalyticsCohort.activity_week < end.date()
+    ))
+    db.execute(insert(AnalyticsCohort).from_select(
+        ['cohort_week', 'activity_week', 'active_users'],
+        select(_week(User.created_at), _week(Story.created_at), func.count(func.distinct(Story.user_id)))
+        .join(User, User.telegram_id == Story.user_id)
+        .where(*stories_in_range)
+        .group_by(_week(User.created_at), _week(Story.created_at))
+    ))
+
+
+def refresh_analytics(now: Optional[datetime] = None, chunk_weeks: int = 4) -> Dict[str, Any]:
+    """
+    Bring the analytics tables up to date.
+    First run backfills from the oldest story/user; later runs start from the week of
+    the previous refresh. Each chunk of chunk_weeks weeks is one short transaction.
+    Returns {'from': date, 'to': date, 'chunks': n}.
+    """
+    now = now or datetime.utcnow()
+    today = now.date()
+    end = week_start(today) + timedelta(weeks=1)
+
+    db = SessionLocal()
+    try:
+        refreshed_until = db.execute(
+            select(AnalyticsRefreshState.refreshed_until).where(AnalyticsRefreshState.name == REFRESH_STATE_NAME)
+        ).scalar()
+        if refreshed_until is None:
+            oldest = [value for value in (
+                db.execute(select(func.min(Story.created_at))).scalar(),
+                db.execute(select(func.min(User.created_at))).scalar(),
+            ) if value is not None]
+            refreshed_until = min(oldest).date() if oldest else today
+    finally:
+        db.close()
+
+    start = week_start(refreshed_until)
+    chunks = 0
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + timedelta(weeks=chunk_weeks), end)
+        db = SessionLocal()
+        try:
+            _refresh_range(db, datetime.combine(chunk_start, datetime.min.time()),
+                           datetime.combine(chunk_end, datetime.min.time()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        chunks += 1
+        chunk_start = chunk_end
+
+    db = SessionLocal()
+    try:
+        state = db.get(AnalyticsRefreshState, REFRESH_STATE_NAME)
+        if state is None:
+            db.add(AnalyticsRefreshState(name=REFRESH_STATE_NAME, refreshed_until=today))
+        else:
+            state.refreshed_until = today
+        db.commit()
+    finally:
+        db.close()
+
+    logger.info(f"Analytics refreshed from {start} to {today} in {chunks} chunks")
+    return {'from': start, 'to': today, 'chunks': chunks}
+
+
+def iter_daily_analytics(start: Optional[date] = None, end: Optional[date] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Days in [start, end] in date order with analytics and the daily_stats counters.
+    stories_per_user is stories per active user that day.
+    """
+    statement = (
+        select(AnalyticsDaily.date, AnalyticsDaily.active_users, AnalyticsDaily.stories, AnalyticsDaily.new_users,
+               DailyStats.start_command_count, DailyStats.profile_completed_count)
+        .outerjoin(DailyStats, DailyStats.date == AnalyticsDaily.date)
+        .order_by(AnalyticsDaily.date)
+    )
+    if start:
+        statement = statement.where(AnalyticsDaily.date >= start)
+    if end:
+        statement = statement.where(AnalyticsDaily.date <= end)
+    for row in stream_rows(statement):
+        yield {
+            'date': row.date,
+            'active_users': row.active_users,
+            'stories': row.stories,
+            'stories_per_user': round(row.stories / row.active_users, 2) if row.active_users else 0.0,
+            'new_users': row.new_users,
+            'start_commands': row.start_command_count or 0,
+            'profiles_completed': row.profile_completed_count or 0,
+        }
+
+
+def iter_request_types(start: Optional[date] = None, end: Optional[date] = None) -> Iterator[Dict[str, Any]]:
+    """Stories per day and request type for days in [start, end], in date order."""
+    statement = (
+        select(AnalyticsRequestType.date, AnalyticsRequestType.request_type, AnalyticsRequestType.stories)
+        .order_by(AnalyticsRequestType.date, AnalyticsRequestType.request_type)
+    )
+    if start:
+        statement = statement.where(AnalyticsRequestType.date >= start)
+    if end:
+        statement = statement.where(AnalyticsRequestType.date <= end)
+    for row in stream_rows(statement):
+        yield {'date': row.date, 'request_type': row.request_type, 'stories': row.stories}
+
+
+def iter_cohorts(start_week: Optional[date] = None, end_week: Optional[date] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Retention cohorts registered in [start_week, end_week], ordered by cohort and week offset.
+    cohort_size is the number of users registered in the cohort week (from analytics_daily).
+    """
+    sizes = (
+        select(_week(AnalyticsDaily.date).label('cohort_week'), func.sum(AnalyticsDaily.new_users).label('cohort_size'))
+        .group_by(_week(AnalyticsDaily.date))
+        .subquery()
+    )
+    statement = (
+        select(AnalyticsCohort.cohort_week, AnalyticsCohort.activity_week, AnalyticsCohort.active_users,
+               sizes.c.cohort_size)
+        .outerjoin(sizes, sizes.c.cohort_week == AnalyticsCohort.cohort_week)
+        .order_by(AnalyticsCohort.cohort_week, AnalyticsCohort.activity_week)
+    )
+    if start_week:
+        statement = statement.where(AnalyticsCohort.cohort_week >= start_week)
+    if end_week:
+        statement = statement.where(AnalyticsCohort.cohort_week <= end_week)
+    for row in stream_rows(statement):
+        cohort_size = row.cohort_size or 0
+        yield {
+            'cohort_week': row.cohort_week,
+            'week': (row.activity_week - row.cohort_week).days // 7,
+            'active_users': row.active_users,
+            'cohort_size': cohort_size,
+            'retention': round(row.active_users / cohort_size, 3) if cohort_size else None,
+        }
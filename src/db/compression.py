@@ -0,0 +1,211 @@
+"""Optional zstd compression of story texts (stories.text_zstd, migration 010).
+
+With STORY_TEXT_COMPRESSION=zstd new stories are stored compressed in text_zstd
+(text stays NULL), using the latest dictionary from story_text_dictionaries when
+one was trained (train_story_dictionary.py). Stories of one user share most of
+their vocabulary and structure, so a dictionary trained on our own corpus
+compresses a 5-10 KB story far better than zstd alone.
+
+Repository functions go through encode_text/decode_text, callers always see str.
+Rows written before compression was enabled (text set, text_zstd NULL) are read
+as is. Reading compressed rows requires zstandard (requirements-compression.txt)
+even if compression of new stories is turned off later.
+"""
+import logging
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import bindparam, desc, insert, select, update
+
+from config import STORY_TEXT_COMPRESSION, STORY_COMPRESSION_LEVEL
+from .session import SessionLocal
+from .models import Story, StoryTextDictionary
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_MODES = ("off", "zstd")
+
+# Dictionary data by id; dictionaries are immutable once stored
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+# Compressor/decompressor objects are not thread-safe: one set per DB worker thread
+_local = threading.local()
+# Dictionary used for new stories: None - not loaded yet, 0 - no dictionary
+_write_dict_id: Optional[int] = None
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError(
+            "zstandard is not installed: pip install -r requirements-compression.txt"
+        ) from e
+    return zstandard
+
+
+def compression_enabled() -> bool:
+    return STORY_TEXT_COMPRESSION == "zstd"
+
+
+def _dictionary(dict_id: int):
+    data = _dictionaries.get(dict_id)
+    if data is None:
+        with _dictionaries_lock:
+            data = _dictionaries.get(dict_id)
+            if data is None:
+                db = SessionLocal()
+                try:
+                    raw = db.execute(
+                        select(StoryTextDictionary.data).where(StoryTextDictionary.id == dict_id)
+                    ).scalar()
+                finally:
+                    db.close()
+                if raw is None:
+                    raise RuntimeError(f"Story text dictionary {dict_id} not found")
+                data = _dictionaries[dict_id] = _zstd().ZstdCompressionDict(bytes(raw))
+    return data
+
+
+def _latest_dictionary_id() -> int:
+    """Id of the newest trained dictionary (0 if none); looked up once per process."""
+    global _write_dict_id
+    if _write_dict_id is None:
+        db = SessionLocal()
+        try:
+            dict_id = db.execute(
+                select(StoryTextDictionary.id).order_by(desc(StoryTextDictionary.id)).limit(1)
+            ).scalar()
+        finally:
+            db.close()
+        _write_dict_id = dict_id or 0
+        logger.info(f"Story text compression: zstd level {STORY_COMPRESSION_LEVEL}, dictionary {_write_dict_id or 'none'}")
+    return _write_dict_id
+
+
+def _compressor(dict_id: int):
+    if not hasattr(_local, 'compressors'):
+        _local.compressors = {}
+    compressors = _local.compressors
+    compressor = compressors.get(dict_id)
+    if compressor is None:
+        zstandard = _zstd()
+        if dict_id:
+            compressor = zstandard.ZstdCompressor(level=STORY_COMPRESSION_LEVEL, dict_data=_dictionary(dict_id))
+        else:
+            compressor = zstandard.ZstdCompressor(level=STORY_COMPRESSION_LEVEL)
+        compressors[dict_id] = compressor
+    return compressor
+
+
+def _decompressor(dict_id: int):
+    if not hasattr(_local, 'decompressors'):
+        _local.decompressors = {}
+    decompressors = _local.decompressors
+    decompressor = decompressors.get(dict_id)
+    if decompressor is None:
+        zstandard = _zstd()
+        if dict_id:
+            decompressor = zstandard.ZstdDecompressor(dict_data=_dictionary(dict_id))
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+        decompressors[dict_id] = decompressor
+    return decompressor
+
+
+def encode_text(text: str) -> Tuple[Optional[str], Optional[bytes], Optional[int]]:
+    """
+    Values for (text, text_zstd, text_dict_id) of a new story.
+    Falls back to plain text if compression is off or fails.
+    """
+    if not compression_enabled():
+        return text, None, None
+    try:
+        dict_id = _latest_dictionary_id()
+        return None, _compressor(dict_id).compress(text.encode('utf-8')), dict_id or None
+    except Exception as e:
+        logger.error(f"Story text compression failed, storing plain text: {e}")
+        return text, None, None
+
+
+def decode_text(text: Optional[str], text_zstd: Optional[bytes], text_dict_id: Optional[int]) -> str:
+    """Story text from the stored columns (plain or compressed)."""
+    if text_zstd is None:
+        return text or ''
+    return _decompressor(text_dict_id or 0).decompress(bytes(text_zstd)).decode('utf-8')
+
+
+def train_dictionary(samples: Sequence[str], dict_size: int = 112 * 1024) -> bytes:
+    """Train a zstd dictionary on story texts; returns the raw dictionary bytes."""
+    zstandard = _zstd()
+    dictionary = zstandard.train_dictionary(dict_size, [sample.encode('utf-8') for sample in samples])
+    return dictionary.as_bytes()
+
+
+def store_dictionary(data: bytes, sample_count: int) -> int:
+    """Save a trained dictionary; it is used for new stories after the bot restarts."""
+    db = SessionLocal()
+    try:
+        dict_id = db.execute(
+            insert(StoryTextDictionary)
+            .values(data=data, sample_count=sample_count)
+            .returning(StoryTextDictionary.id)
+        ).scalar_one()
+        db.commit()
+        return dict_id
+    finally:
+        db.close()
+
+
+def sample_story_texts(limit: int) -> List[str]:
+    """Texts of the latest `limit` stories (compressed ones are decoded)."""
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(Story.text, Story.text_zstd, Story.text_dict_id)
+            .order_by(desc(Story.created_at))
+            .limit(limit)
+            .execution_options(yield_per=500)
+        )
+        return [decode_text(*row) for row in rows]
+    finally:
+        db.close()
+
+
+def compress_existing_stories(dict_id: Optional[int], batch_size: int = 500) -> int:
+    """
+    Compress stories still stored as plain text, in batches of batch_size (one transaction each).
+    Rows are addressed by (id, created_at) so every UPDATE touches a single partition.
+    Returns number of compressed stories.
+    """
+    compressor = _compressor(dict_id or 0)
+    statement = (
+        update(Story)
+        .where(Story.id == bindparam('story_id'), Story.created_at == bindparam('story_created_at'))
+        .values(text=None, text_zstd=bindparam('blob'), text_dict_id=dict_id or None)
+    )
+    total = 0
+    last_id = 0
+    while True:
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(Story.id, Story.created_at, Story.text)
+                .where(Story.text_zstd.is_(None), Story.id > last_id)
+                .order_by(Story.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            db.connection().execute(statement, [
+                {'story_id': row.id, 'story_created_at': row.created_at,
+                 'blob': compressor.compress((row.text or '').encode('utf-8'))}
+                for row in rows
+            ])
+            db.commit()
+        finally:
+            db.close()
+        last_id = rows[-1].id
+        total += len(rows)
+        logger.info(f"Compressed {total} stories")
+    return total
@@ -0,0 +1,85 @@
+"""Streaming exports of raw data for offline analysis (export_data.py).
+
+Every dataset is a single SELECT in date order read through a server-side cursor
+(stream_rows), so exporting millions of stories keeps memory constant. Date filters
+go on stories.created_at, which lets PostgreSQL skip whole monthly partitions
+(see partitions.py); story texts are never read.
+
+- stories: story metadata (who, when, which button, model, delivery status);
+- latency: per-stage timings of each story (Agent 1, generation, delivery);
+- daily_stats: the daily counters.
+"""
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from .models import DailyStats, Story
+from .session import stream_rows
+
+# Column types used by the Parquet writer: 'int', 'str', 'bool', 'date', 'datetime'
+Columns = List[Tuple[str, str]]
+
+
+def _story_range(statement, start: Optional[date], end: Optional[date]):
+    """Stories created on days [start, end]; open-ended if a bound is None."""
+    if start:
+        statement = statement.where(Story.created_at >= datetime.combine(start, datetime.min.time()))
+    if end:
+        statement = statement.where(Story.created_at < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+    return statement.order_by(Story.created_at, Story.id)
+
+
+def _stories(start: Optional[date], end: Optional[date]):
+    return _story_range(select(
+        Story.id, Story.user_id, Story.created_at, Story.request_type, Story.model, Story.delivery_status,
+        Story.text_zstd.is_not(None), Story.reflection_questions.is_not(None),
+    ), start, end)
+
+
+def _latency(start: Optional[date], end: Optional[date]):
+    return _story_range(select(
+        Story.id, Story.created_at, Story.request_type, Story.delivery_status,
+        Story.agent_ms, Story.generation_ms, Story.delivery_ms,
+    ), start, end)
+
+
+def _daily_stats(start: Optional[date], end: Optional[date]):
+    statement = select(
+        DailyStats.date, DailyStats.stories_count, DailyStats.new_users_count,
+        DailyStats.start_command_count, DailyStats.profile_completed_count,
+    ).order_by(DailyStats.date)
+    if start:
+        statement = statement.where(DailyStats.date >= start)
+    if end:
+        statement = statement.where(DailyStats.date <= end)
+    return statement
+
+
+# Dataset -> (query builder for days [start, end], columns in query order)
+DATASETS: Dict[str, Tuple[Callable, Columns]] = {
+    'stories': (_stories, [
+        ('id', 'int'), ('user_id', 'int'), ('created_at', 'datetime'), ('request_type', 'str'),
+        ('model', 'str'), ('delivery_status', 'str'), ('compressed', 'bool'), ('has_reflection_questions', 'bool'),
+    ]),
+    'latency': (_latency, [
+        ('story_id', 'int'), ('created_at', 'datetime'), ('request_type', 'str'), ('delivery_status', 'str'),
+        ('agent_ms', 'int'), ('generation_ms', 'int'), ('delivery_ms', 'int'),
+    ]),
+    'daily_stats': (_daily_stats, [
+        ('date', 'date'), ('stories', 'int'), ('new_users', 'int'),
+        ('start_commands', 'int'), ('profiles_completed', 'int'),
+    ]),
+}
+
+
+def export_columns(dataset: str) -> Columns:
+    return DATASETS[dataset][1]
+
+
+def iter_export_rows(dataset: str, start: Optional[date] = None, end: Optional[date] = None,
+                     batch_size: int = 5000) -> Iterator[Tuple[Any, ...]]:
+    """Rows of a dataset for days [start, end] as tuples in export_columns() order, oldest first."""
+    build, _ = DATASETS[dataset]
+    for row in stream_rows(build(start, end), batch_size=batch_size):
+        yield tuple(row)
@@ -1,5 +1,5 @@
 """SQLAlchemy ORM models."""
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, BigInteger, Date
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, BigInteger, Date, JSON, LargeBinary, CheckConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -19,12 +19,15 @@ class User(Base):
     wishes = Column(Text, nullable=True)
     feedback = Column(Text, nullable=True)
     story_total = Column(Integer, default=0, nullable=False)
+    # Версия профиля: увеличивается при каждом изменении (для compare-and-set в patch_user_profile)
+    version = Column(Integer, default=1, server_default='1', nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
     # Relationships
-    stories = relationship("Story", back_populates="user", cascade="all, delete-orphan")
-    contexts = relationship("Context", back_populates="user", cascade="all, delete-orphan")
+    # passive_deletes: связанные строки удаляет БД (ON DELETE CASCADE), ORM их не загружает
+    stories = relationship("Story", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
+    contexts = relationship("Context", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
     __table_args__ = (
         Index('ix_users_telegram_id', 'telegram_id', unique=True),
@@ -43,19 +46,38 @@ class User(Base):
             'wishes': self.wishes or '',
             'feedback': self.feedback or '',
             'story_total': self.story_total,
+            'version': self.version,
             'created_at': self.created_at.isoformat() if self.created_at else '',
             'updated_at': self.updated_at.isoformat() if self.updated_at else '',
         }
 
 
 class Story(Base):
-    """Story model."""
+    """
+    Story model.
+    In PostgreSQL the table is partitioned by month on created_at (migration 009):
+    the primary key there is (id, created_at), id is still unique via its sequence.
+    """
     __tablename__ = "stories"
 
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(BigInteger, ForeignKey("users.telegram_id", ondelete="CASCADE"), nullable=False, index=True)
-    text = Column(Text, nullable=False)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.telegram_id", ondelete="CASCADE"), nullable=False)
+    # Текст хранится либо как есть (text), либо сжатым zstd (text_zstd, см. db.compression)
+    text = Column(Text, nullable=True)
+    text_zstd = Column(LargeBinary, nullable=True)
+    # Словарь zstd из story_text_dictionaries; NULL - сжато без словаря
+    text_dict_id = Column(Integer, nullable=True)
     model = Column(String(50), default='deepseek', nullable=False)
+    # Откуда запрошена сказка: 'regular' (сообщение), 'new_dilemma', 'random_moral' и т.д.; NULL - до миграции 011
+    request_type = Column(String(30), nullable=True)
+    # 'pending' - сохранена, но еще не отправлена; 'delivered' - отправлена; 'failed' - отправка не удалась
+    delivery_status = Column(String(20), default='pending', server_default='pending', nullable=False)
+    # Длительность этапов, мс: Agent 1, генерация DeepSeek, отправка в Telegram (NULL - этап не выполнялся)
+    agent_ms = Column(Integer, nullable=True)
+    generation_ms = Column(Integer, nullable=True)
+    delivery_ms = Column(Integer, nullable=True)
+    # Вопросы для размышлений, заранее сгенерированные после доставки (список строк)
+    reflection_questions = Column(JSON, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
 
     # Relationships
@@ -63,9 +85,20 @@ class Story(Base):
 
     __table_args__ = (
         Index('ix_stories_user_created', 'user_id', 'created_at'),
+        CheckConstraint('text IS NOT NULL OR text_zstd IS NOT NULL', name='ck_stories_text_present'),
     )
 
 
+class StoryTextDictionary(Base):
+    """zstd dictionary trained on story texts (train_story_dictionary.py)."""
+    __tablename__ = "story_text_dictionaries"
+
+    id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    sample_count = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
 class Context(Base):
     """Context model."""
     __tablename__ = "contexts"
@@ -108,3 +141,39 @@ class DailyStats(Base):
             'updated_at': self.updated_at.isoformat() if self.updated_at else '',
         }
 
+
+class AnalyticsDaily(Base):
+    """Per-day activity computed from stories and users (db.analytics)."""
+    __tablename__ = "analytics_daily"
+
+    date = Column(Date, primary_key=True)
+    active_users = Column(Integer, nullable=False)
+    stories = Column(Integer, nullable=False)
+    new_users = Column(Integer, nullable=False)
+
+
+class AnalyticsRequestType(Base):
+    """Stories per day and request type (which button or message produced them)."""
+    __tablename__ = "analytics_request_types"
+
+    date = Column(Date, primary_key=True)
+    request_type = Column(String(30), primary_key=True)
+    stories = Column(Integer, nullable=False)
+
+
+class AnalyticsCohort(Base):
+    """Users registered in cohort_week who received a story in activity_week."""
+    __tablename__ = "analytics_cohorts"
+
+    cohort_week = Column(Date, primary_key=True)
+    activity_week = Column(Date, primary_key=True, index=True)
+    active_users = Column(Integer, nullable=False)
+
+
+class AnalyticsRefreshState(Base):
+    """How far the analytics tables are final: days before refreshed_until are not recomputed."""
+    __tablename__ = "analytics_refresh_state"
+
+    name = Column(String(50), primary_key=True)
+    refreshed_until = Column(Date, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
@@ -0,0 +1,110 @@
+"""Monthly partitions of the stories table (PostgreSQL, see migration 009).
+
+Each month lives in its own partition stories_pYYYYMM; rows outside them land in
+stories_default. Retention is enforced by dropping whole partitions, so saving a
+story is a pure append and old history goes away without per-row deletes.
+"""
+import logging
+import re
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+
+from .session import engine
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = "stories"
+DEFAULT_PARTITION = "stories_default"
+
+_PARTITION_RE = re.compile(r"^stories_p(\d{4})(\d{2})$")
+
+
+def month_start(value) -> date:
+    """First day of the month containing value."""
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    """First day of the month `months` after (or before, if negative) the given one."""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"stories_p{month:%Y%m}"
+
+
+def list_story_partitions(conn) -> Dict[date, str]:
+    """Map month -> partition name for the monthly partitions attached to stories."""
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:parent AS regclass)"
+    ), {"parent": PARENT_TABLE}).scalars()
+    partitions = {}
+    for name in rows:
+        match = _PARTITION_RE.match(name)
+        if match:
+            partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def _create_partition(conn, month: date):
+    """
+    Create and attach the partition for one month.
+    Rows that already fell into stories_default for that month are moved into it first,
+    otherwise ATTACH PARTITION would fail on the overlapping default rows.
+    CHECK constraints are copied too: ATTACH PARTITION requires every constraint of the
+    parent (e.g. ck_stories_text_present from migration 010) to exist on the new table.
+    """
+    name = partition_name(month)
+    lower, upper = month.isoformat(), add_months(month, 1).isoformat()
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)"))
+    moved = conn.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+        f"WHERE created_at >= :lower AND created_at < :upper RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ), {"lower": lower, "upper": upper}).rowcount
+    conn.execute(text(
+        f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{lower}') TO ('{upper}')"
+    ))
+    logger.info(f"Created partition {name}" + (f", moved {moved} rows from {DEFAULT_PARTITION}" if moved else ""))
+
+
+def maintain_story_partitions(retention_months: int, months_ahead: int = 2,
+                              now: Optional[datetime] = None, dry_run: bool = False) -> Dict[str, List[str]]:
+    """
+    Create partitions up to months_ahead months after the current one and drop partitions
+    that ended more than retention_months months ago (retention_months <= 0 keeps everything).
+    Each partition is created or dropped in its own short transaction.
+    Returns {'created': [...], 'dropped': [...]} (what would be done if dry_run).
+    """
+    current = month_start(now or datetime.utcnow())
+    result = {'created': [], 'dropped': []}
+
+    with engine.connect() as conn:
+        partitions = list_story_partitions(conn)
+
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if month in partitions:
+            continue
+        result['created'].append(partition_name(month))
+        if not dry_run:
+            with engine.begin() as conn:
+                _create_partition(conn, month)
+
+    if retention_months > 0:
+        # Partition for month M holds rows up to the start of M + 1
+        cutoff = add_months(current, -retention_months)
+        for month, name in sorted(partitions.items()):
+            if add_months(month, 1) > cutoff:
+                break
+            result['dropped'].append(name)
+            if not dry_run:
+                with engine.begin() as conn:
+                    conn.execute(text(f"DROP TABLE {name}"))
+                logger.info(f"Dropped partition {name} (retention {retention_months} months)")
+
+    return result
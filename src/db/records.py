@@ -0,0 +1,128 @@
+"""Lightweight records returned by repository projection queries (no ORM hydration)."""
+from collections.abc import Mapping
+from typing import Any, Iterator, NamedTuple
+
+from .models import User
+
+
+# Columns selected for a full profile, in UserProfile constructor order
+PROFILE_COLUMNS = (
+    User.telegram_id,
+    User.username,
+    User.child_names,
+    User.age,
+    User.traits,
+    User.context_active,
+    User.wishes,
+    User.feedback,
+    User.story_total,
+    User.version,
+    User.created_at,
+    User.updated_at,
+)
+
+
+class UserProfile(Mapping):
+    """
+    User profile stored in __slots__ instead of a dict.
+    Read-only mapping with the same keys as User.to_dict(), so handlers keep using
+    profile.get('age') and profile['version']; timestamps are formatted only on access.
+    """
+    __slots__ = (
+        'telegram_id', 'username', 'child_names', 'age', 'traits', 'context_active',
+        'wishes', 'feedback', 'story_total', 'version', '_created_at', '_updated_at',
+    )
+
+    KEYS = (
+        'user_id', 'telegram_id', 'username', 'child_names', 'age', 'traits', 'context_active',
+        'wishes', 'feedback', 'story_total', 'version', 'created_at', 'updated_at',
+    )
+
+    def __init__(self, telegram_id, username, child_names, age, traits, context_active,
+                 wishes, feedback, story_total, version, created_at, updated_at):
+        self.telegram_id = telegram_id
+        self.username = username or ''
+        self.child_names = child_names or ''
+        self.age = age or ''
+        self.traits = traits or ''
+        self.context_active = context_active or ''
+        self.wishes = wishes or ''
+        self.feedback = feedback or ''
+        self.story_total = story_total
+        self.version = version
+        self._created_at = created_at
+        self._updated_at = updated_at
+
+    @classmethod
+    def from_row(cls, row) -> "UserProfile":
+        """Build profile from a row selected with PROFILE_COLUMNS."""
+        return cls(*row)
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'user_id':
+            return str(self.telegram_id)
+        if key in ('created_at', 'updated_at'):
+            value = getattr(self, '_' + key)
+            return value.isoformat() if value else ''
+        if key in self.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.KEYS)
+
+    def __len__(self) -> int:
+        return len(self.KEYS)
+
+    def to_dict(self) -> dict:
+        """Convert profile to a plain dictionary."""
+        return dict(self)
+
+    def __repr__(self) -> str:
+        return f"UserProfile(telegram_id={self.telegram_id}, version={self.version})"
+
+
+# Columns needed to build a story prompt, in GenerationProfile field order
+GENERATION_COLUMNS = (
+    User.telegram_id,
+    User.child_names,
+    User.age,
+    User.traits,
+    User.context_active,
+    User.wishes,
+    User.story_total,
+    User.version,
+)
+
+
+class GenerationProfile(NamedTuple):
+    """Prompt-relevant profile columns only (tuple-backed, no large feedback column)."""
+    telegram_id: int
+    child_names: str
+    age: str
+    traits: str
+    context_active: str
+    wishes: str
+    story_total: int
+    version: int
+
+    @classmethod
+    def from_row(cls, row) -> "GenerationProfile":
+        """Build record from a row selected with GENERATION_COLUMNS (NULL text becomes '')."""
+        telegram_id, child_names, age, traits, context_active, wishes, story_total, version = row
+        return cls(
+            telegram_id,
+            child_names or '',
+            age or '',
+            traits or '',
+            context_active or '',
+            wishes or '',
+            story_total or 0,
+            version,
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Dict-style access, so the record can be passed where a profile is expected."""
+        if key in self._fields:
+            return getattr(self, key)
+        return default
@@ -1,12 +1,16 @@
 """Database repository functions."""
 import logging
-from typing import Optional, Dict, Any, List
-from datetime import datetime, date
+from typing import Optional, Dict, Any, List, Tuple
+from datetime import datetime, date, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
+from sqlalchemy import desc, func, update, delete, select
 
-from .session import SessionLocal
+from config import STORY_LOOKUP_DAYS
+
+from .session import SessionLocal, track_queries
 from .models import User, Story, Context, DailyStats
+from .compression import encode_text, decode_text
+from .records import UserProfile, PROFILE_COLUMNS, GenerationProfile, GENERATION_COLUMNS
 
 logger = logging.getLogger(__name__)
 
@@ -20,16 +24,18 @@ def get_db() -> Session:
         db.close()
 
 
-def get_user(telegram_id: int) -> Optional[Dict[str, Any]]:
+@track_queries
+def get_user(telegram_id: int) -> Optional[UserProfile]:
     """
     Get user by telegram_id.
-    Returns user dict or None if not found.
+    Selects profile columns directly (no ORM object).
+    Returns UserProfile (read like a dict) or None if not found.
     """
     db = SessionLocal()
     try:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
-        if user:
-            return user.to_dict()
+        row = db.execute(select(*PROFILE_COLUMNS).where(User.telegram_id == telegram_id)).first()
+        if row:
+            return UserProfile.from_row(row)
         return None
     except Exception as e:
         logger.error(f"Ошибка получения пользователя {telegram_id}: {e}")
@@ -38,6 +44,44 @@ def get_user(telegram_id: int) -> Optional[Dict[str, Any]]:
         db.close()
 
 
+@track_queries
+def user_exists(telegram_id: int) -> bool:
+    """
+    Check whether user profile exists without loading any profile columns.
+    Returns False on error.
+    """
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(User.telegram_id).where(User.telegram_id == telegram_id).limit(1)
+        ).first() is not None
+    except Exception as e:
+        logger.error(f"Ошибка проверки пользователя {telegram_id}: {e}")
+        return False
+    finally:
+        db.close()
+
+
+@track_queries
+def get_generation_profile(telegram_id: int) -> Optional[GenerationProfile]:
+    """
+    Get only the profile columns used to build a story prompt.
+    Returns GenerationProfile or None if not found.
+    """
+    db = SessionLocal()
+    try:
+        row = db.execute(select(*GENERATION_COLUMNS).where(User.telegram_id == telegram_id)).first()
+        if row:
+            return GenerationProfile.from_row(row)
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка получения профиля для генерации {telegram_id}: {e}")
+        return None
+    finally:
+        db.close()
+
+
+@track_queries
 def upsert_user_profile(
     telegram_id: int,
     username: str,
@@ -62,6 +106,7 @@ def upsert_user_profile(
             user.traits = traits
             if context_active is not None:
                 user.context_active = context_active
+            user.version += 1
             user.updated_at = datetime.utcnow()
         else:
             # Create new user
@@ -91,6 +136,7 @@ def upsert_user_profile(
         db.close()
 
 
+@track_queries
 def update_user_fields(telegram_id: int, **fields) -> bool:
     """
     Update user fields dynamically.
@@ -108,6 +154,7 @@ def update_user_fields(telegram_id: int, **fields) -> bool:
             if hasattr(user, key):
                 setattr(user, key, value)
         
+        user.version += 1
         user.updated_at = datetime.utcnow()
         db.commit()
         logger.info(f"Поля пользователя {telegram_id} обновлены: {list(fields.keys())}")
@@ -120,6 +167,63 @@ def update_user_fields(telegram_id: int, **fields) -> bool:
         db.close()
 
 
+# Fields that patch_user_profile may change
+_PATCHABLE_USER_FIELDS = frozenset(
+    column.name for column in User.__table__.columns
+) - {'telegram_id', 'version', 'created_at', 'updated_at'}
+
+
+@track_queries
+def patch_user_profile(
+    telegram_id: int,
+    fields: Dict[str, Any],
+    expected_version: Optional[int] = None
+) -> Tuple[Optional[UserProfile], bool]:
+    """
+    Patch user fields with a single UPDATE ... RETURNING and bump the profile version.
+    If expected_version is given, the patch applies only to that version (compare-and-set).
+    Returns (profile, conflict):
+    - (new profile, False) on success, no re-read needed;
+    - (current profile or None if deleted, True) on version conflict;
+    - (None, False) if the user does not exist or on error.
+    """
+    values = {key: value for key, value in fields.items() if key in _PATCHABLE_USER_FIELDS}
+    db = SessionLocal()
+    try:
+        stmt = update(User).where(User.telegram_id == telegram_id)
+        if expected_version is not None:
+            stmt = stmt.where(User.version == expected_version)
+        stmt = stmt.values(
+            **values,
+            version=User.version + 1,
+            updated_at=datetime.utcnow()
+        ).returning(*PROFILE_COLUMNS)
+        
+        row = db.execute(stmt).first()
+        if row is None:
+            db.rollback()
+            if expected_version is None:
+                logger.warning(f"Пользователь {telegram_id} не найден для обновления")
+                return None, False
+            current = db.execute(select(*PROFILE_COLUMNS).where(User.telegram_id == telegram_id)).first()
+            current = UserProfile.from_row(current) if current else None
+            logger.info(f"Конфликт версий профиля {telegram_id}: ожидалась {expected_version}, "
+                        f"текущая {current.version if current else 'профиль удален'}")
+            return current, True
+        
+        profile = UserProfile.from_row(row)
+        db.commit()
+        logger.info(f"Поля пользователя {telegram_id} обновлены: {list(values.keys())}, версия {profile['version']}")
+        return profile, False
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка обновления профиля пользователя {telegram_id}: {e}")
+        return None, False
+    finally:
+        db.close()
+
+
+@track_queries
 def increment_story_total(telegram_id: int) -> int:
     """
     Increment story_total for user and return new total.
@@ -145,85 +249,194 @@ def increment_story_total(telegram_id: int) -> int:
         db.close()
 
 
-def save_story(telegram_id: int, story_text: str, model: str = 'deepseek') -> bool:
+@track_queries
+def save_story(telegram_id: int, story_text: str, model: str = 'deepseek',
+               request_type: Optional[str] = None, agent_ms: Optional[int] = None,
+               generation_ms: Optional[int] = None) -> Optional[int]:
     """
-    Save story, increment story_total, and trim to last 5 stories.
-    Returns True on success, False on error.
+    Save story and increment story_total (two statements: UPDATE users, INSERT story).
+    Stories are append-only: old ones are removed by dropping monthly partitions
+    (db.partitions), not on every save. With STORY_TEXT_COMPRESSION=zstd the text
+    is stored compressed (db.compression); readers always get plain text back.
+    The story is saved with delivery_status='pending'; request_type records which
+    button or message produced it (for analytics), agent_ms/generation_ms - how long
+    Agent 1 and generation took (delivery_ms is set by set_story_delivery_status).
+    Returns story id on success, None on error.
     """
     db = SessionLocal()
     try:
-        # Create story
+        # Increment story_total (also checks that the user exists)
+        updated = db.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id)
+            .values(story_total=User.story_total + 1)
+        ).rowcount
+        if not updated:
+            logger.warning(f"Пользователь {telegram_id} не найден при сохранении сказки")
+            db.rollback()
+            return None
+        
+        text, text_zstd, text_dict_id = encode_text(story_text)
         story = Story(
             user_id=telegram_id,
-            text=story_text,
-            model=model
+            text=text,
+            text_zstd=text_zstd,
+            text_dict_id=text_dict_id,
+            model=model,
+            request_type=request_type,
+            agent_ms=agent_ms,
+            generation_ms=generation_ms
         )
         db.add(story)
-        
-        # Increment story_total
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
-        if user:
-            user.story_total += 1
-        else:
-            logger.warning(f"Пользователь {telegram_id} не найден при сохранении сказки")
-            db.rollback()
-            return False
-        
-        # Flush to get story ID, then trim
         db.flush()
-        
-        # Trim to last 5 stories (before commit)
-        _trim_stories(db, telegram_id, limit=5)
+        story_id = story.id
         
         db.commit()
-        logger.info(f"Сказка сохранена для пользователя {telegram_id}")
-        return True
+        logger.info(f"Сказка {story_id} сохранена для пользователя {telegram_id}")
+        return story_id
     except Exception as e:
         db.rollback()
         logger.error(f"Ошибка сохранения сказки для пользователя {telegram_id}: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def _recent_story(story_id: int):
+    """
+    Filter for a story by id among stories of the last STORY_LOOKUP_DAYS days.
+    The id alone does not say which monthly partition holds the row, so PostgreSQL
+    would probe every partition; the created_at bound lets it skip the older ones.
+    Stories looked up by id are recent: just saved, just delivered or resent.
+    """
+    since = datetime.utcnow() - timedelta(days=STORY_LOOKUP_DAYS)
+    return (Story.id == story_id) & (Story.created_at >= since)
+
+
+@track_queries
+def set_story_delivery_status(story_id: int, status: str, delivery_ms: Optional[int] = None) -> bool:
+    """
+    Set delivery status of a story: 'pending', 'delivered' or 'failed'.
+    delivery_ms (how long sending to Telegram took) is stored if given.
+    Only stories of the last STORY_LOOKUP_DAYS days are updated (see _recent_story).
+    Returns True on success, False on error.
+    """
+    values = {Story.delivery_status: status}
+    if delivery_ms is not None:
+        values[Story.delivery_ms] = delivery_ms
+    db = SessionLocal()
+    try:
+        updated = db.query(Story).filter(_recent_story(story_id)).update(
+            values, synchronize_session=False
+        )
+        db.commit()
+        return updated > 0
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка обновления статуса доставки сказки {story_id}: {e}")
         return False
     finally:
         db.close()
 
 
-def _trim_stories(db: Session, telegram_id: int, limit: int = 5):
+@track_queries
+def get_story(telegram_id: int, story_id: int) -> Optional[Dict[str, Any]]:
     """
-    Keep only last N stories for user, delete older ones.
-    Note: does not commit, should be called within a transaction.
+    Get story by id, only if it belongs to the user and was created within
+    the last STORY_LOOKUP_DAYS days (see _recent_story).
+    Returns story dict or None if not found.
+    """
+    db = SessionLocal()
+    try:
+        story = db.execute(
+            select(Story.id, Story.user_id, Story.text, Story.text_zstd, Story.text_dict_id,
+                   Story.model, Story.delivery_status, Story.created_at)
+            .where(_recent_story(story_id), Story.user_id == telegram_id)
+        ).first()
+        if not story:
+            return None
+        return {
+            'id': story.id,
+            'user_id': story.user_id,
+            'text': decode_text(story.text, story.text_zstd, story.text_dict_id),
+            'model': story.model,
+            'delivery_status': story.delivery_status,
+            'created_at': story.created_at.isoformat() if story.created_at else '',
+        }
+    except Exception as e:
+        logger.error(f"Ошибка получения сказки {story_id} для пользователя {telegram_id}: {e}")
+        return None
+    finally:
+        db.close()
+
+
+@track_queries
+def set_story_reflection_questions(story_id: int, questions: List[str]) -> bool:
+    """
+    Store pre-generated reflection questions for a story
+    (of the last STORY_LOOKUP_DAYS days, see _recent_story).
+    Returns True on success, False on error.
+    """
+    db = SessionLocal()
+    try:
+        updated = db.query(Story).filter(_recent_story(story_id)).update(
+            {Story.reflection_questions: questions}, synchronize_session=False
+        )
+        db.commit()
+        return updated > 0
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка сохранения вопросов для сказки {story_id}: {e}")
+        return False
+    finally:
+        db.close()
+
+
+@track_queries
+def get_latest_story_reflection(telegram_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Get id and stored reflection questions of the user's latest story.
+    The story text is not loaded.
+    Returns {'id', 'reflection_questions'} or None if the user has no stories.
     """
+    db = SessionLocal()
     try:
-        # Get all stories for user, ordered by created_at DESC
-        stories = db.query(Story).filter(
+        row = db.query(Story.id, Story.reflection_questions).filter(
             Story.user_id == telegram_id
-        ).order_by(desc(Story.created_at)).all()
-        
-        if len(stories) > limit:
-            # Delete oldest stories (keep last N)
-            stories_to_delete = stories[limit:]
-            for story in stories_to_delete:
-                db.delete(story)
-            logger.info(f"Помечено к удалению {len(stories_to_delete)} старых сказок для пользователя {telegram_id}")
+        ).order_by(desc(Story.created_at)).first()
+        if not row:
+            return None
+        return {'id': row.id, 'reflection_questions': row.reflection_questions}
     except Exception as e:
-        logger.error(f"Ошибка trim сказок для пользователя {telegram_id}: {e}")
-        raise
+        logger.error(f"Ошибка получения вопросов последней сказки для пользователя {telegram_id}: {e}")
+        return None
+    finally:
+        db.close()
 
 
+@track_queries
 def get_last_stories(telegram_id: int, limit: int = 5) -> List[Dict[str, Any]]:
     """
-    Get last N stories for user.
+    Get last N stories for user, newest first.
+    Reads ix_stories_user_created backwards (in every partition) and stops after N rows,
+    so the cost does not grow with the user's history.
     Returns list of story dicts.
     """
     db = SessionLocal()
     try:
-        stories = db.query(Story).filter(
-            Story.user_id == telegram_id
-        ).order_by(desc(Story.created_at)).limit(limit).all()
+        stories = db.execute(
+            select(Story.id, Story.user_id, Story.text, Story.text_zstd, Story.text_dict_id,
+                   Story.model, Story.created_at)
+            .where(Story.user_id == telegram_id)
+            .order_by(desc(Story.created_at))
+            .limit(limit)
+        ).all()
         
         return [
             {
                 'id': story.id,
                 'user_id': story.user_id,
-                'text': story.text,
+                'text': decode_text(story.text, story.text_zstd, story.text_dict_id),
                 'model': story.model,
                 'created_at': story.created_at.isoformat() if story.created_at else '',
             }
@@ -236,6 +449,7 @@ def get_last_stories(telegram_id: int, limit: int = 5) -> List[Dict[str, Any]]:
         db.close()
 
 
+@track_queries
 def add_context(telegram_id: int, kind: str, content: str) -> bool:
     """
     Add context (active or archived).
@@ -287,6 +501,7 @@ def _trim_contexts(db: Session, telegram_id: int, kind: str, limit: int = 5):
         raise
 
 
+@track_queries
 def get_active_context(telegram_id: int) -> Optional[str]:
     """
     Get active context for user.
@@ -309,19 +524,21 @@ def get_active_context(telegram_id: int) -> Optional[str]:
         db.close()
 
 
+@track_queries
 def delete_user_profile(telegram_id: int) -> bool:
     """
     Delete user profile and all related stories and contexts.
+    Uses a single DELETE; stories and contexts are removed by ON DELETE CASCADE in the database.
     Returns True on success, False on error.
     """
     db = SessionLocal()
     try:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
+        result = db.execute(delete(User).where(User.telegram_id == telegram_id))
+        if result.rowcount == 0:
+            db.rollback()
             logger.warning(f"Пользователь {telegram_id} не найден для удаления")
             return False
         
-        db.delete(user)  # Cascade will delete stories and contexts
         db.commit()
         logger.info(f"Профиль пользователя {telegram_id} и все связанные данные удалены")
         return True
@@ -333,8 +550,56 @@ def delete_user_profile(telegram_id: int) -> bool:
         db.close()
 
 
+@track_queries
+def purge_inactive_users(inactive_days: int, batch_size: int = 500, dry_run: bool = False) -> int:
+    """
+    Delete users whose profile has not been updated for inactive_days (saving a story
+    also updates the profile), together with their stories and contexts.
+    Works in batches, each in its own short transaction; rows locked by the bot are skipped.
+    Returns number of deleted users (or number of candidates if dry_run).
+    """
+    cutoff = datetime.utcnow() - timedelta(days=inactive_days)
+    inactive = User.updated_at < cutoff
+    
+    if dry_run:
+        db = SessionLocal()
+        try:
+            return db.query(func.count(User.telegram_id)).filter(inactive).scalar() or 0
+        finally:
+            db.close()
+    
+    total = 0
+    while True:
+        db = SessionLocal()
+        try:
+            batch = (
+                select(User.telegram_id)
+                .where(inactive)
+                .order_by(User.telegram_id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            result = db.execute(delete(User).where(User.telegram_id.in_(batch)))
+            db.commit()
+            deleted = result.rowcount or 0
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка удаления неактивных пользователей: {e}")
+            break
+        finally:
+            db.close()
+        
+        total += deleted
+        logger.info(f"Удалено неактивных пользователей: {deleted} (всего {total})")
+        if deleted < batch_size:
+            break
+    
+    return total
+
+
 # ==================== Daily Statistics ====================
 
+@track_queries
 def increment_daily_stat(stat_type: str, increment: int = 1, target_date: Optional[date] = None) -> bool:
     """
     Increment daily statistic counter.
@@ -385,6 +650,7 @@ def increment_daily_stat(stat_type: str, increment: int = 1, target_date: Option
         db.close()
 
 
+@track_queries
 def get_daily_stats(start_date: Optional[date] = None, end_date: Optional[date] = None, limit: int = 30) -> List[Dict[str, Any]]:
     """
     Get daily statistics for date range.
@@ -410,6 +676,7 @@ def get_daily_stats(start_date: Optional[date] = None, end_date: Optional[date]
         db.close()
 
 
+@track_queries
 def get_daily_stats_summary() -> Dict[str, Any]:
     """
     Get summary statistics across all days.
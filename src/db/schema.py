@@ -0,0 +1,107 @@
+"""Schema revision check against the Alembic migrations bundled with the code."""
+import functools
+import logging
+import re
+from typing import Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from config import BASE_DIR
+from .session import engine
+
+logger = logging.getLogger(__name__)
+
+ALEMBIC_INI = BASE_DIR / "alembic.ini"
+VERSIONS_DIR = BASE_DIR / "alembic" / "versions"
+
+SCHEMA_CHECK_MODES = ("fail", "warn", "upgrade", "off")
+
+_REVISION_RE = re.compile(r"^revision\s*=\s*['\"]([^'\"]+)['\"]", re.MULTILINE)
+_DOWN_REVISION_RE = re.compile(r"^down_revision\s*=\s*(?:['\"]([^'\"]+)['\"]|None)", re.MULTILINE)
+
+
+class SchemaOutOfDateError(RuntimeError):
+    """Database schema is behind the migrations bundled with the code."""
+
+
+@functools.lru_cache(maxsize=1)
+def bundled_revisions() -> Dict[str, Optional[str]]:
+    """
+    Map revision -> down_revision for the bundled migration files.
+    Files are read as text (migration modules are not imported), once per process.
+    """
+    revisions = {}
+    for path in sorted(VERSIONS_DIR.glob("*.py")):
+        source = path.read_text(encoding="utf-8")
+        revision = _REVISION_RE.search(source)
+        down_revision = _DOWN_REVISION_RE.search(source)
+        if revision and down_revision:
+            revisions[revision.group(1)] = down_revision.group(1)
+    return revisions
+
+
+def bundled_head() -> str:
+    """The single head revision of the bundled migrations."""
+    revisions = bundled_revisions()
+    heads = set(revisions) - set(revisions.values())
+    if len(heads) != 1:
+        raise RuntimeError(f"Expected one Alembic head in {VERSIONS_DIR}, found: {sorted(heads)}")
+    return heads.pop()
+
+
+def current_revision() -> Optional[str]:
+    """
+    Revision recorded in alembic_version (one SELECT).
+    Returns None if the database was never migrated.
+    """
+    with engine.connect() as conn:
+        try:
+            return conn.execute(text("SELECT version_num FROM alembic_version")).scalar()
+        except DBAPIError as e:
+            if "alembic_version" in str(e):
+                return None
+            raise
+
+
+def upgrade_to_head():
+    """Apply all pending migrations (alembic upgrade head)."""
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(str(ALEMBIC_INI))
+    config.set_main_option("script_location", str(BASE_DIR / "alembic"))
+    command.upgrade(config, "head")
+
+
+def check_schema(mode: str = "fail") -> Optional[str]:
+    """
+    Compare the database revision with the bundled head.
+    mode: 'fail' raises SchemaOutOfDateError, 'warn' only logs, 'upgrade' applies
+    pending migrations, 'off' skips the check.
+    A database that is ahead of the code (unknown revision during a rolling
+    deploy) is logged and accepted. Returns the revision the database is at.
+    """
+    if mode == "off":
+        return None
+    if mode not in SCHEMA_CHECK_MODES:
+        raise ValueError(f"Unknown schema check mode: {mode} (expected one of {SCHEMA_CHECK_MODES})")
+
+    head = bundled_head()
+    current = current_revision()
+    if current == head:
+        logger.info(f"Database schema is at head revision {head}")
+        return current
+    if current is not None and current not in bundled_revisions():
+        logger.warning(f"Database schema revision {current} is newer than bundled head {head}, continuing")
+        return current
+
+    message = f"Database schema revision {current or '(none)'} is behind bundled head {head}"
+    if mode == "upgrade":
+        logger.warning(f"{message}, applying migrations")
+        upgrade_to_head()
+        return head
+    if mode == "warn":
+        logger.warning(f"{message}; run: python apply_migrations.py")
+        return current
+    raise SchemaOutOfDateError(f"{message}; run: python apply_migrations.py")
@@ -1,13 +1,20 @@
 """Database session configuration."""
-import os
-from sqlalchemy import create_engine
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from dotenv import load_dotenv
 
-load_dotenv()
+# .env is loaded once, by config
+from config import DATABASE_URL, DB_QUERY_INSTRUMENTATION, DB_SLOW_QUERY_MS
 
-from config import DATABASE_URL
+logger = logging.getLogger(__name__)
 
 # Create engine
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
@@ -18,3 +25,169 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Create Base class for models
 Base = declarative_base()
 
+STREAM_BATCH_SIZE = 1000
+
+
+def stream_rows(statement, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[Any]:
+    """
+    Rows of a SELECT fetched in batches through a server-side cursor (yield_per),
+    so memory stays constant however many rows the query returns.
+    """
+    db = SessionLocal()
+    try:
+        yield from db.execute(statement.execution_options(yield_per=batch_size))
+    finally:
+        db.close()
+
+
+# ==================== Query instrumentation ====================
+
+class QueryScope:
+    """Statements issued while handling one unit of work (e.g. one Telegram update)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.statements = 0
+        self.db_ms = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed_ms: float):
+        with self._lock:
+            self.statements += 1
+            self.db_ms += elapsed_ms
+
+
+class QueryStats:
+    """Per-repository-function counters: calls, statements, time in DB, slow statements."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._functions: Dict[str, Dict[str, Any]] = {}
+
+    def _entry(self, name: str) -> Dict[str, Any]:
+        entry = self._functions.get(name)
+        if entry is None:
+            entry = self._functions[name] = {
+                'calls': 0, 'statements': 0, 'max_statements': 0, 'db_ms': 0.0, 'slow': 0,
+            }
+        return entry
+
+    def record_call(self, name: str, statements: int):
+        with self._lock:
+            entry = self._entry(name)
+            entry['calls'] += 1
+            entry['max_statements'] = max(entry['max_statements'], statements)
+
+    def record_statement(self, name: str, elapsed_ms: float, slow: bool):
+        with self._lock:
+            entry = self._entry(name)
+            entry['statements'] += 1
+            entry['db_ms'] += elapsed_ms
+            if slow:
+                entry['slow'] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Copy of the counters with statements per call, busiest functions first."""
+        with self._lock:
+            result = {}
+            for name, entry in self._functions.items():
+                entry = dict(entry)
+                entry['db_ms'] = round(entry['db_ms'], 1)
+                entry['statements_per_call'] = round(entry['statements'] / entry['calls'], 2) if entry['calls'] else None
+                result[name] = entry
+        return dict(sorted(result.items(), key=lambda item: item[1]['db_ms'], reverse=True))
+
+    def reset(self):
+        with self._lock:
+            self._functions.clear()
+
+
+query_stats = QueryStats()
+
+# Current unit of work and repository function; contextvars follow run_blocking into worker threads
+_current_scope: ContextVar[Optional[QueryScope]] = ContextVar('db_query_scope', default=None)
+_current_function: ContextVar[Optional[list]] = ContextVar('db_query_function', default=None)
+
+
+@contextmanager
+def query_scope(name: str):
+    """Count statements issued inside the block (and in tasks/threads started from it)."""
+    scope = QueryScope(name)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+
+
+def track_queries(func):
+    """Attribute statements issued by a repository function to its name in query_stats."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        call = [name, 0]
+        token = _current_function.set(call)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_function.reset(token)
+            query_stats.record_call(name, call[1])
+
+    return wrapper
+
+
+def _redact(parameters: Any) -> Any:
+    """Replace bound values with their types so user data never reaches the log."""
+    if isinstance(parameters, dict):
+        return {key: _redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"<{len(parameters)} parameter sets>"
+        return [_redact_value(value) for value in parameters]
+    return _redact_value(parameters)
+
+
+def _redact_value(value: Any) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__} len={len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    slow = elapsed_ms >= DB_SLOW_QUERY_MS
+
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.record(elapsed_ms)
+    call = _current_function.get()
+    if call is not None:
+        call[1] += 1
+        query_stats.record_statement(call[0], elapsed_ms, slow)
+
+    if slow:
+        logger.warning(
+            f"Slow query {elapsed_ms:.0f} ms"
+            f" (function: {call[0] if call else '-'}, scope: {scope.name if scope else '-'}): "
+            f"{' '.join(statement.split())[:500]} | params: {_redact(parameters)}"
+        )
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+if DB_QUERY_INSTRUMENTATION:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
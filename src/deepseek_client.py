@@ -1,32 +1,33 @@
 """Клиент для работы с DeepSeek API - генерация сказок."""
+import json
 import logging
-import requests
-from typing import Optional
+import httpx
+from typing import Any, Dict, Optional, Tuple
 
 from config import DEEPSEEK_API_KEY, DEEPSEEK_API_URL
 
 logger = logging.getLogger(__name__)
 
 
+class DeepSeekRequestError(Exception):
+    """Запрос к DeepSeek не выполнен: сетевая ошибка, таймаут или ответ API с ошибкой."""
+
+
 class DeepSeekClient:
     """Клиент для генерации сказок через DeepSeek API."""
     
     def __init__(self):
         self.api_key = DEEPSEEK_API_KEY
         self.api_url = DEEPSEEK_API_URL
+        self.model = "deepseek-chat"
+        self.temperature = 0.8
+        self.timeout = 60
+        # Асинхронный HTTP-клиент создается лениво в цикле событий бота
+        self._async_client: Optional[httpx.AsyncClient] = None
     
-    def generate_story(self, user_prompt: str) -> Optional[str]:
-        """
-        Генерирует сказку через DeepSeek API.
-        
-        Args:
-            user_prompt: Промпт от Agent 1 для генерации сказки
-        
-        Returns:
-            Текст сказки или None в случае ошибки
-        """
-        try:
-            system_prompt = """Ты — профессиональный сценарист и сторителлер, работающий по методологии Pixar Animation Studios.
+    def _build_request(self, user_prompt: str, json_output: bool = False) -> Tuple[Dict[str, str], Dict[str, Any]]:
+        """Собирает заголовки и тело запроса к DeepSeek API (json_output - ответ строго в JSON)."""
+        system_prompt = """Ты — профессиональный сценарист и сторителлер, работающий по методологии Pixar Animation Studios.
 Твоя задача — писать детские сказки с чёткой драматургией, внутренней трансформацией героя и неназидательной моралью.
 
 ОБЩИЕ ПРИНЦИПЫ
@@ -187,63 +188,97 @@ Story Spine:
 - Не используй мат и контент 18+
 - Используй ТОЧНЫЕ имена детей из запроса, не заменяй их на другие"""
 
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0.8,
-                "max_tokens": 2000,
-                "stream": False
-            }
-            
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        payload = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": self.temperature,
+            "max_tokens": 2000,
+            "stream": False
+        }
+        if json_output:
+            # Сказка внутри JSON: нужен запас токенов на экранирование
+            payload["response_format"] = {"type": "json_object"}
+            payload["max_tokens"] = 3000
+        
+        return headers, payload
+    
+    def _parse_response(self, response) -> Optional[str]:
+        """
+        Разбирает ответ DeepSeek API.
+        
+        Подходит и для requests.Response, и для httpx.Response:
+        оба предоставляют status_code, json() и text.
+        """
+        # Проверяем статус ответа
+        if response.status_code != 200:
+            self._log_error_response(response)
+            return None
+        
+        data = response.json()
+        
+        # Извлекаем текст сказки
+        if "choices" in data and len(data["choices"]) > 0:
+            story_text = data["choices"][0]["message"]["content"]
+            logger.info("Сказка успешно сгенерирована через DeepSeek")
+            return story_text
+        else:
+            logger.error(f"DeepSeek вернул неожиданный формат ответа: {data}")
+            return None
+    
+    def _log_error_response(self, response):
+        """Пишет в лог ошибку из ответа DeepSeek API с кодом, отличным от 200."""
+        error_data = {}
+        try:
+            error_data = response.json()
+        except:
+            error_data = {"error": response.text[:500]}
+        
+        error_msg = error_data.get("error", {})
+        if isinstance(error_msg, dict):
+            error_message = error_msg.get("message", str(error_data))
+        else:
+            error_message = str(error_data)
+        
+        # Специальная обработка для ошибки баланса
+        if response.status_code == 402 or "balance" in error_message.lower() or "insufficient" in error_message.lower():
+            logger.error(f"DeepSeek API: Недостаточно баланса на счету. {error_message}")
+        else:
+            logger.error(f"DeepSeek API вернул ошибку {response.status_code}: {error_message}")
+    
+    def generate_story(self, user_prompt: str) -> Optional[str]:
+        """
+        Генерирует сказку через DeepSeek API (блокирующий вызов).
+        
+        Args:
+            user_prompt: Промпт от Agent 1 для генерации сказки
+        
+        Returns:
+            Текст сказки или None в случае ошибки
+        """
+        # requests нужен только синхронному пути (бот использует agenerate_story)
+        import requests
+        
+        try:
+            headers, payload = self._build_request(user_prompt)
+        
             logger.info(f"Отправляю запрос к DeepSeek API: {self.api_url}")
-            
+        
             response = requests.post(
                 self.api_url,
                 headers=headers,
                 json=payload,
-                timeout=60
+                timeout=self.timeout
             )
+            return self._parse_response(response)
             
-            # Проверяем статус ответа
-            if response.status_code != 200:
-                error_data = {}
-                try:
-                    error_data = response.json()
-                except:
-                    error_data = {"error": response.text[:500]}
-                
-                error_msg = error_data.get("error", {})
-                if isinstance(error_msg, dict):
-                    error_message = error_msg.get("message", str(error_data))
-                else:
-                    error_message = str(error_data)
-                
-                # Специальная обработка для ошибки баланса
-                if response.status_code == 402 or "balance" in error_message.lower() or "insufficient" in error_message.lower():
-                    logger.error(f"DeepSeek API: Недостаточно баланса на счету. {error_message}")
-                else:
-                    logger.error(f"DeepSeek API вернул ошибку {response.status_code}: {error_message}")
-                return None
-            
-            data = response.json()
-            
-            # Извлекаем текст сказки
-            if "choices" in data and len(data["choices"]) > 0:
-                story_text = data["choices"][0]["message"]["content"]
-                logger.info("Сказка успешно сгенерирована через DeepSeek")
-                return story_text
-            else:
-                logger.error(f"DeepSeek вернул неожиданный формат ответа: {data}")
-                return None
-                
         except requests.exceptions.HTTPError as e:
             error_detail = ""
             try:
@@ -262,4 +297,102 @@ Story Spine:
         except Exception as e:
             logger.error(f"Ошибка генерации сказки: {e}", exc_info=True)
             return None
-
+    
+    async def agenerate_story(self, user_prompt: str) -> Optional[str]:
+        """
+        Генерирует сказку через DeepSeek API без занятия потока.
+        
+        Отмена задачи (asyncio.CancelledError) прерывает HTTP-запрос
+        и пробрасывается вызывающему коду.
+        
+        Args:
+            user_prompt: Промпт от Agent 1 для генерации сказки
+        
+        Returns:
+            Текст сказки или None в случае ошибки
+        """
+        try:
+            headers, payload = self._build_request(user_prompt)
+        
+            if self._async_client is None:
+                self._async_client = httpx.AsyncClient(timeout=self.timeout)
+        
+            logger.info(f"Отправляю запрос к DeepSeek API: {self.api_url}")
+        
+            response = await self._async_client.post(
+                self.api_url,
+                headers=headers,
+                json=payload
+            )
+            return self._parse_response(response)
+        
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка запроса к DeepSeek API: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка генерации сказки: {e}", exc_info=True)
+            return None
+    
+    async def agenerate_story_with_profile_patch(self, user_prompt: str) -> Optional[Dict[str, Any]]:
+        """
+        Один вызов DeepSeek со структурированным ответом: обновление профиля и сказка.
+        
+        Args:
+            user_prompt: Промпт из story_prompts.build_single_hop_prompt
+        
+        Returns:
+            {"should_update_profile": bool, "profile_patch": dict, "story": str}
+            или None, если ответ не разобран или не соответствует схеме
+        
+        Raises:
+            DeepSeekRequestError: сетевая ошибка, таймаут или ответ API с ошибкой
+        """
+        try:
+            headers, payload = self._build_request(user_prompt, json_output=True)
+            
+            if self._async_client is None:
+                self._async_client = httpx.AsyncClient(timeout=self.timeout)
+            
+            logger.info(f"Отправляю структурированный запрос к DeepSeek API: {self.api_url}")
+            
+            response = await self._async_client.post(
+                self.api_url,
+                headers=headers,
+                json=payload
+            )
+            if response.status_code != 200:
+                self._log_error_response(response)
+                raise DeepSeekRequestError(f"DeepSeek API вернул ошибку {response.status_code}")
+            content = self._parse_response(response)
+            if not content:
+                return None
+            
+            result = json.loads(content)
+            if not isinstance(result, dict):
+                logger.warning(f"DeepSeek вернул JSON неожиданного вида: {content[:300]}")
+                return None
+            
+            story = result.get("story")
+            profile_patch = result.get("profile_patch") or {}
+            if not isinstance(story, str) or not story.strip() or not isinstance(profile_patch, dict):
+                logger.warning(f"DeepSeek вернул JSON без сказки или с некорректным profile_patch: {content[:300]}")
+                return None
+            
+            return {
+                "should_update_profile": bool(result.get("should_update_profile", False)),
+                "profile_patch": profile_patch,
+                "story": story.strip(),
+            }
+        
+        except json.JSONDecodeError as e:
+            logger.warning(f"Не удалось разобрать JSON-ответ DeepSeek: {e}")
+            return None
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка запроса к DeepSeek API: {e}")
+            raise DeepSeekRequestError(str(e)) from e
+    
+    async def aclose(self):
+        """Закрывает асинхронный HTTP-клиент."""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
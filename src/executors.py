@@ -0,0 +1,90 @@
+"""Именованные пулы потоков для блокирующих задач разных типов.
+
+Запросы к БД, вызовы LLM и CPU-задачи выполняются в отдельных пулах,
+поэтому медленный провайдер LLM не занимает потоки, нужные для быстрых
+запросов к профилю.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class NamedExecutor:
+    """Пул потоков с метриками: глубина очереди, активные и завершенные задачи."""
+    
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.max_queued = 0
+    
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполняет func в пуле, сохраняя contextvars вызывающей задачи (как asyncio.to_thread)."""
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            queued = self.queued
+        if queued > self.max_workers:
+            logger.debug(f"Пул '{self.name}' перегружен: в очереди {queued} задач при {self.max_workers} потоках")
+        
+        def _call():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return ctx.run(func, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+        
+        return await loop.run_in_executor(self.executor, _call)
+    
+    def stats(self) -> Dict[str, int]:
+        """Текущие метрики пула."""
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'max_queued': self.max_queued,
+            }
+    
+    def shutdown(self, wait: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+class ExecutorRegistry:
+    """Набор именованных пулов: "db", "llm", "cpu" и т.д."""
+    
+    def __init__(self, sizes: Dict[str, int]):
+        self.executors = {name: NamedExecutor(name, size) for name, size in sizes.items()}
+    
+    def get(self, workload: str) -> NamedExecutor:
+        if workload not in self.executors:
+            raise ValueError(f"Неизвестный тип нагрузки: {workload}")
+        return self.executors[workload]
+    
+    async def run(self, workload: str, func: Callable, *args, **kwargs) -> Any:
+        return await self.get(workload).run(func, *args, **kwargs)
+    
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: executor.stats() for name, executor in self.executors.items()}
+    
+    def shutdown(self, wait: bool = False):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
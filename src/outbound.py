@@ -0,0 +1,184 @@
+"""Общий бюджет исходящих запросов к Bot API и общий тикер статуса 'Typing'.
+
+Все запросы бота проходят через OutboundRateBudget (rate limiter PTB),
+который держит глобальный лимит запросов в секунду. Статусы 'Typing'
+для всех активных чатов отправляет один TypingTicker: он пачкой шлет
+только те чаты, которым пора обновить статус, и только если в бюджете
+остается запас для обычных сообщений. Под нагрузкой первыми
+пропускаются именно статусы 'Typing'.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Coroutine, Deque, Dict, Optional
+
+from telegram.constants import ChatAction
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundRateBudget(BaseRateLimiter):
+    """Глобальный лимит исходящих запросов к Bot API (скользящее окно в 1 секунду).
+
+    Обычные запросы при исчерпании бюджета ждут свободного слота.
+    При RetryAfter от Telegram отправка приостанавливается на указанное время.
+    """
+
+    def __init__(self, max_per_second: int = 25):
+        self.max_per_second = max_per_second
+        self._sent: Deque[float] = deque()
+        self._paused_until = 0.0
+        self.throttled = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _prune(self, now: float):
+        while self._sent and now - self._sent[0] >= 1.0:
+            self._sent.popleft()
+
+    def headroom(self) -> int:
+        """Сколько запросов еще можно отправить в текущем окне без ожидания."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return 0
+        self._prune(now)
+        return self.max_per_second - len(self._sent)
+
+    async def _acquire(self):
+        waited = False
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                delay = self._paused_until - now
+            else:
+                self._prune(now)
+                if len(self._sent) < self.max_per_second:
+                    self._sent.append(now)
+                    if waited:
+                        self.throttled += 1
+                    return
+                delay = 1.0 - (now - self._sent[0])
+            waited = True
+            await asyncio.sleep(max(delay, 0.01))
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Any],
+    ) -> Any:
+        await self._acquire()
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, "total_seconds"):
+                retry_after = retry_after.total_seconds()
+            self._paused_until = max(self._paused_until, time.monotonic() + float(retry_after))
+            logger.warning(f"Telegram просит подождать {retry_after} с перед {endpoint}, приостанавливаю отправку")
+            await self._acquire()
+            return await callback(*args, **kwargs)
+
+
+class TypingTicker:
+    """Один фоновый цикл, который поддерживает статус 'Typing' во всех активных чатах."""
+
+    def __init__(self, budget: OutboundRateBudget, interval: float = 4.0, reserve: Optional[int] = None):
+        self.budget = budget
+        self.interval = interval
+        # Часть бюджета, которую статусы 'Typing' никогда не занимают
+        self.reserve = reserve if reserve is not None else max(1, budget.max_per_second // 3)
+        self._bot = None
+        self._active: Dict[int, int] = {}
+        self._next_due: Dict[int, float] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+
+    @asynccontextmanager
+    async def track(self, bot, chat_id: Optional[int]):
+        """Показывает 'Typing' в чате, пока выполняется тело блока."""
+        if not chat_id:
+            yield
+            return
+
+        self._bot = bot
+        self._ensure_started()
+        self._active[chat_id] = self._active.get(chat_id, 0) + 1
+        if self._active[chat_id] == 1:
+            self._next_due[chat_id] = time.monotonic()
+            self._wakeup.set()
+        try:
+            yield
+        finally:
+            self._active[chat_id] -= 1
+            if self._active[chat_id] <= 0:
+                self._active.pop(chat_id, None)
+                self._next_due.pop(chat_id, None)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _send(self, chat_id: int):
+        try:
+            await self._bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception as e:
+            logger.debug(f"Не удалось отправить typing в чат {chat_id}: {e}")
+
+    async def _tick(self):
+        now = time.monotonic()
+        due = [chat_id for chat_id, at in self._next_due.items() if at <= now]
+        if not due:
+            return
+
+        allowed = max(0, self.budget.headroom() - self.reserve)
+        batch, skipped = due[:allowed], due[allowed:]
+        for chat_id in batch:
+            self._next_due[chat_id] = now + self.interval
+        # Пропущенные чаты пробуем снова на следующем такте, не занимая бюджет сейчас
+        for chat_id in skipped:
+            self._next_due[chat_id] = now + 1.0
+        self.dropped += len(skipped)
+
+        if batch:
+            await asyncio.gather(*(self._send(chat_id) for chat_id in batch))
+            self.sent += len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._tick()
+            except Exception as e:
+                logger.warning(f"Ошибка в тикере typing: {e}")
+
+            now = time.monotonic()
+            next_at = min(self._next_due.values(), default=now + self.interval)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_at - now, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        """Останавливает фоновый цикл."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"active_chats": len(self._active), "sent": self.sent, "dropped": self.dropped}
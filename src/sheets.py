@@ -1,510 +1,265 @@
-"""Работа с Google Sheets: профили пользователей и истории сказок."""
+"""Необязательная выгрузка профилей и сказок в Google Sheets.
+
+Основное хранилище - PostgreSQL, таблица - копия для просмотра. ExportingStorage
+оборачивает хранилище бота и после успешной записи ставит строку в очередь
+SheetsExporter. Экспортер отправляет очередь пачками: раз в flush_interval
+секунд или когда набралось batch_size строк. Новые профили и сказки уходят
+одним values.append на лист, изменения уже выгруженных профилей - одним
+values.batchUpdate. Несколько изменений одного профиля между отправками
+схлопываются в одно.
+
+Лист Users: user_id, username, child_names, age, traits, created_at,
+updated_at, wishes, version, story_total. Лист Stories (только добавление):
+created_at, user_id, story_id, text, model. При удалении профиля его строка
+в Users очищается; сказки в Stories остаются до пересоздания таблицы.
+
+Зависимости: pip install -r requirements-sheets.txt
+"""
+import asyncio
 import logging
-from typing import Optional, Dict, Any, List
+import re
+import threading
+from collections.abc import Mapping
 from datetime import datetime
-import uuid
+from typing import Any, Dict, List, Optional
 
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+logger = logging.getLogger(__name__)
 
-from config import CREDENTIALS_PATH, SPREADSHEET_ID
+USERS_COLUMNS = ('user_id', 'username', 'child_names', 'age', 'traits', 'created_at',
+                 'updated_at', 'wishes', 'version', 'story_total')
+_USERS_LAST_COLUMN = chr(ord('A') + len(USERS_COLUMNS) - 1)
+_UPDATED_RANGE_RE = re.compile(r"![A-Z]+(\d+)")
 
-logger = logging.getLogger(__name__)
 
+class SheetsExporter:
+    """Очередь строк для Google Sheets и фоновая отправка пачками."""
 
-class GoogleSheetsClient:
-    """Клиент для работы с Google Sheets."""
-    
-    def __init__(self):
-        self.service = None
-        self._init_service()
-    
-    def _init_service(self):
-        """Инициализирует сервис Google Sheets."""
-        try:
-            creds = Credentials.from_service_account_file(
-                str(CREDENTIALS_PATH),
-                scopes=['https://www.googleapis.com/auth/spreadsheets']
-            )
-            self.service = build('sheets', 'v4', credentials=creds)
-            logger.info("Google Sheets сервис инициализирован")
-        except Exception as e:
-            logger.error(f"Ошибка инициализации Google Sheets: {e}")
-            raise
-    
-    def _get_sheet_id(self, sheet_name: str) -> Optional[int]:
-        """Получает ID листа по имени."""
-        try:
-            spreadsheet = self.service.spreadsheets().get(
-                spreadsheetId=SPREADSHEET_ID
-            ).execute()
-            
-            for sheet in spreadsheet.get('sheets', []):
-                if sheet['properties']['title'] == sheet_name:
-                    return sheet['properties']['sheetId']
-            return None
-        except Exception as e:
-            logger.error(f"Ошибка получения ID листа {sheet_name}: {e}")
-            return None
-    
-    def get_user_profile(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """
-        Получает профиль пользователя из листа Users.
-        Возвращает None, если пользователь не найден.
-        """
-        try:
-            range_name = 'Users!A2:K'
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=range_name
-            ).execute()
-            
-            rows = result.get('values', [])
-            
-            for row in rows:
-                if len(row) > 0 and str(row[0]) == str(user_id):
-                    return {
-                        'user_id': str(row[0]) if len(row) > 0 else '',
-                        'username': row[1] if len(row) > 1 else '',
-                        'child_names': row[2] if len(row) > 2 else '',
-                        'age': row[3] if len(row) > 3 else '',
-                        'traits': row[4] if len(row) > 4 else '',
-                        'created_at': row[5] if len(row) > 5 else '',
-                        'updated_at': row[6] if len(row) > 6 else '',
-                        'last_user_message': row[7] if len(row) > 7 else '',
-                        'state': row[8] if len(row) > 8 else '',
-                        'version': row[9] if len(row) > 9 else '1',
-                        'story_total': row[10] if len(row) > 10 else '0'
-                    }
-            
-            return None
-        except Exception as e:
-            logger.error(f"Ошибка получения профиля пользователя {user_id}: {e}")
-            return None
-    
-    def create_user_profile(
-        self,
-        user_id: int,
-        username: str,
-        child_names: str,
-        age: str,
-        traits: str
-    ) -> bool:
-        """Создает новый профиль пользователя."""
-        try:
-            now = datetime.now().isoformat()
-            values = [[
-                str(user_id),
-                username or '',
-                child_names,
-                age,
-                traits,
-                now,
-                now,
-                '',
-                'active',
-                '1'
-                '0' # story_total
-            ]]
-
-
-            
-            body = {'values': values}
-            result = self.service.spreadsheets().values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range='Users!A2',
-                valueInputOption='RAW',
-                insertDataOption='INSERT_ROWS',
-                body=body
-            ).execute()
-            
-            logger.info(f"Профиль пользователя {user_id} создан")
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка создания профиля пользователя {user_id}: {e}")
-            return False
-    
-    def update_user_profile(
-        self,
-        user_id: int,
-        profile_patch: Dict[str, Any]
-    ) -> bool:
-        """
-        Обновляет профиль пользователя.
-        profile_patch может содержать: child_names, age, traits, last_user_message
-        """
-        try:
-            # Находим строку пользователя
-            range_name = 'Users!A2:K'
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=range_name
-            ).execute()
-            
-            rows = result.get('values', [])
-            row_index = None
-            
-            for idx, row in enumerate(rows):
-                if len(row) > 0 and str(row[0]) == str(user_id):
-                    row_index = idx + 2  # +2 потому что заголовок и 0-based -> 1-based
-                    break
-            
-            if row_index is None:
-                logger.warning(f"Пользователь {user_id} не найден для обновления")
-                return False
-            
-            # Получаем текущий профиль
-            current_range = f'Users!A{row_index}:K{row_index}'
-            current_result = self.service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=current_range
-            ).execute()
-            
-            current_row = current_result.get('values', [[]])[0]
-            
-            # Обновляем значения
-            updated_row = list(current_row)
-            while len(updated_row) < 11:
-                updated_row.append('')
-            
-            # Обновляем поля из patch
-            if 'child_names' in profile_patch:
-                updated_row[2] = str(profile_patch['child_names'])
-            if 'age' in profile_patch:
-                updated_row[3] = str(profile_patch['age'])
-            if 'traits' in profile_patch:
-                updated_row[4] = str(profile_patch['traits'])
-            if 'last_user_message' in profile_patch:
-                updated_row[7] = str(profile_patch['last_user_message'])
-            
-            # Обновляем updated_at
-            updated_row[6] = datetime.now().isoformat()
-            
-            # Записываем обновленную строку
-            body = {'values': [updated_row]}
-            self.service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=current_range,
-                valueInputOption='RAW',
-                body=body
+    def __init__(self, spreadsheet_id: str, credentials_path: str, batch_size: int = 200,
+                 flush_interval: float = 30.0, max_pending: int = 10000):
+        self.spreadsheet_id = spreadsheet_id
+        self.credentials_path = credentials_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._service = None
+        self._lock = threading.Lock()
+        # Последнее состояние профиля по user_id (None - профиль удален)
+        self._pending_users: Dict[int, Optional[List[str]]] = {}
+        self._pending_stories: List[List[str]] = []
+        # Номер строки профиля на листе Users; загружается один раз при старте
+        self._user_rows: Dict[int, int] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        # Выгрузка отключается, если не удалось подключиться к таблице при старте
+        self.disabled = False
+        self.exported_rows = 0
+        self.api_calls = 0
+        self.dropped_rows = 0
+
+    # ---------- очередь (вызывается из потоков пула БД) ----------
+
+    def enqueue_user(self, profile: Mapping):
+        if self.disabled:
+            return
+        row = [str(profile.get(column, '') or '') for column in USERS_COLUMNS]
+        with self._lock:
+            self._pending_users[int(profile['telegram_id'])] = row
+        self._maybe_wake()
+
+    def enqueue_user_deleted(self, telegram_id: int):
+        if self.disabled:
+            return
+        with self._lock:
+            self._pending_users[telegram_id] = None
+        self._maybe_wake()
+
+    def enqueue_story(self, telegram_id: int, story_id: int, text: str, model: str):
+        if self.disabled:
+            return
+        with self._lock:
+            if len(self._pending_stories) >= self.max_pending:
+                self._pending_stories.pop(0)
+                self.dropped_rows += 1
+            self._pending_stories.append([datetime.utcnow().isoformat(), str(telegram_id), str(story_id), text, model])
+        self._maybe_wake()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending_users) + len(self._pending_stories)
+
+    def _maybe_wake(self):
+        if self._loop is not None and self.pending() >= self.batch_size:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # ---------- Google Sheets API (блокирующие вызовы, выполняются в потоке) ----------
+
+    def _connect(self):
+        from google.oauth2.service_account import Credentials
+        from googleapiclient.discovery import build
+
+        creds = Credentials.from_service_account_file(
+            self.credentials_path,
+            scopes=['https://www.googleapis.com/auth/spreadsheets']
+        )
+        self._service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+        result = self._service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range='Users!A2:A'
+        ).execute()
+        self.api_calls += 1
+        for offset, row in enumerate(result.get('values', [])):
+            if row and str(row[0]).isdigit():
+                self._user_rows[int(row[0])] = offset + 2
+
+    def _append(self, sheet: str, rows: List[List[str]]) -> int:
+        """Добавляет строки одним запросом; возвращает номер первой добавленной строки."""
+        result = self._service.spreadsheets().values().append(
+            spreadsheetId=self.spreadsheet_id,
+            range=f'{sheet}!A2',
+            valueInputOption='RAW',
+            insertDataOption='INSERT_ROWS',
+            body={'values': rows}
+        ).execute()
+        self.api_calls += 1
+        match = _UPDATED_RANGE_RE.search(result.get('updates', {}).get('updatedRange', ''))
+        return int(match.group(1)) if match else 0
+
+    def _write(self, users: Dict[int, Optional[List[str]]], stories: List[List[str]]):
+        updates = []
+        new_users = []
+        for telegram_id, row in users.items():
+            row_number = self._user_rows.get(telegram_id)
+            if row_number is not None:
+                values = row if row is not None else [''] * len(USERS_COLUMNS)
+                updates.append({'range': f'Users!A{row_number}:{_USERS_LAST_COLUMN}{row_number}', 'values': [values]})
+                if row is None:
+                    del self._user_rows[telegram_id]
+            elif row is not None:
+                new_users.append((telegram_id, row))
+
+        if updates:
+            self._service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'valueInputOption': 'RAW', 'data': updates}
             ).execute()
-            
-            logger.info(f"Профиль пользователя {user_id} обновлен")
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка обновления профиля пользователя {user_id}: {e}")
-            return False
-    
-    def delete_user_profile(self, user_id: int) -> bool:
-        """
-        Удаляет профиль пользователя из листа Users.
-        Также удаляет все сказки пользователя из листа Stories.
-        """
+            self.api_calls += 1
+        if new_users:
+            first_row = self._append('Users', [row for _, row in new_users])
+            if first_row:
+                for offset, (telegram_id, _) in enumerate(new_users):
+                    self._user_rows[telegram_id] = first_row + offset
+        if stories:
+            self._append('Stories', stories)
+
+    # ---------- фоновая отправка ----------
+
+    async def start(self) -> bool:
+        """Подключается к таблице и запускает фоновую отправку. False - выгрузка отключена."""
         try:
-            # Получаем sheet_id для Users
-            users_sheet_id = self._get_sheet_id('Users')
-            if users_sheet_id is None:
-                logger.error("Не удалось найти лист Users")
-                return False
-            
-            # Находим строку пользователя в Users
-            range_name = 'Users!A2:K'
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=range_name
-            ).execute()
-            
-            rows = result.get('values', [])
-            user_row_index = None
-            
-            for idx, row in enumerate(rows):
-                if len(row) > 0 and str(row[0]) == str(user_id):
-                    user_row_index = idx + 2  # +2 потому что заголовок и 0-based -> 1-based
-                    break
-            
-            if user_row_index is None:
-                logger.warning(f"Пользователь {user_id} не найден для удаления")
-                return False
-            
-            # Удаляем строку профиля из Users
-            requests = [{
-                'deleteDimension': {
-                    'range': {
-                        'sheetId': users_sheet_id,
-                        'dimension': 'ROWS',
-                        'startIndex': user_row_index - 1,  # 0-based
-                        'endIndex': user_row_index
-                    }
-                }
-            }]
-            
-            # Удаляем все сказки пользователя из Stories
-            stories_sheet_id = self._get_sheet_id('Stories')
-            if stories_sheet_id:
-                stories_range = 'Stories!A2:B'
-                stories_result = self.service.spreadsheets().values().get(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=stories_range
-                ).execute()
-                
-                stories_rows = stories_result.get('values', [])
-                # Собираем индексы строк для удаления (с конца к началу)
-                rows_to_delete = []
-                for idx, row in enumerate(stories_rows):
-                    if len(row) >= 2 and str(row[1]) == str(user_id):
-                        rows_to_delete.append(idx + 2)  # +2 потому что заголовок и 0-based -> 1-based
-                
-                # Сортируем в обратном порядке для удаления с конца
-                rows_to_delete.sort(reverse=True)
-                
-                for row_idx in rows_to_delete:
-                    requests.append({
-                        'deleteDimension': {
-                            'range': {
-                                'sheetId': stories_sheet_id,
-                                'dimension': 'ROWS',
-                                'startIndex': row_idx - 1,  # 0-based
-                                'endIndex': row_idx
-                            }
-                        }
-                    })
-            
-            # Выполняем все удаления одним запросом
-            if requests:
-                body = {'requests': requests}
-                self.service.spreadsheets().batchUpdate(
-                    spreadsheetId=SPREADSHEET_ID,
-                    body=body
-                ).execute()
-                
-                logger.info(f"Профиль пользователя {user_id} и все его сказки удалены")
-                return True
-            else:
-                return False
-                
+            await asyncio.to_thread(self._connect)
         except Exception as e:
-            logger.error(f"Ошибка удаления профиля пользователя {user_id}: {e}")
+            logger.error(f"Выгрузка в Google Sheets отключена, не удалось подключиться: {e}")
+            self.disabled = True
+            with self._lock:
+                self._pending_users.clear()
+                self._pending_stories.clear()
             return False
-            def increment_story_total(self, user_id: int) -> int:
-                         """
-        Увеличивает Users.story_total на 1 для пользователя.
-        Колонка story_total = B
-        updated_at = I
-        """
-        try:
-            # Читаем Users (A:P чтобы захватить все поля)
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range='Users!A2:P'
-            ).execute()
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Выгрузка в Google Sheets запущена, профилей в таблице: {len(self._user_rows)}")
+        return True
 
-            rows = result.get('values', [])
-            row_index = None
-            current_value = 0
-
-            for idx, row in enumerate(rows):
-                if len(row) > 0 and str(row[0]) == str(user_id):
-                    row_index = idx + 2  # строка в Google Sheets
-                    if len(row) > 1 and row[1].strip() != "":
-                        try:
-                            current_value = int(row[1])
-                        except ValueError:
-                            current_value = 0
-                    break
-
-            if row_index is None:
-                logger.warning(f"Пользователь {user_id} не найден для story_total")
-                return 0
-
-            new_value = current_value + 1
-            now = datetime.now().isoformat()
-
-            # Обновляем story_total (B) и updated_at (I)
-            self.service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f'Users!B{row_index}',
-                valueInputOption='RAW',
-                body={'values': [[str(new_value)]]}
-            ).execute()
+    async def flush(self):
+        """Отправляет накопленную очередь (при ошибке строки возвращаются в очередь)."""
+        async with self._flush_lock:
+            with self._lock:
+                users, self._pending_users = self._pending_users, {}
+                stories, self._pending_stories = self._pending_stories, []
+            if not users and not stories:
+                return
+            try:
+                await asyncio.to_thread(self._write, users, stories)
+                self.exported_rows += len(users) + len(stories)
+            except Exception as e:
+                logger.error(f"Ошибка выгрузки в Google Sheets ({len(users) + len(stories)} строк): {e}")
+                with self._lock:
+                    # Более новые изменения профиля, поставленные во время отправки, важнее
+                    for telegram_id, row in users.items():
+                        self._pending_users.setdefault(telegram_id, row)
+                    self._pending_stories[:0] = stories
+                    overflow = len(self._pending_stories) - self.max_pending
+                    if overflow > 0:
+                        del self._pending_stories[:overflow]
+                        self.dropped_rows += overflow
 
-            self.service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f'Users!I{row_index}',
-                valueInputOption='RAW',
-                body={'values': [[now]]}
-            ).execute()
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
 
-            logger.info(f"story_total={new_value} для user_id={user_id}")
-            return new_value
+    async def stop(self):
+        """Останавливает фоновую отправку и выгружает остаток очереди."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+        logger.info(f"Метрики выгрузки в Google Sheets: {self.stats()}")
 
-        except Exception as e:
-            logger.error(f"Ошибка increment_story_total для {user_id}: {e}")
-            return 0
-    def increment_story_total(self, user_id: int) -> int:
-        """
-        Увеличивает Users.story_total (колонка K) на 1 для пользователя user_id.
-        Возвращает новое значение.
-        """
-        try:
-            # Ищем строку пользователя
-            range_name = 'Users!A2:K'
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=range_name
-            ).execute()
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': self.pending(),
+            'exported_rows': self.exported_rows,
+            'api_calls': self.api_calls,
+            'dropped_rows': self.dropped_rows,
+        }
 
-            rows = result.get('values', [])
-            row_index = None
-            current_val = 0
-
-            for idx, row in enumerate(rows):
-                if len(row) > 0 and str(row[0]) == str(user_id):
-                    row_index = idx + 2  # строка в Sheets (1-based, с учетом заголовка)
-                    if len(row) > 10 and str(row[10]).strip() != "":
-                        try:
-                            current_val = int(float(str(row[10]).strip()))
-                        except Exception:
-                            current_val = 0
-                    break
-
-            if row_index is None:
-                logger.warning(f"Пользователь {user_id} не найден для increment_story_total")
-                return 0
-
-            new_val = current_val + 1
-            now = datetime.now().isoformat()
-
-            # K = story_total, G = updated_at
-            self.service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f'Users!K{row_index}',
-                valueInputOption='RAW',
-                body={'values': [[str(new_val)]]}
-            ).execute()
 
-            self.service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f'Users!G{row_index}',
-                valueInputOption='RAW',
-                body={'values': [[now]]}
-            ).execute()
+class ExportingStorage:
+    """Хранилище, которое после успешной записи ставит изменения в очередь SheetsExporter."""
 
-            logger.info(f"story_total incremented user_id={user_id} new_val={new_val}")
-            return new_val
+    def __init__(self, inner: Any, exporter: SheetsExporter):
+        self.inner = inner
+        self.exporter = exporter
 
-        except Exception as e:
-            logger.error(f"Ошибка increment_story_total для {user_id}: {e}")
-            return 0
-
-    def save_story(
-        self,
-        user_id: int,
-        story_text: str,
-        model: str = 'deepseek'
-    ) -> bool:
-        """
-        Сохраняет сказку в лист Stories и выполняет trim до последних 5 записей.
-        """
-        try:
-            # Генерируем уникальный ID для истории
-            story_id = str(uuid.uuid4())
-            ts = datetime.now().isoformat()
-            
-            # Добавляем новую запись
-            values = [[ts, str(user_id), story_id, story_text, model]]
-            body = {'values': values}
-            
-            self.service.spreadsheets().values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range='Stories!A2',
-                valueInputOption='RAW',
-                insertDataOption='INSERT_ROWS',
-                body=body
-            ).execute()
-            
-            logger.info(f"Сказка сохранена для пользователя {user_id}")
-            self.increment_story_total(user_id)
+    def __getattr__(self, name: str):
+        # Чтение и остальные операции - без изменений
+        return getattr(self.inner, name)
 
-            # Увеличиваем счетчик всех сказок
-            self.increment_story_total(user_id)
+    def upsert_user_profile(self, telegram_id: int, *args, **kwargs) -> bool:
+        success = self.inner.upsert_user_profile(telegram_id, *args, **kwargs)
+        if success:
+            profile = self.inner.get_user(telegram_id)
+            if profile:
+                self.exporter.enqueue_user(profile)
+        return success
 
-            # Выполняем trim до последних 5 записей
-            self._trim_stories(user_id)
+    def patch_user_profile(self, telegram_id: int, fields: Dict[str, Any], expected_version: Optional[int] = None):
+        profile, conflict = self.inner.patch_user_profile(telegram_id, fields, expected_version)
+        if profile is not None and not conflict:
+            self.exporter.enqueue_user(profile)
+        return profile, conflict
 
-            return True
-
-        except Exception as e:
-            logger.error(f"Ошибка сохранения сказки для пользователя {user_id}: {e}")
-            return False
-    
-    def _trim_stories(self, user_id: int):
-        """
-        Оставляет только последние 5 сказок для пользователя.
-        Удаляет самые старые записи.
-        """
-        try:
-            # Читаем все записи Stories (ts, user_id)
-            range_name = 'Stories!A2:B'
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=range_name
-            ).execute()
-            
-            rows = result.get('values', [])
-            
-            # Фильтруем записи для этого user_id и сортируем по ts
-            user_stories = []
-            for idx, row in enumerate(rows):
-                if len(row) >= 2 and str(row[1]) == str(user_id):
-                    try:
-                        ts = datetime.fromisoformat(row[0])
-                        user_stories.append((idx + 2, ts))  # +2 потому что заголовок и 0-based -> 1-based
-                    except:
-                        # Если не удалось распарсить дату, пропускаем
-                        continue
-            
-            # Если записей больше 5, удаляем самые старые
-            if len(user_stories) > 5:
-                # Сортируем по времени (старые первыми)
-                user_stories.sort(key=lambda x: x[1])
-                
-                # Определяем, сколько нужно удалить
-                to_delete = len(user_stories) - 5
-                
-                # Получаем sheet_id для Stories
-                sheet_id = self._get_sheet_id('Stories')
-                if sheet_id is None:
-                    logger.error("Не удалось найти лист Stories")
-                    return
-                
-                # Удаляем самые старые записи (с конца, чтобы индексы не смещались)
-                rows_to_delete = [row_idx for row_idx, _ in user_stories[:to_delete]]
-                rows_to_delete.sort(reverse=True)  # С конца к началу
-                
-                # Формируем запросы на удаление
-                requests = []
-                for row_idx in rows_to_delete:
-                    requests.append({
-                        'deleteDimension': {
-                            'range': {
-                                'sheetId': sheet_id,
-                                'dimension': 'ROWS',
-                                'startIndex': row_idx - 1,  # 0-based
-                                'endIndex': row_idx
-                            }
-                        }
-                    })
-                
-                if requests:
-                    body = {'requests': requests}
-                    self.service.spreadsheets().batchUpdate(
-                        spreadsheetId=SPREADSHEET_ID,
-                        body=body
-                    ).execute()
-                    
-                    logger.info(f"Удалено {len(requests)} старых сказок для пользователя {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка trim сказок для пользователя {user_id}: {e}")
+    def delete_user_profile(self, telegram_id: int) -> bool:
+        success = self.inner.delete_user_profile(telegram_id)
+        if success:
+            self.exporter.enqueue_user_deleted(telegram_id)
+        return success
 
+    def save_story(self, telegram_id: int, story_text: str, model: str = 'deepseek',
+                   request_type: Optional[str] = None, agent_ms: Optional[int] = None,
+                   generation_ms: Optional[int] = None) -> Optional[int]:
+        story_id = self.inner.save_story(telegram_id, story_text, model=model, request_type=request_type,
+                                         agent_ms=agent_ms, generation_ms=generation_ms)
+        if story_id is not None:
+            self.exporter.enqueue_story(telegram_id, story_id, story_text, model)
+        return story_id
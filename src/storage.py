@@ -0,0 +1,246 @@
+"""Интерфейс хранилища, от которого зависит бот, и его реализации.
+
+StorageBackend описывает все операции с данными, которые выполняет bot.py.
+PostgresStorage - основная реализация поверх db.repository, InMemoryStorage -
+хранилище в памяти процесса для тестов, бенчмарков и нагрузочного теста.
+Все методы синхронные: бот вызывает их через run_blocking.
+"""
+import itertools
+import logging
+import threading
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+from db.models import User
+from db.records import GenerationProfile, UserProfile
+
+logger = logging.getLogger(__name__)
+
+DAILY_STAT_TYPES = ('stories', 'new_users', 'start_command', 'profile_completed')
+
+
+class StorageBackend(Protocol):
+    """Операции с профилями, сказками и статистикой, которые использует бот."""
+
+    def get_user(self, telegram_id: int) -> Optional[UserProfile]: ...
+
+    def user_exists(self, telegram_id: int) -> bool: ...
+
+    def get_generation_profile(self, telegram_id: int) -> Optional[GenerationProfile]: ...
+
+    def upsert_user_profile(self, telegram_id: int, username: str, child_names: str, age: str,
+                            traits: str, context_active: Optional[str] = None) -> bool: ...
+
+    def patch_user_profile(self, telegram_id: int, fields: Dict[str, Any],
+                           expected_version: Optional[int] = None) -> Tuple[Optional[UserProfile], bool]: ...
+
+    def delete_user_profile(self, telegram_id: int) -> bool: ...
+
+    def save_story(self, telegram_id: int, story_text: str, model: str = 'deepseek',
+                   request_type: Optional[str] = None, agent_ms: Optional[int] = None,
+                   generation_ms: Optional[int] = None) -> Optional[int]: ...
+
+    def set_story_delivery_status(self, story_id: int, status: str, delivery_ms: Optional[int] = None) -> bool: ...
+
+    def get_story(self, telegram_id: int, story_id: int) -> Optional[Dict[str, Any]]: ...
+
+    def set_story_reflection_questions(self, story_id: int, questions: List[str]) -> bool: ...
+
+    def get_latest_story_reflection(self, telegram_id: int) -> Optional[Dict[str, Any]]: ...
+
+    def increment_daily_stat(self, stat_type: str, increment: int = 1,
+                             target_date: Optional[date] = None) -> bool: ...
+
+
+class PostgresStorage:
+    """Хранилище в PostgreSQL (функции db.repository)."""
+
+    def __init__(self):
+        from db import repository
+        self.get_user = repository.get_user
+        self.user_exists = repository.user_exists
+        self.get_generation_profile = repository.get_generation_profile
+        self.upsert_user_profile = repository.upsert_user_profile
+        self.patch_user_profile = repository.patch_user_profile
+        self.delete_user_profile = repository.delete_user_profile
+        self.save_story = repository.save_story
+        self.set_story_delivery_status = repository.set_story_delivery_status
+        self.get_story = repository.get_story
+        self.set_story_reflection_questions = repository.set_story_reflection_questions
+        self.get_latest_story_reflection = repository.get_latest_story_reflection
+        self.increment_daily_stat = repository.increment_daily_stat
+
+
+# Поля профиля, которые может менять patch_user_profile (как в db.repository)
+_PATCHABLE_FIELDS = frozenset(
+    column.name for column in User.__table__.columns
+) - {'telegram_id', 'version', 'created_at', 'updated_at'}
+
+
+class InMemoryStorage:
+    """Хранилище в памяти процесса с той же семантикой, что и PostgreSQL-репозиторий.
+
+    Версии профиля и compare-and-set, полная история сказок (только добавление),
+    каскадное удаление сказок вместе с профилем. Потокобезопасно.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users: Dict[int, Dict[str, Any]] = {}
+        self._stories: Dict[int, Dict[str, Any]] = {}
+        # id сказок пользователя в порядке сохранения (аналог ix_stories_user_created)
+        self._user_stories: Dict[int, List[int]] = {}
+        self._story_ids = itertools.count(1)
+        self._daily_stats: Dict[date, Dict[str, int]] = {}
+
+    def _profile(self, user: Dict[str, Any]) -> UserProfile:
+        return UserProfile(
+            user['telegram_id'], user['username'], user['child_names'], user['age'], user['traits'],
+            user['context_active'], user['wishes'], user['feedback'], user['story_total'],
+            user['version'], user['created_at'], user['updated_at'],
+        )
+
+    def get_user(self, telegram_id: int) -> Optional[UserProfile]:
+        with self._lock:
+            user = self._users.get(telegram_id)
+            return self._profile(user) if user else None
+
+    def user_exists(self, telegram_id: int) -> bool:
+        with self._lock:
+            return telegram_id in self._users
+
+    def get_generation_profile(self, telegram_id: int) -> Optional[GenerationProfile]:
+        with self._lock:
+            user = self._users.get(telegram_id)
+            if not user:
+                return None
+            return GenerationProfile.from_row((
+                user['telegram_id'], user['child_names'], user['age'], user['traits'],
+                user['context_active'], user['wishes'], user['story_total'], user['version'],
+            ))
+
+    def upsert_user_profile(self, telegram_id: int, username: str, child_names: str, age: str,
+                            traits: str, context_active: Optional[str] = None) -> bool:
+        now = datetime.utcnow()
+        with self._lock:
+            user = self._users.get(telegram_id)
+            if user:
+                user.update(username=username or user['username'], child_names=child_names, age=age, traits=traits,
+                            version=user['version'] + 1, updated_at=now)
+                if context_active is not None:
+                    user['context_active'] = context_active
+            else:
+                self._users[telegram_id] = {
+                    'telegram_id': telegram_id, 'username': username, 'child_names': child_names, 'age': age,
+                    'traits': traits, 'context_active': context_active or '', 'wishes': '', 'feedback': '',
+                    'story_total': 0, 'version': 1, 'created_at': now, 'updated_at': now,
+                }
+        return True
+
+    def patch_user_profile(self, telegram_id: int, fields: Dict[str, Any],
+                           expected_version: Optional[int] = None) -> Tuple[Optional[UserProfile], bool]:
+        with self._lock:
+            user = self._users.get(telegram_id)
+            if user is None:
+                return None, expected_version is not None
+            if expected_version is not None and user['version'] != expected_version:
+                return self._profile(user), True
+            user.update({key: value for key, value in fields.items() if key in _PATCHABLE_FIELDS})
+            user['version'] += 1
+            user['updated_at'] = datetime.utcnow()
+            return self._profile(user), False
+
+    def delete_user_profile(self, telegram_id: int) -> bool:
+        with self._lock:
+            if self._users.pop(telegram_id, None) is None:
+                return False
+            for story_id in self._user_stories.pop(telegram_id, []):
+                del self._stories[story_id]
+            return True
+
+    def save_story(self, telegram_id: int, story_text: str, model: str = 'deepseek',
+                   request_type: Optional[str] = None, agent_ms: Optional[int] = None,
+                   generation_ms: Optional[int] = None) -> Optional[int]:
+        with self._lock:
+            user = self._users.get(telegram_id)
+            if user is None:
+                return None
+            story_id = next(self._story_ids)
+            self._stories[story_id] = {
+                'id': story_id, 'user_id': telegram_id, 'text': story_text, 'model': model,
+                'request_type': request_type, 'agent_ms': agent_ms, 'generation_ms': generation_ms,
+                'delivery_ms': None, 'delivery_status': 'pending', 'reflection_questions': None, 'created_at': datetime.utcnow(),
+            }
+            self._user_stories.setdefault(telegram_id, []).append(story_id)
+            user['story_total'] += 1
+            return story_id
+
+    def set_story_delivery_status(self, story_id: int, status: str, delivery_ms: Optional[int] = None) -> bool:
+        with self._lock:
+            story = self._stories.get(story_id)
+            if story is None:
+                return False
+            story['delivery_status'] = status
+            if delivery_ms is not None:
+                story['delivery_ms'] = delivery_ms
+            return True
+
+    def get_story(self, telegram_id: int, story_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            story = self._stories.get(story_id)
+            if story is None or story['user_id'] != telegram_id:
+                return None
+            return {
+                'id': story['id'],
+                'user_id': story['user_id'],
+                'text': story['text'],
+                'model': story['model'],
+                'delivery_status': story['delivery_status'],
+                'created_at': story['created_at'].isoformat(),
+            }
+
+    def set_story_reflection_questions(self, story_id: int, questions: List[str]) -> bool:
+        with self._lock:
+            story = self._stories.get(story_id)
+            if story is None:
+                return False
+            story['reflection_questions'] = list(questions)
+            return True
+
+    def get_latest_story_reflection(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            user_story_ids = self._user_stories.get(telegram_id)
+            if not user_story_ids:
+                return None
+            story = self._stories[user_story_ids[-1]]
+            return {'id': story['id'], 'reflection_questions': story['reflection_questions']}
+
+    def increment_daily_stat(self, stat_type: str, increment: int = 1,
+                             target_date: Optional[date] = None) -> bool:
+        if stat_type not in DAILY_STAT_TYPES:
+            logger.warning(f"Неизвестный тип статистики: {stat_type}")
+            return False
+        target_date = target_date or datetime.utcnow().date()
+        with self._lock:
+            stats = self._daily_stats.setdefault(target_date, dict.fromkeys(DAILY_STAT_TYPES, 0))
+            stats[stat_type] += increment
+        return True
+
+    def get_daily_stats(self, target_date: Optional[date] = None) -> Dict[str, int]:
+        """Счетчики за день (для тестов)."""
+        with self._lock:
+            return dict(self._daily_stats.get(target_date or datetime.utcnow().date(), {}))
+
+
+STORAGE_BACKENDS = {
+    'postgres': PostgresStorage,
+    'memory': InMemoryStorage,
+}
+
+
+def create_storage(name: str = 'postgres') -> StorageBackend:
+    """Создает хранилище по имени из STORAGE_BACKEND."""
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f"Неизвестное хранилище: {name} (доступны: {', '.join(STORAGE_BACKENDS)})")
+    logger.info(f"Хранилище данных: {name}")
+    return STORAGE_BACKENDS[name]()
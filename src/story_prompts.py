@@ -0,0 +1,274 @@
+"""Шаблоны промптов для DeepSeek: чистая логика без I/O, выполняется прямо в event loop."""
+import logging
+import re
+import secrets
+from functools import lru_cache
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Список моралей для разных возрастов
+MORALS_BY_AGE = {
+    "3-5": [
+        "Дружить важнее, чем владеть игрушкой",
+        "Делая добро, ты сам становишься счастливее",
+        "Делиться — не значит терять",
+        "Мама и папа помогают, даже когда запрещают",
+        "Добрые слова делают мир мягче",
+        "Драться — не способ решать проблемы",
+        "Помогать другим — это правильно",
+        "Если ошибся, можно попросить прощения",
+        "Жадность мешает радоваться",
+        "Вежливость открывает сердца",
+    ],
+    "6-8": [
+        "Честность важнее выгоды",
+        "Усилие приводит к результату",
+        "Не суди других по внешности",
+        "Каждый поступок имеет последствия",
+        "Настойчивость помогает достигать цели",
+        "Ошибки — часть обучения",
+        "Хвастовство отталкивает друзей",
+        "Быть справедливым важнее чем быть первым",
+        "Доброта возвращается",
+    ],
+    "9-12": [
+        "Справедливость важнее личной выгоды",
+        "Ответственность — это умение держать слово",
+        "Зависть разрушает, труд развивает",
+        "Каждый человек ценен, даже если он не похож на тебя",
+        "Самоконтроль это сила",
+        "Настоящая дружба проверяется поступками",
+        "Ошибаться не стыдно, стыдно не учиться",
+        "Уважение нужно заслужить делами",
+        "Смелость — это делать правильно, даже когда трудно",
+    ],
+    "13+": [
+        "Честность с собой важнее одобрения окружающих",
+        "Характер формируется в сложных ситуациях",
+        "Популярность не равна уважению",
+        "Успех без совести не делает счастливым",
+        "Выбор — это всегда отказ от чего-то другого",
+        "Сильный человек умеет признавать ошибки",
+        "Не каждый конфликт нужно выигрывать",
+        "Ценности важнее обстоятельств",
+        "Ты отвечаешь не только за свои желания, но и за последствия своих поступков",
+    ],
+}
+
+# Общий хвост промптов: мораль не проговаривается, а видна из поступков героя
+_HIDDEN_MORAL = (
+    "Сказка должна быть интересной и поучительной, но мораль НЕ должна быть написана текстом - "
+    "она должна быть понятна из действий и выбора героя."
+)
+_HIDDEN_RANDOM_MORAL = (
+    "Сказка должна быть интересной и поучительной, но мораль должна быть скрытой, не проговариваться напрямую."
+)
+
+# Шаблоны промпта для каждого request_type (форматируются через str.format)
+STORY_PROMPT_TEMPLATES = {
+    "new_dilemma": (
+        "Напиши сказку, которая разбирает следующую ситуацию: {message}. "
+        "Сказка, которая помогает ребенку понять, как правильно поступать в такой ситуации."
+    ),
+    "random_moral": (
+        "Напиши сказку, которая передает следующую идею (НЕ пиши мораль текстом, "
+        "она должна быть понятна из действий героя): {moral}. " + _HIDDEN_RANDOM_MORAL
+    ),
+    "previous_moral": (
+        "Напиши сказку, которая разбирает следующую ситуацию: {message}. "
+        "Сказка должна помочь ребенку понять, как правильно поступать в такой ситуации, "
+        "но НЕ пиши мораль текстом - она должна быть понятна из действий и выбора героя."
+    ),
+    "add_traits": (
+        "Напиши сказку, которая учитывает обновленные черты характера ребенка. "
+        "Пользователь дополнил характер следующим: {message}. " + _HIDDEN_MORAL
+    ),
+    "add_traits_empty": (
+        "Напиши сказку, которая учитывает обновленные черты характера ребенка. " + _HIDDEN_MORAL
+    ),
+    "wishes": (
+        "Напиши сказку с учетом следующих пожеланий пользователя: {message}. " + _HIDDEN_MORAL
+    ),
+    "regular": "Напиши сказку  на основе запроса: {message}",
+}
+
+DEFAULT_MORAL = "Дружба важнее игрушек"
+
+_AGE_NUMBER_RE = re.compile(r"\d+")
+
+
+@lru_cache(maxsize=1024)
+def get_average_age_value(age: str) -> Optional[float]:
+    """Возвращает средний возраст, если указано несколько чисел."""
+    age_numbers = [int(n) for n in _AGE_NUMBER_RE.findall(str(age))]
+    if not age_numbers:
+        return None
+    return sum(age_numbers) / len(age_numbers)
+
+
+@lru_cache(maxsize=1024)
+def get_age_group(age: str) -> str:
+    """Определяет возрастную группу на основе возраста."""
+    age_value = get_average_age_value(age)
+    if age_value is None:
+        return "6-8"  # Дефолтная группа
+    
+    if age_value <= 5:
+        return "3-5"
+    elif age_value <= 8:
+        return "6-8"
+    elif age_value <= 12:
+        return "9-12"
+    else:
+        return "13+"
+
+
+def get_random_moral_by_age(age: str) -> str:
+    """Получает случайную мораль на основе возраста."""
+    age_group = get_age_group(age)
+    morals = MORALS_BY_AGE.get(age_group, MORALS_BY_AGE["6-8"])
+    
+    # Используем secrets.choice для более надежной случайности
+    selected_moral = secrets.choice(morals)
+    
+    logger.info(f"Выбрана случайная мораль для возрастной группы {age_group} (возраст: {age}): '{selected_moral}' из {len(morals)} вариантов")
+    return selected_moral
+
+
+def build_story_request(
+    request_type: str,
+    user_message: str,
+    user_profile: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Формирует промпт для специальных запросов на генерацию сказки.
+    
+    request_type может быть:
+    - "new_dilemma": новая дилемма (обновляет context_active)
+    - "random_moral": случайная мораль (не использует context_active)
+    - "previous_moral": прошлая мораль (использует context_active)
+    - "add_traits": дополнить характер (обновляет traits)
+    - "wishes": сказка с учетом пожеланий
+    - "regular": обычный запрос сказки
+    
+    Возвращает:
+    {
+        "request_type": str,
+        "deepseek_user_prompt": "string",
+        "moral": "string"  # только для random_moral
+    }
+    """
+    try:
+        if request_type == "random_moral":
+            age = user_profile.get('age', '') if user_profile else ''
+            try:
+                moral = get_random_moral_by_age(age)
+            except Exception as e:
+                logger.error(f"Ошибка при генерации случайной морали для возраста {age}: {e}", exc_info=True)
+                moral = DEFAULT_MORAL
+            prompt = STORY_PROMPT_TEMPLATES["random_moral"].format(moral=moral)
+            logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (random_moral) ===\n{prompt}\n{'=' * 50}")
+            # Возвращаем мораль для сохранения в context_active
+            return {"request_type": "random_moral", "deepseek_user_prompt": prompt, "moral": moral}
+        
+        if request_type == "add_traits" and not user_message:
+            template_name = "add_traits_empty"
+        elif request_type in STORY_PROMPT_TEMPLATES:
+            template_name = request_type
+        else:
+            # Обычный запрос
+            request_type = template_name = "regular"
+        
+        prompt = STORY_PROMPT_TEMPLATES[template_name].format(message=user_message)
+        logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK ({request_type}) ===\n{prompt}\n{'=' * 50}")
+        return {"request_type": request_type, "deepseek_user_prompt": prompt}
+    
+    except Exception as e:
+        logger.error(f"Ошибка в build_story_request: {e}")
+        fallback_prompt = "Напиши сказку ."
+        logger.info(f"=== ПРОМПТ ДЛЯ DEEPSEEK (fallback) ===\n{fallback_prompt}\n{'=' * 50}")
+        return {"request_type": request_type, "deepseek_user_prompt": fallback_prompt}
+
+
+def build_deepseek_prompt(
+    task_prompt: str,
+    user_profile: Optional[Dict[str, Any]] = None,
+    request_type: str = "regular"
+) -> str:
+    """
+    Добавляет к заданию для DeepSeek информацию о детях из профиля.
+    
+    Без профиля возвращает задание без изменений.
+    """
+    if not user_profile or not hasattr(user_profile, 'get'):
+        return task_prompt
+    
+    child_names = user_profile.get('child_names', '').strip() if user_profile.get('child_names') else ''
+    age = user_profile.get('age', '').strip() if user_profile.get('age') else ''
+    traits = user_profile.get('traits', '').strip() if user_profile.get('traits') else ''
+    context_active = user_profile.get('context_active', '').strip() if user_profile.get('context_active') else ''
+    wishes = user_profile.get('wishes', '').strip() if user_profile.get('wishes') else ''
+    
+    profile_header = f"ГЛАВНЫЕ ГЕРОИ сказки (обязательно используй их в сказке):\n"
+    profile_header += f"- Имена: {child_names}\n"
+    
+    # Возраст и черты характера всегда учитываются, но не прописываются текстом
+    if age:
+        profile_header += f"- Возраст: {age} (УЧИТЫВАЙ при написании: сложность языка, понятность сюжета, глубину морали - но НЕ пиши возраст текстом в сказке)\n"
+    if traits:
+        profile_header += f"- Черты характера: {traits} (ОБЯЗАТЕЛЬНО отрази в поведении и поступках героя, но СТРОГО ЗАПРЕЩЕНО упоминать их текстом. НЕ используй конструкции типа 'сказал он конструктор', 'он наставник', 'он генератор идей' и т.д. Покажи характер только через действия)\n"
+    
+    # Для случайной морали НЕ добавляем context_active
+    if request_type != "random_moral" and context_active:
+        profile_header += f"\nВАЖНО - РЕАЛЬНАЯ СИТУАЦИЯ ДЛЯ РАЗБОРА:\n{context_active}\n"
+        profile_header += "Сказка ОБЯЗАТЕЛЬНО должна разбирать именно эту ситуацию. Мораль НЕ должна быть написана текстом - она должна быть понятна из действий и выбора героя.\n"
+    
+    # Добавляем пожелания, если они есть
+    if wishes:
+        profile_header += f"\nДОПОЛНИТЕЛЬНЫЕ ПОЖЕЛАНИЯ (ОБЯЗАТЕЛЬНО УЧТИ):\n{wishes}\n"
+        profile_header += "Эти пожелания должны быть учтены при написании сказки.\n"
+    
+    profile_header += f"\nЗАДАНИЕ: {task_prompt}\n\n"
+    
+    # Финальное напоминание всегда включает инструкции по возрасту и характеру
+    profile_header += "ВАЖНО: Главными героями сказки ДОЛЖНЫ быть именно эти дети с указанными именами. "
+    if age or traits:
+        profile_header += "Обязательно учитывай возраст и черты характера при написании (сложность языка, поведение героя), но СТРОГО ЗАПРЕЩЕНО писать их текстом. НЕ используй роли или типы личности типа 'конструктор', 'наставник', 'генератор идей' и т.д."
+    
+    return profile_header
+
+
+SINGLE_HOP_INSTRUCTIONS = """Сначала проанализируй сообщение родителя.
+Если оно исправляет профиль ребенка ("ему 6, а не 5", "он не спокойный, а упрямый", "двое детей: Маша и Петя") → should_update_profile=true и заполни profile_patch только изменившимися полями (child_names, age, traits).
+Для traits верни финальное значение: при удалении - без удаленных черт, при замене - новое значение, при дополнении - текущие черты плюс новые, сохраняя имена детей.
+Если это обычный запрос сказки → should_update_profile=false и пустой profile_patch.
+Затем напиши сказку по заданию ниже, учитывая исправления профиля, если они есть.
+
+Верни ТОЛЬКО валидный JSON без пояснений:
+{
+    "should_update_profile": false,
+    "profile_patch": {},
+    "story": "**Название сказки**\n\nТекст сказки"
+}"""
+
+
+def build_single_hop_prompt(
+    story_prompt: str,
+    user_message: str,
+    user_profile: Optional[Dict[str, Any]] = None
+) -> str:
+    """Формирует промпт для одного вызова DeepSeek: обновление профиля и сказка в одном JSON-ответе."""
+    current = user_profile or {}
+    profile_info = (
+        "Текущий профиль ребенка:\n"
+        f"- Имя: {current.get('child_names') or 'не указано'}\n"
+        f"- Возраст: {current.get('age') or 'не указан'}\n"
+        f"- Черты характера: {current.get('traits') or 'не указаны'}\n"
+    )
+    return (
+        f"{SINGLE_HOP_INSTRUCTIONS}\n\n"
+        f"{profile_info}\n"
+        f"Сообщение родителя: {user_message}\n\n"
+        f"{story_prompt}"
+    )
@@ -1,11 +1,19 @@
-"""Утилиты: антифлуд, кэш профиля, разбиение сообщений."""
+"""Утилиты: антифлуд, кэш профиля, разметка и разбиение сообщений."""
+import hashlib
+import html
+import re
 import time
 import logging
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from typing import Dict, Optional, Any, Tuple, List
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+# Максимальная длина текста одного сообщения в Telegram
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
 
 class AntifloodManager:
     """Менеджер антифлуда: не чаще 1 генерации/15 секунд и не более 15 сказок в сутки на пользователя."""
@@ -15,8 +23,12 @@ class AntifloodManager:
         self.daily_limit = daily_limit
         self.last_generation: Dict[int, float] = {}
         self.generating: Dict[int, bool] = {}
+        # Время начала идущей генерации (от него считается кулдаун замененной генерации)
+        self.generation_started: Dict[int, float] = {}
         # Храним времена генераций для каждого пользователя (для лимита в сутки)
         self.daily_generations: Dict[int, List[float]] = {}
+        # Счетчики отказов в генерации: "источник:причина" -> количество
+        self.refusals: Dict[str, int] = {}
     
     def _cleanup_old_generations(self, user_id: int, now: float):
         """Удаляет генерации старше 24 часов."""
@@ -31,28 +43,27 @@ class AntifloodManager:
             if gen_time > one_day_ago
         ]
     
-    def _get_daily_count(self, user_id: int, now: float) -> int:
-        """Возвращает количество генераций за последние 24 часа."""
-        self._cleanup_old_generations(user_id, now)
-        return len(self.daily_generations.get(user_id, []))
-    
-    def can_generate(self, user_id: int) -> Tuple[bool, Optional[str]]:
+    def _check_admission(self, user_id: int, now: float, replacing: bool = False) -> Tuple[Optional[str], Optional[str]]:
         """
-        Проверяет, можно ли генерировать для пользователя.
-        Возвращает (можно_ли, сообщение_если_нет).
+        Проверяет ограничения для пользователя.
+        replacing=True - новая генерация заменит идущую: та считается уже учтенной
+        с момента своего начала (так ее учтет abort_generation после отмены).
+        Возвращает (причина_отказа, сообщение) или (None, None), если генерация разрешена.
         """
-        now = time.time()
-        
         # Если уже генерируется
+        pending = None
         if self.generating.get(user_id, False):
-            return False, "Принял, генерирую — подождите…"
+            if not replacing:
+                return "in_flight", "Принял, генерирую — подождите…"
+            pending = self.generation_started.get(user_id, now)
         
         # Проверяем лимит в сутки
-        daily_count = self._get_daily_count(user_id, now)
-        if daily_count >= self.daily_limit:
+        self._cleanup_old_generations(user_id, now)
+        generations = self.daily_generations[user_id] + ([pending] if pending is not None else [])
+        if len(generations) >= self.daily_limit:
             # Вычисляем время до сброса (до полуночи следующего дня или через 24 часа после первой генерации)
-            if user_id in self.daily_generations and self.daily_generations[user_id]:
-                oldest_generation = min(self.daily_generations[user_id])
+            if generations:
+                oldest_generation = min(generations)
                 reset_time = oldest_generation + 86400
                 remaining_seconds = int(reset_time - now)
                 remaining_hours = remaining_seconds // 3600
@@ -63,37 +74,98 @@ class AntifloodManager:
                 else:
                     time_str = f"{remaining_minutes} мин."
                 
-                return False, f"Достигнут лимит: {self.daily_limit} сказок в сутки. Попробуйте через {time_str}."
+                return "daily_limit", f"Достигнут лимит: {self.daily_limit} сказок в сутки. Попробуйте через {time_str}."
             else:
-                return False, f"Достигнут лимит: {self.daily_limit} сказок в сутки. Попробуйте завтра."
+                return "daily_limit", f"Достигнут лимит: {self.daily_limit} сказок в сутки. Попробуйте завтра."
         
         # Проверяем кулдаун между генерациями
-        last_time = self.last_generation.get(user_id, 0)
+        last_time = max(self.last_generation.get(user_id, 0), pending or 0)
         elapsed = now - last_time
         
         if elapsed < self.cooldown_seconds:
             remaining = int(self.cooldown_seconds - elapsed)
-            return False, f"Подождите {remaining} секунд перед следующей генерацией."
+            return "cooldown", f"Подождите {remaining} секунд перед следующей генерацией."
         
+        return None, None
+    
+    def can_generate(self, user_id: int) -> Tuple[bool, Optional[str]]:
+        """
+        Проверяет, можно ли генерировать для пользователя.
+        Возвращает (можно_ли, сообщение_если_нет).
+        """
+        reason, message = self._check_admission(user_id, time.time())
+        return reason is None, message
+    
+    def _count_refusal(self, user_id: int, source: str, reason: str):
+        key = f"{source}:{reason}"
+        self.refusals[key] = self.refusals.get(key, 0) + 1
+        logger.info(f"Генерация для пользователя {user_id} отклонена ({key}), всего таких отказов: {self.refusals[key]}")
+    
+    def try_start_generation(self, user_id: int, source: str = "message") -> Tuple[bool, Optional[str]]:
+        """
+        Единая точка допуска генерации: проверяет ограничения и сразу отмечает начало генерации.
+        Отказы считаются по источнику и причине (см. refusals).
+        Возвращает (допущена_ли, сообщение_если_нет).
+        """
+        reason, message = self._check_admission(user_id, time.time())
+        if reason is not None:
+            self._count_refusal(user_id, source, reason)
+            return False, message
+        
+        self.start_generation(user_id)
+        return True, None
+    
+    def check_replacement(self, user_id: int, source: str = "message") -> Tuple[bool, Optional[str]]:
+        """
+        Проверяет, ничего не отмечая, будет ли допущена генерация, которая заменит идущую
+        (идущая считается учтенной с момента своего начала). Вызывается до отмены идущей
+        генерации: при отказе ее не нужно отменять. Отказы считаются, как в try_start_generation.
+        Возвращает (допущена_ли, сообщение_если_нет).
+        """
+        reason, message = self._check_admission(user_id, time.time(), replacing=True)
+        if reason is not None:
+            self._count_refusal(user_id, source, reason)
+            return False, message
         return True, None
     
     def start_generation(self, user_id: int):
         """Отмечает начало генерации."""
         self.generating[user_id] = True
+        self.generation_started[user_id] = time.time()
+    
+    def abort_generation(self, user_id: int, superseded: bool = False):
+        """
+        Снимает отметку незавершенной генерации.
+        Таймаут и ошибка не учитываются в антифлуде и суточном лимите. Генерация, отмененная
+        новым запросом (superseded), учитывается: запрос к DeepSeek уже отправлен, иначе частые
+        нажатия кнопок обходили бы кулдаун и лимит. Кулдаун отсчитывается от ее начала, поэтому
+        генерацию, которая идет дольше кулдауна, можно заменить сразу.
+        Если генерация уже завершена через finish_generation, ничего не делает.
+        """
+        if not self.generating.get(user_id, False):
+            return
+        started = self.generation_started.pop(user_id, time.time())
+        self.generating[user_id] = False
+        if superseded:
+            self._record_generation(user_id, started)
     
     def finish_generation(self, user_id: int):
         """Отмечает завершение генерации и обновляет время."""
-        now = time.time()
         self.generating[user_id] = False
-        self.last_generation[user_id] = now
+        self.generation_started.pop(user_id, None)
+        self._record_generation(user_id, time.time())
+    
+    def _record_generation(self, user_id: int, at: float):
+        """Учитывает генерацию в кулдауне и суточном лимите."""
+        self.last_generation[user_id] = at
         
         # Добавляем генерацию в список для подсчета суточного лимита
         if user_id not in self.daily_generations:
             self.daily_generations[user_id] = []
-        self.daily_generations[user_id].append(now)
+        self.daily_generations[user_id].append(at)
         
         # Очищаем старые записи
-        self._cleanup_old_generations(user_id, now)
+        self._cleanup_old_generations(user_id, time.time())
 
 
 class ProfileCache:
@@ -125,53 +197,291 @@ class ProfileCache:
             del self.cache[user_id]
 
 
+class StoryCache:
+    """
+    Кэш сгенерированных сказок по хэшу финального промпта, модели и температуры.
+    
+    Политики выдачи из кэша:
+    - "retry": сказка выдается повторно только тому же пользователю и только
+      если она еще не была ему доставлена (повтор после ошибки отправки);
+    - "off": кэш отключен.
+    Сказка одного пользователя другому не выдается: в ней имена и черты его детей.
+    """
+    
+    POLICIES = ("off", "retry")
+    
+    def __init__(self, policy: str = "retry", ttl_minutes: int = 60, max_size: int = 500):
+        if policy not in self.POLICIES:
+            logger.warning(f"Неизвестная политика кэша сказок '{policy}', кэш отключен")
+            policy = "off"
+        self.policy = policy
+        self.ttl_seconds = ttl_minutes * 60
+        self.max_size = max_size
+        self.cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.policy != "off" and self.max_size > 0
+    
+    @staticmethod
+    def make_key(prompt: str, model: str, temperature: float) -> str:
+        """Ключ кэша: хэш нормализованного промпта, модели и температуры."""
+        normalized = " ".join(prompt.split())
+        payload = f"{model}\x00{temperature}\x00{normalized}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _get_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry['created_at'] > self.ttl_seconds:
+            del self.cache[key]
+            return None
+        return entry
+    
+    def get(self, key: str, user_id: int) -> Optional[str]:
+        """Возвращает сказку из кэша, если политика разрешает выдать ее пользователю."""
+        if not self.enabled:
+            return None
+        entry = self._get_entry(key)
+        if entry is None or entry['owner'] != user_id or user_id in entry['delivered']:
+            return None
+        self.cache.move_to_end(key)
+        return entry['text']
+    
+    def put(self, key: str, user_id: int, story_text: str):
+        """Сохраняет сгенерированную сказку, вытесняя самые старые записи."""
+        if not self.enabled:
+            return
+        self.cache[key] = {
+            'text': story_text,
+            'owner': user_id,
+            'created_at': time.time(),
+            'saved': {},
+            'delivered': set(),
+        }
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+    
+    def get_saved_story_id(self, key: str, user_id: int) -> Optional[int]:
+        """Id сказки в БД, если она уже была сохранена для пользователя."""
+        entry = self._get_entry(key) if self.enabled else None
+        return entry['saved'].get(user_id) if entry is not None else None
+    
+    def mark_saved(self, key: str, user_id: int, story_id: int):
+        """Отмечает, что сказка сохранена в БД для пользователя."""
+        entry = self._get_entry(key) if self.enabled else None
+        if entry is not None:
+            entry['saved'][user_id] = story_id
+    
+    def mark_delivered(self, key: str, user_id: int):
+        """Отмечает, что сказка доставлена пользователю."""
+        entry = self._get_entry(key) if self.enabled else None
+        if entry is not None:
+            entry['delivered'].add(user_id)
+
+
+def utf16_len(text: str) -> int:
+    """Длина строки в единицах UTF-16 (так считает лимиты Telegram)."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+# HTML-теги и сущности, внутри которых нельзя разрывать сообщение
+_HTML_ATOM_RE = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^>]*>|&#?\w+;')
+# Символы вне Basic Multilingual Plane
+_ASTRAL_RE = re.compile(r'[\U00010000-\U0010FFFF]')
+# Конец предложения (возможно, перед закрывающим тегом), за которым идет пробел
+_SENTENCE_END_RE = re.compile(r'[.!?…](?:</[a-zA-Z]+>)*(?=\s)')
+
+
+def _apply_tags(stack: List[Tuple[str, str]], atoms: List[Tuple[int, int, bool, str]]) -> List[Tuple[str, str]]:
+    """Возвращает новый стек открытых тегов после применения списка тегов."""
+    stack = list(stack)
+    for _, _, closing, tag in atoms:
+        if not tag or tag.endswith('/>'):
+            continue
+        name = _HTML_ATOM_RE.match(tag).group(2).lower()
+        if not closing:
+            stack.append((name, tag))
+            continue
+        # Закрываем ближайший открытый тег с таким же именем
+        for j in range(len(stack) - 1, -1, -1):
+            if stack[j][0] == name:
+                del stack[j]
+                break
+    return stack
+
+
+def _closing_tags(stack: List[Tuple[str, str]]) -> str:
+    """Закрывающие теги для стека открытых тегов (в обратном порядке)."""
+    return ''.join(f'</{name}>' for name, _ in reversed(stack))
+
+
 def split_message(text: str, max_length: int = 3800) -> List[str]:
     """
-    Разбивает длинное сообщение на части по ~3800 символов.
-    Старается разбивать по предложениям.
+    Разбивает длинное сообщение на части не длиннее max_length (в UTF-16).
+    
+    Работает за один проход по индексам: старается резать по абзацам,
+    затем по предложениям, затем по пробелам. Никогда не режет внутри
+    HTML-тега или сущности; теги, открытые на границе, закрываются в конце
+    части и открываются заново в начале следующей, поэтому каждая часть
+    является корректным HTML для ParseMode.HTML.
     """
-    if len(text) <= max_length:
+    total_units = utf16_len(text)
+    if total_units <= max_length:
         return [text]
     
+    # Символы вне BMP (эмодзи) занимают 2 единицы UTF-16, храним только их позиции
+    astral = [m.start() for m in _ASTRAL_RE.finditer(text)] if total_units != len(text) else []
+    atoms = [
+        (m.start(), m.end(), m.group(1) == '/', m.group(0) if m.group(2) else '')
+        for m in _HTML_ATOM_RE.finditer(text)
+    ]
+    atom_starts = [atom[0] for atom in atoms]
+    
+    def safe_cut(pos: int) -> int:
+        """Сдвигает позицию разреза влево, если она попадает внутрь тега или сущности."""
+        k = bisect_right(atom_starts, pos) - 1
+        if k >= 0 and atoms[k][0] < pos < atoms[k][1]:
+            return atoms[k][0]
+        return pos
+    
     chunks = []
-    current_chunk = ""
-    
-    # Разбиваем по предложениям (точка, восклицательный, вопросительный знак + пробел)
-    sentences = []
-    buffer = ""
-    
-    for char in text:
-        buffer += char
-        if char in ".!?" and len(buffer) > 10:  # Минимальная длина предложения
-            sentences.append(buffer)
-            buffer = ""
-    
-    if buffer:
-        sentences.append(buffer)
-    
-    # Если предложений нет или они слишком длинные, разбиваем по абзацам
-    if not sentences or any(len(s) > max_length for s in sentences):
-        sentences = text.split("\n\n")
-        if not sentences:
-            sentences = [text]
-    
-    # Формируем чанки
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) <= max_length:
-            current_chunk += sentence
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            # Если предложение само по себе длиннее max_length, разбиваем принудительно
-            if len(sentence) > max_length:
-                for i in range(0, len(sentence), max_length):
-                    chunks.append(sentence[i:i + max_length])
-                current_chunk = ""
-            else:
-                current_chunk = sentence
+    stack: List[Tuple[str, str]] = []
+    atom_index = 0
+    start = 0
+    length = len(text)
     
-    if current_chunk:
-        chunks.append(current_chunk.strip())
+    while start < length:
+        prefix = ''.join(tag for _, tag in stack)
+        budget = max_length - utf16_len(prefix) - utf16_len(_closing_tags(stack))
+        
+        while True:
+            end = start + max(budget, 0)
+            while astral:
+                # Уменьшаем окно, пока оно не уложится в бюджет с учетом эмодзи
+                units = end - start + bisect_left(astral, end) - bisect_left(astral, start)
+                if units <= budget or end <= start:
+                    break
+                end -= units - budget
+            if end >= length:
+                cut = length
+            else:
+                cut = safe_cut(_find_cut(text, start, end))
+                if cut <= start:
+                    # Нет подходящей границы: режем жестко, но не внутри тега
+                    cut = safe_cut(end)
+                if cut <= start:
+                    # Тег длиннее всего бюджета - отдаем его целиком
+                    k = bisect_right(atom_starts, start) - 1
+                    in_atom = k >= 0 and atoms[k][0] <= start < atoms[k][1]
+                    cut = atoms[k][1] if in_atom else start + 1
+            
+            # Теги внутри части меняют набор тегов, которые нужно закрыть в конце
+            atom_end = bisect_left(atom_starts, cut, lo=atom_index)
+            new_stack = _apply_tags(stack, atoms[atom_index:atom_end])
+            body = text[start:cut].rstrip()
+            chunk = prefix + body + _closing_tags(new_stack)
+            overflow = utf16_len(chunk) - max_length
+            if overflow <= 0 or cut - start <= 1 or budget <= overflow:
+                break
+            budget -= overflow
+        
+        if body.strip():
+            chunks.append(chunk.strip())
+        stack = new_stack
+        atom_index = atom_end
+        start = cut
+        while start < length and text[start].isspace():
+            start += 1
     
     return chunks if chunks else [text]
 
+
+def _find_cut(text: str, start: int, end: int) -> int:
+    """
+    Ищет лучшую позицию разреза в text[start:end].
+    Приоритет: конец абзаца, конец предложения, пробел. Граница принимается,
+    только если она во второй половине окна, иначе части получаются слишком мелкими.
+    """
+    min_cut = start + (end - start) // 2
+    
+    paragraph = text.rfind('\n\n', start, end)
+    if paragraph > min_cut:
+        return paragraph
+    
+    sentence_end = -1
+    for match in _SENTENCE_END_RE.finditer(text, min_cut, end):
+        sentence_end = match.end()
+    if sentence_end > min_cut:
+        return sentence_end
+    
+    space = max(text.rfind(' ', start, end), text.rfind('\n', start, end))
+    if space > min_cut:
+        return space
+    
+    return end
+
+
+# Разметка, которую выдает DeepSeek: **жирный**, __подчеркнутый__, *курсив*.
+# Одна альтернация - весь текст токенизируется за один проход.
+_MARKDOWN_RE = re.compile(
+    r'\*\*(?P<bold>.+?)\*\*'
+    r'|__(?P<underline>.+?)__'
+    r'|(?<!\*)\*(?P<italic>[^*]+?)\*(?!\*)'
+)
+
+
+def markdown_to_html(text: str) -> str:
+    """
+    Преобразует markdown разметку в HTML для Telegram.
+    
+    Преобразует:
+    - **текст** → <b>текст</b> (жирный) - только первое вхождение (название),
+      у остальных звездочки просто убираются
+    - *текст* → <i>текст</i> (курсив)
+    - __текст__ → <u>текст</u> (подчеркнутый)
+    
+    Весь остальной текст экранируется (&, <, >), поэтому результат всегда
+    является корректным HTML для ParseMode.HTML.
+    
+    Args:
+        text: Текст с markdown разметкой
+        
+    Returns:
+        Текст с HTML разметкой
+    """
+    parts: List[str] = []
+    _render_markdown(text, parts, allow_bold=True)
+    return ''.join(parts)
+
+
+def _render_markdown(text: str, parts: List[str], allow_bold: bool) -> bool:
+    """
+    Дописывает в parts HTML для text.
+    Возвращает allow_bold после обработки (жирным выделяется только первое вхождение).
+    """
+    position = 0
+    for match in _MARKDOWN_RE.finditer(text):
+        parts.append(html.escape(text[position:match.start()], quote=False))
+        position = match.end()
+        
+        kind = match.lastgroup
+        if kind == 'bold':
+            if allow_bold:
+                allow_bold = False
+                parts.append('<b>')
+                _render_markdown(match.group(kind), parts, allow_bold=False)
+                parts.append('</b>')
+            else:
+                _render_markdown(match.group(kind), parts, allow_bold=False)
+            continue
+        
+        tag = 'u' if kind == 'underline' else 'i'
+        parts.append(f'<{tag}>')
+        allow_bold = _render_markdown(match.group(kind), parts, allow_bold)
+        parts.append(f'</{tag}>')
+    
+    parts.append(html.escape(text[position:], quote=False))
+    return allow_bold
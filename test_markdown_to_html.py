@@ -0,0 +1,77 @@
+"""Тест преобразования markdown в HTML (utils.markdown_to_html).
+
+Корпус типичных ответов DeepSeek с ожидаемым результатом и фаззинг
+на случайных строках: результат всегда должен быть корректным HTML
+для Telegram (только теги b/i/u, сбалансированные, без сырых <, > и &).
+"""
+import os
+import random
+import re
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from utils import markdown_to_html
+
+CORPUS = [
+    ("Просто текст", "Просто текст"),
+    ("**Ёжик и яблоко**\n\nЖил-был ёжик.", "<b>Ёжик и яблоко</b>\n\nЖил-был ёжик."),
+    ("**Название**\n\nОн **очень** устал.", "<b>Название</b>\n\nОн очень устал."),
+    ("Он сказал *тихо* и __твердо__.", "Он сказал <i>тихо</i> и <u>твердо</u>."),
+    ("**Название** и *мысль про __главное__*", "<b>Название</b> и <i>мысль про <u>главное</u></i>"),
+    ("__**Подчеркнутое название**__", "<u><b>Подчеркнутое название</b></u>"),
+    ("2 < 3 && 5 > 4", "2 &lt; 3 &amp;&amp; 5 &gt; 4"),
+    ("<script>alert(1)</script>", "&lt;script&gt;alert(1)&lt;/script&gt;"),
+    ("**<b>Название</b>**", "<b>&lt;b&gt;Название&lt;/b&gt;</b>"),
+    ("Звездочка * одна", "Звездочка * одна"),
+    ("** незакрытый жирный", "** незакрытый жирный"),
+    ("__ незакрытое подчеркивание", "__ незакрытое подчеркивание"),
+    ("Кавычки \"остаются\" 'как есть'", "Кавычки \"остаются\" 'как есть'"),
+    ("Эмодзи 🦔 *курсив 😀*", "Эмодзи 🦔 <i>курсив 😀</i>"),
+    ("", ""),
+]
+
+ALLOWED_TAG_RE = re.compile(r'</?(b|i|u)>')
+ENTITY_RE = re.compile(r'&(amp|lt|gt);')
+FUZZ_ALPHABET = ["*", "**", "_", "__", "<", ">", "&", "a", "б", " ", "\n", "😀", "<b>", "&amp;"]
+
+
+def assert_valid_telegram_html(rendered: str):
+    """Проверяет, что строку примет Telegram с ParseMode.HTML."""
+    stack = []
+    for match in ALLOWED_TAG_RE.finditer(rendered):
+        tag = match.group(0)
+        name = match.group(1)
+        if tag.startswith('</'):
+            assert stack and stack.pop() == name, rendered
+        else:
+            stack.append(name)
+    assert not stack, rendered
+    
+    leftover = ENTITY_RE.sub('', ALLOWED_TAG_RE.sub('', rendered))
+    assert not re.search(r'[<>&]', leftover), rendered
+
+
+def test_corpus():
+    for source, expected in CORPUS:
+        assert markdown_to_html(source) == expected, source
+
+
+def test_fuzz_output_is_valid_html():
+    rng = random.Random(20260119)
+    for _ in range(5000):
+        source = "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, 40)))
+        assert_valid_telegram_html(markdown_to_html(source))
+
+
+def test_only_first_bold_is_kept():
+    rendered = markdown_to_html("**Первое** **второе** **третье**")
+    assert rendered.count("<b>") == 1
+
+
+if __name__ == "__main__":
+    test_corpus()
+    test_fuzz_output_is_valid_html()
+    test_only_first_bold_is_kept()
+    print("✅ Все тесты markdown_to_html пройдены")
@@ -0,0 +1,107 @@
+"""Тест разбиения длинных сообщений (utils.split_message).
+
+Проверяет свойства на случайно сгенерированных HTML-текстах:
+- каждая часть не длиннее лимита в единицах UTF-16;
+- в каждой части сбалансированы HTML-теги;
+- теги и сущности никогда не разрезаются;
+- видимый текст после склейки частей совпадает с исходным.
+"""
+import os
+import random
+import re
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from utils import split_message, utf16_len
+
+TAG_RE = re.compile(r'<(/?)([a-z]+)>')
+WORDS = [
+    "Жил-был", "мальчик", "Петя", "и", "его", "друг", "ёжик", "лес", "солнце",
+    "делиться", "игрушки", "честно", "😀", "🦔", "&amp;", "&lt;", "&gt;", "2+2",
+]
+
+
+def random_story(rng: random.Random, words: int) -> str:
+    """Генерирует текст, похожий на вывод markdown_to_html."""
+    parts = ["<b>Название сказки</b>\n\n"]
+    open_tag = None
+    for i in range(words):
+        if open_tag is None and rng.random() < 0.03:
+            open_tag = rng.choice(["i", "u"])
+            parts.append(f"<{open_tag}>")
+        parts.append(rng.choice(WORDS))
+        if open_tag and rng.random() < 0.1:
+            parts.append(f"</{open_tag}>")
+            open_tag = None
+        roll = rng.random()
+        if roll < 0.03:
+            parts.append(".\n\n")
+        elif roll < 0.12:
+            parts.append(rng.choice([". ", "! ", "? ", "… "]))
+        else:
+            parts.append(" ")
+    if open_tag:
+        parts.append(f"</{open_tag}>")
+    return "".join(parts)
+
+
+def is_balanced(chunk: str) -> bool:
+    """Проверяет, что все теги в части открыты и закрыты корректно."""
+    stack = []
+    for match in TAG_RE.finditer(chunk):
+        closing, name = match.groups()
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return False
+    return not stack
+
+
+def visible_text(html_text: str) -> str:
+    """Видимый текст без тегов и пробельных символов."""
+    return re.sub(r'\s+', '', TAG_RE.sub('', html_text))
+
+
+def test_short_text_is_untouched():
+    text = "Короткая сказка <i>с курсивом</i>."
+    assert split_message(text) == [text]
+
+
+def test_properties_on_random_stories():
+    rng = random.Random(20260119)
+    for _ in range(200):
+        max_length = rng.choice([64, 200, 1000, 3800])
+        text = random_story(rng, rng.randint(20, 3000))
+        chunks = split_message(text, max_length=max_length)
+        
+        for chunk in chunks:
+            assert utf16_len(chunk) <= max_length, (max_length, utf16_len(chunk))
+            assert is_balanced(chunk), chunk
+            assert not re.search(r'<[^>]*$|^[^<]*>', chunk), chunk
+            assert not re.search(r'&#?\w*$', chunk), chunk
+        
+        assert visible_text("".join(chunks)) == visible_text(text)
+
+
+def test_prefers_paragraph_and_sentence_boundaries():
+    paragraph = "Жил-был ёжик. " * 40
+    text = (paragraph.strip() + "\n\n") * 20
+    for chunk in split_message(text, max_length=1500):
+        assert chunk.endswith(".")
+
+
+def test_astral_characters_counted_as_two_units():
+    text = "😀" * 5000
+    chunks = split_message(text, max_length=3800)
+    assert all(utf16_len(chunk) <= 3800 for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+if __name__ == "__main__":
+    test_short_text_is_untouched()
+    test_properties_on_random_stories()
+    test_prefers_paragraph_and_sentence_boundaries()
+    test_astral_characters_counted_as_two_units()
+    print("✅ Все тесты split_message пройдены")
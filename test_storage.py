@@ -0,0 +1,92 @@
+"""Тест хранилища в памяти (storage.InMemoryStorage).
+
+Проверяет ту же семантику, на которую рассчитывает бот при работе с PostgreSQL:
+- версии профиля и compare-and-set в patch_user_profile;
+- сказки только добавляются (история не обрезается) и растет story_total;
+- сказка доступна только своему пользователю;
+- удаление профиля вместе со сказками;
+- счетчики дневной статистики.
+"""
+import os
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+# Хранилище в памяти не обращается к БД, но config требует переменные окружения
+for name, value in (("TELEGRAM_BOT_TOKEN", "test"), ("OPENAI_API_KEY", "test"),
+                    ("DEEPSEEK_API_KEY", "test"), ("DATABASE_URL", "sqlite://")):
+    os.environ.setdefault(name, value)
+
+from storage import InMemoryStorage, create_storage
+
+
+def make_storage():
+    storage = InMemoryStorage()
+    storage.upsert_user_profile(1, "parent", "Маша", "6", "добрая")
+    return storage
+
+
+def test_profile_versions_and_compare_and_set():
+    storage = make_storage()
+    profile = storage.get_user(1)
+    assert profile['child_names'] == "Маша"
+    assert profile['version'] == 1
+    assert storage.user_exists(1) and not storage.user_exists(2)
+
+    patched, conflict = storage.patch_user_profile(1, {'wishes': 'про космос'}, expected_version=1)
+    assert not conflict and patched['wishes'] == 'про космос' and patched['version'] == 2
+
+    current, conflict = storage.patch_user_profile(1, {'wishes': 'про море'}, expected_version=1)
+    assert conflict and current['wishes'] == 'про космос'
+
+    # Неизвестные поля и служебные колонки не меняются
+    patched, _ = storage.patch_user_profile(1, {'version': 100, 'unknown': 'x'})
+    assert patched['version'] == 3
+    assert storage.patch_user_profile(2, {'age': '5'}) == (None, False)
+    assert storage.get_generation_profile(1).wishes == 'про космос'
+
+
+def test_story_history_and_ownership():
+    storage = make_storage()
+    story_ids = [storage.save_story(1, f"Сказка {i}") for i in range(7)]
+    assert storage.get_user(1)['story_total'] == 7
+    # Старые сказки не удаляются при сохранении новых
+    assert storage.get_story(1, story_ids[0])['text'] == "Сказка 0"
+    assert storage.get_story(1, story_ids[-1])['text'] == "Сказка 6"
+    assert storage.get_story(2, story_ids[-1]) is None
+    assert storage.save_story(2, "Нет пользователя") is None
+
+    assert storage.set_story_delivery_status(story_ids[-1], 'delivered')
+    assert storage.get_story(1, story_ids[-1])['delivery_status'] == 'delivered'
+
+    latest = storage.get_latest_story_reflection(1)
+    assert latest == {'id': story_ids[-1], 'reflection_questions': None}
+    storage.set_story_reflection_questions(story_ids[-1], ["Вопрос?"])
+    assert storage.get_latest_story_reflection(1)['reflection_questions'] == ["Вопрос?"]
+
+
+def test_delete_removes_stories():
+    storage = make_storage()
+    story_id = storage.save_story(1, "Сказка")
+    assert storage.delete_user_profile(1)
+    assert not storage.delete_user_profile(1)
+    assert storage.get_user(1) is None
+    assert storage.get_story(1, story_id) is None
+    assert storage.get_latest_story_reflection(1) is None
+
+
+def test_daily_stats():
+    storage = create_storage('memory')
+    assert storage.increment_daily_stat('stories')
+    assert storage.increment_daily_stat('stories', 2)
+    assert not storage.increment_daily_stat('unknown')
+    assert storage.get_daily_stats()['stories'] == 3
+
+
+if __name__ == "__main__":
+    test_profile_versions_and_compare_and_set()
+    test_story_history_and_ownership()
+    test_delete_removes_stories()
+    test_daily_stats()
+    print("✓ Все проверки хранилища в памяти пройдены")
@@ -0,0 +1,58 @@
+"""Train a zstd dictionary on recent stories and save it to story_text_dictionaries.
+
+New stories use the newest dictionary after the bot restarts (STORY_TEXT_COMPRESSION=zstd).
+    python train_story_dictionary.py --samples 5000
+    python train_story_dictionary.py --compress-existing
+"""
+import sys
+import os
+import argparse
+import logging
+
+# Add the current directory and src to Python path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+sys.path.insert(0, os.path.join(current_dir, 'src'))
+
+from src.db.compression import (
+    compress_existing_stories,
+    sample_story_texts,
+    store_dictionary,
+    train_dictionary,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Train and store a dictionary, optionally compress stories stored as plain text."""
+    parser = argparse.ArgumentParser(description="Обучение словаря zstd для текстов сказок")
+    parser.add_argument("--samples", type=int, default=5000, help="Сколько последних сказок взять для обучения")
+    parser.add_argument("--dict-size", type=int, default=112 * 1024, help="Размер словаря, байт")
+    parser.add_argument("--compress-existing", action="store_true",
+                        help="После обучения сжать сказки, которые хранятся как есть")
+    parser.add_argument("--batch-size", type=int, default=500, help="Сказок за одну транзакцию при сжатии")
+    args = parser.parse_args()
+
+    try:
+        samples = sample_story_texts(args.samples)
+        if len(samples) < 100:
+            print(f"❌ Слишком мало сказок для обучения словаря: {len(samples)} (нужно хотя бы 100)")
+            return 1
+        data = train_dictionary(samples, args.dict_size)
+        dict_id = store_dictionary(data, len(samples))
+        print(f"✓ Словарь {dict_id} обучен на {len(samples)} сказках ({len(data) // 1024} КБ)")
+        print("  Новые сказки будут сжиматься с ним после перезапуска бота (STORY_TEXT_COMPRESSION=zstd)")
+
+        if args.compress_existing:
+            count = compress_existing_stories(dict_id, batch_size=args.batch_size)
+            print(f"✓ Сжато сказок: {count}")
+        return 0
+    except Exception as e:
+        logger.error(f"Ошибка обучения словаря: {e}", exc_info=True)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
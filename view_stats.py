@@ -1,6 +1,7 @@
 """View daily statistics."""
 import sys
 import os
+import argparse
 import logging
 from datetime import datetime, timedelta
 
@@ -10,14 +11,87 @@ sys.path.insert(0, current_dir)
 sys.path.insert(0, os.path.join(current_dir, 'src'))
 
 from src.db.repository import get_daily_stats, get_daily_stats_summary
+from src.db.analytics import iter_cohorts, iter_daily_analytics, iter_request_types, refresh_analytics, week_start
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+REQUEST_TYPE_LABELS = {
+    'regular': 'Сообщение',
+    'new_dilemma': 'Новая дилемма',
+    'random_moral': 'Случайная мораль',
+    'previous_moral': 'Прошлая мораль',
+    'wishes': 'Пожелания',
+    'add_traits': 'Характер',
+    'unknown': 'Неизвестно',
+}
+
+
+def print_analytics(days: int, cohort_weeks: int):
+    """Activity, button mix and weekly retention from the analytics tables."""
+    start = datetime.utcnow().date() - timedelta(days=days - 1)
+
+    print("="*80)
+    print(f"АКТИВНОСТЬ ЗА {days} ДНЕЙ")
+    print("="*80 + "\n")
+    print(f"{'Дата':<12} | {'DAU':>8} | {'Сказки':>8} | {'Сказок':>8} | {'Новые':>8}")
+    print(f"{'':12} | {'':>8} | {'':>8} | {'на польз':>8} | {'польз.':>8}")
+    print("-" * 80)
+    for day in iter_daily_analytics(start=start):
+        print(f"{day['date'].isoformat():<12} | {day['active_users']:>8} | {day['stories']:>8} | "
+              f"{day['stories_per_user']:>8.2f} | {day['new_users']:>8}")
+    print("-" * 80 + "\n")
+
+    mix = {}
+    for row in iter_request_types(start=start):
+        mix[row['request_type']] = mix.get(row['request_type'], 0) + row['stories']
+    total = sum(mix.values())
+    print("="*80)
+    print(f"ИСТОЧНИКИ СКАЗОК ЗА {days} ДНЕЙ")
+    print("="*80 + "\n")
+    for request_type, stories in sorted(mix.items(), key=lambda item: item[1], reverse=True):
+        label = REQUEST_TYPE_LABELS.get(request_type, request_type)
+        print(f"{label:<22} {stories:>8}  {stories / total:>6.1%}")
+    if not mix:
+        print("Нет сказок за период.")
+    print()
+
+    first_cohort = week_start(datetime.utcnow().date()) - timedelta(weeks=cohort_weeks - 1)
+    print("="*80)
+    print("УДЕРЖАНИЕ ПО НЕДЕЛЬНЫМ КОГОРТАМ (доля получивших сказку на неделе N после регистрации)")
+    print("="*80 + "\n")
+    print(f"{'Когорта':<12} | {'Польз.':>7} | " + " ".join(f"{'N' + str(week):>6}" for week in range(cohort_weeks)))
+    print("-" * 80)
+    cohort, size, cells = None, 0, {}
+
+    def print_cohort():
+        if cohort is not None:
+            row = " ".join(f"{cells[week]:>6.0%}" if week in cells else f"{'':>6}" for week in range(cohort_weeks))
+            print(f"{cohort.isoformat():<12} | {size:>7} | {row}")
+
+    for row in iter_cohorts(start_week=first_cohort):
+        if row['cohort_week'] != cohort:
+            print_cohort()
+            cohort, size, cells = row['cohort_week'], row['cohort_size'], {}
+        if row['retention'] is not None and row['week'] < cohort_weeks:
+            cells[row['week']] = row['retention']
+    print_cohort()
+    print("-" * 80 + "\n")
+
 
 def main():
     """View daily statistics."""
+    parser = argparse.ArgumentParser(description="Просмотр статистики")
+    parser.add_argument("--days", type=int, default=30, help="За сколько последних дней показать активность")
+    parser.add_argument("--cohort-weeks", type=int, default=8, help="Сколько недельных когорт показать")
+    parser.add_argument("--no-refresh", action="store_true", help="Не обновлять аналитику перед показом")
+    args = parser.parse_args()
+
     try:
+        # Досчитываем аналитику с момента прошлого обновления
+        if not args.no_refresh:
+            refresh_analytics()
+        
         print("\n" + "="*80)
         print("СТАТИСТИКА ПО ДНЯМ")
         print("="*80 + "\n")
@@ -27,6 +101,7 @@ def main():
         
         if not stats:
             print("Нет данных статистики.\n")
+            print_analytics(args.days, args.cohort_weeks)
             return 0
         
         # Заголовок таблицы
@@ -68,6 +143,8 @@ def main():
         
         print("\n" + "="*80 + "\n")
         
+        print_analytics(args.days, args.cohort_weeks)
+        
         return 0
         
     except Exception as e: